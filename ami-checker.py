@@ -1,7 +1,17 @@
 import boto3
 import botocore
+import config_event_batch
 import json
 import datetime
+import os
+
+# SSM parameter holding the high-water mark of the incremental scan
+STATE_PARAMETER_NAME = os.environ.get("STATE_PARAMETER_NAME", "/config-rules/ami-checker/state")
+
+# Beyond this many days since the last run the scan falls back to all images
+MAX_INCREMENTAL_DAYS = 31
+
+MAX_ANNOTATION_LENGTH = 256
 
 # Helper function used to validate input
 def check_defined(reference, reference_name):
@@ -34,61 +44,163 @@ def normalize_parameters(rule_parameters):
 #
 # Arguments:
 #
-# configuration_item - the configuration item obtained from the AWS Config event
-# debug_enabled - debug flag
+# event - the AWS Config (periodic) event
 #
 # return values:
 #
 # compliance_type -
 #
-#     NOT_APPLICABLE - (1) something other than a security group is being evaluated
-#                      (2) the configuration item is being deleted
-#     NON_COMPLIANT  - the rules do not match the required rules and we couldn't
-#                      fix them
-#     COMPLIANT      - the rules match the required rules or we were able to fix
-#                      them
+#     NON_COMPLIANT  - at least one ami of the account is public
+#     COMPLIANT      - none of the ami(s) is public
 #
 # annotation         - the annotation message for AWS Config
+# image_evaluations  - per-image (AWS::EC2::Image) evaluations for images that
+#                      are new since the last run or changed their visibility
+# state              - the scan state to save once the evaluations have been
+#                      accepted (see save_state)
 def evaluate_compliance(event):
 
     owner_id = event["accountId"]
     ec2 = boto3.client('ec2')
+    ssm = boto3.client('ssm')
 
-    response = ec2.describe_images(Owners=[owner_id])
+    state = load_state(ssm)
+    ordering_timestamp = datetime.datetime.now()
+    image_evaluations = []
 
+    # Public images are few, so they are listed in full on every run with a
+    # server-side filter instead of paging through every image of the owner.
     public_ami = []
-    for ami in response["Images"]:
-        print ("evaluting ami ", ami)
-        if ami["Public"]:
-            public_ami.append(ami["ImageId"])
+    for ami in paginate_images(ec2, owner_id, [{"Name": "is-public", "Values": ["true"]}]):
+        print ("public ami ", ami["ImageId"])
+        public_ami.append(ami["ImageId"])
+        image_evaluations.append(image_evaluation(ami["ImageId"], True, ordering_timestamp))
+
+    # Images that were public in the last run but are not any more
+    for image_id in set(state["publicImageIds"]) - set(public_ami):
+        image_evaluations.append(image_evaluation(image_id, False, ordering_timestamp))
+
+    # New private images since the high-water mark
+    high_water_mark = state["highWaterMark"]
+    for ami in paginate_images(ec2, owner_id, creation_date_filters(high_water_mark)):
+        if high_water_mark and ami["CreationDate"] <= high_water_mark:
+            continue
+        state["highWaterMark"] = max(state["highWaterMark"] or "", ami["CreationDate"])
+        if not ami["Public"]:
+            image_evaluations.append(image_evaluation(ami["ImageId"], False, ordering_timestamp))
+
+    state["publicImageIds"] = sorted(public_ami)
+    print ("Per-image evaluations: ", len(image_evaluations))
+
     if len(public_ami) > 0:
+        annotation = "the following ami(s) are publicly accessible: " + ", ".join(public_ami)
         return {
             "compliance_type": "NON_COMPLIANT",
-            "annotation": "the following ami(s) are publicly accessible: " + public_ami
+            "annotation": truncate_annotation(annotation),
+            "image_evaluations": image_evaluations,
+            "state": state
         }
 
     return {
         "compliance_type": "COMPLIANT",
-        "annotation": "all ami(s) are comply with CPA standard"
+        "annotation": "all ami(s) are comply with CPA standard",
+        "image_evaluations": image_evaluations,
+        "state": state
+    }
+
+# paginate_images
+#
+# Stream the images of the owner page by page.
+def paginate_images(ec2, owner_id, filters):
+    paginator = ec2.get_paginator("describe_images")
+    for page in paginator.paginate(Owners=[owner_id], Filters=filters, PaginationConfig={"PageSize": 1000}):
+        for ami in page["Images"]:
+            yield ami
+
+# creation_date_filters
+#
+# describe_images can only filter creation-date with wildcards, so select the
+# days from the high-water mark until today. Without a mark, or when the mark
+# is older than MAX_INCREMENTAL_DAYS, every image is listed.
+def creation_date_filters(high_water_mark):
+    if not high_water_mark:
+        return []
+    since = datetime.datetime.strptime(high_water_mark[:10], "%Y-%m-%d").date()
+    today = datetime.datetime.utcnow().date()
+    days = (today - since).days
+    if days < 0 or days > MAX_INCREMENTAL_DAYS:
+        return []
+    return [{
+        "Name": "creation-date",
+        "Values": [(since + datetime.timedelta(days=d)).isoformat() + "*" for d in range(days + 1)]
+    }]
+
+def image_evaluation(image_id, is_public, ordering_timestamp):
+    if is_public:
+        return {
+            'ComplianceResourceType': 'AWS::EC2::Image',
+            'ComplianceResourceId': image_id,
+            'ComplianceType': 'NON_COMPLIANT',
+            'Annotation': 'the ami is publicly accessible',
+            'OrderingTimestamp': ordering_timestamp
+        }
+    return {
+        'ComplianceResourceType': 'AWS::EC2::Image',
+        'ComplianceResourceId': image_id,
+        'ComplianceType': 'COMPLIANT',
+        'Annotation': 'the ami is not publicly accessible',
+        'OrderingTimestamp': ordering_timestamp
+    }
+
+def truncate_annotation(annotation):
+    if len(annotation) > MAX_ANNOTATION_LENGTH:
+        return annotation[:MAX_ANNOTATION_LENGTH - 3] + "..."
+    return annotation
+
+# load_state / save_state
+#
+# The high-water mark (latest CreationDate seen) and the ids of the images
+# that were public in the last run are kept in SSM Parameter Store. The state
+# is only saved after Config accepted every evaluation of the run, so a failed
+# or timed out run evaluates the same images again.
+def load_state(ssm):
+    try:
+        value = ssm.get_parameter(Name=STATE_PARAMETER_NAME)["Parameter"]["Value"]
+        state = json.loads(value)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ParameterNotFound':
+            raise
+        state = {}
+    return {
+        "highWaterMark": state.get("highWaterMark"),
+        "publicImageIds": state.get("publicImageIds", [])
     }
 
+def save_state(ssm, state):
+    ssm.put_parameter(
+        Name=STATE_PARAMETER_NAME,
+        Value=json.dumps(state),
+        Type='String',
+        Tier='Intelligent-Tiering',
+        Overwrite=True)
+
 def lambda_handler(event, context):
 
     evaluation = evaluate_compliance(event)
-    print("Evaluation Result :", evaluation)
+    print("Evaluation Result :", evaluation["compliance_type"], evaluation["annotation"])
 
     config = boto3.client('config')
 
-    response = config.put_evaluations(
-       Evaluations=[
-           {
-               'ComplianceResourceType': 'AWS::::Account',
-               'ComplianceResourceId': event["accountId"],
-               'ComplianceType': evaluation["compliance_type"],
-               "Annotation": evaluation["annotation"],
-               'OrderingTimestamp': datetime.datetime.now()
-           }
-
-       ],
-       ResultToken=event['resultToken'])
+    account_evaluation = {
+        'ComplianceResourceType': 'AWS::::Account',
+        'ComplianceResourceId': event["accountId"],
+        'ComplianceType': evaluation["compliance_type"],
+        "Annotation": evaluation["annotation"],
+        'OrderingTimestamp': datetime.datetime.now()
+    }
+    failed = config_event_batch.put_evaluations_in_chunks(config, [account_evaluation] + evaluation["image_evaluations"], event['resultToken'])
 
+    if failed:
+        print("State not saved, the next run evaluates the same images again")
+        return
+    save_state(boto3.client('ssm'), evaluation["state"])
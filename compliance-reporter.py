@@ -1,6 +1,55 @@
 import boto3
 import botocore
+import compliance_history
+import concurrent.futures
+import csv
+import datetime
+import gzip
+import hashlib
+import io
 import json
+import os
+import threading
+from botocore.config import Config
+
+# Rules fetched in parallel. Throttled calls are retried by the client in
+# adaptive mode, which also rate limits the client after throttling errors.
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))
+CONFIG_CLIENT_CONFIG = Config(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    max_pool_connections=MAX_WORKERS)
+
+# "account" reports on this account only, "aggregator" on every account and
+# region of the config aggregator
+REPORT_MODE = os.environ.get("REPORT_MODE", "account")
+
+# Where the snapshot of the last run is kept: "s3://bucket/key", or a local
+# file path (used as a stand-in when testing). When set, only the delta to
+# the previous run is reported.
+SNAPSHOT_LOCATION = os.environ.get("SNAPSHOT_LOCATION")
+
+# When set, the full report is streamed to this bucket as CSV and JSON Lines
+# and SNS only receives a summary with per-rule counts and the object keys.
+REPORT_BUCKET = os.environ.get("REPORT_BUCKET")
+REPORT_PREFIX = os.environ.get("REPORT_PREFIX", "compliance-reports/")
+
+# S3 multipart parts must be at least 5 MiB, except for the last one
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# SNS messages are limited to 256 KB; keep the summary well below it
+MAX_SUMMARY_RULE_LINES = 1000
+
+# Bytes of the newly failing and of the resolved listing in a delta report;
+# the rest of a section is only counted, so the message stays under the SNS
+# limit however large the change
+MAX_DELTA_SECTION_BYTES = 100 * 1024
+
+# Local columnar history of every run (SQLite, see compliance_history.py):
+# a local path, or "s3://bucket/key" which is downloaded to /tmp, appended to
+# and uploaded again.
+HISTORY_LOCATION = os.environ.get("HISTORY_LOCATION")
+
+CSV_COLUMNS = ["rule", "account_id", "region", "resource_type", "resource_id", "annotation", "result_recorded_time"]
 
 # Helper function used to validate input
 def check_defined(reference, reference_name):
@@ -28,47 +77,459 @@ def normalize_parameters(rule_parameters):
     return rule_parameters
 
 
-def lambda_handler(event, context):
+# list_config_rules
+#
+# Names of all config rules of the account, following every page.
+def list_config_rules(config):
+    rule_names = []
+    paginator = config.get_paginator("describe_config_rules")
+    for page in paginator.paginate():
+        for rule in page["ConfigRules"]:
+            rule_names.append(rule["ConfigRuleName"])
+    return rule_names
 
-    ACCOUNT_ID = context.invoked_function_arn.split(":")[4]
-    config = boto3.client('config')
-    aggregator="security-control-config-aggr"
-    region="ap-southeast-1"
+# get_non_compliant_results
+#
+# All NON_COMPLIANT evaluation results of one rule, following every page.
+#
+# With a sink, every page is handed to sink(rule_name, results) as it arrives
+# and nothing is kept in memory.
+def get_non_compliant_results(config, rule_name, sink=None):
+    results = []
+    paginator = config.get_paginator("get_compliance_details_by_config_rule")
+    for page in paginator.paginate(ConfigRuleName=rule_name, ComplianceTypes=["NON_COMPLIANT"], PaginationConfig={"PageSize": 100}):
+        if sink is not None:
+            sink(rule_name, page["EvaluationResults"])
+        else:
+            results.extend(page["EvaluationResults"])
+    return results
+
+# collect_concurrently
+#
+# Call fetch(key) for every key on a bounded thread pool. The config client
+# retries throttled calls in adaptive mode, which also slows the request rate
+# down client side, so MAX_WORKERS only bounds the fan-out.
+#
+# return values:
+#
+# a list of (key, fetch(key)) in the order of keys
+def collect_concurrently(fetch, keys):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(zip(keys, executor.map(fetch, keys)))
+
+# collect_non_compliant_results
+#
+# NON_COMPLIANT results of every rule of this account.
+#
+# return values:
+#
+# a list of (rule_name, evaluation results) in the order of rule_names
+def collect_non_compliant_results(config, rule_names, sink=None):
+    return collect_concurrently(lambda rule_name: get_non_compliant_results(config, rule_name, sink), rule_names)
+
+# list_aggregate_non_compliant_targets
+#
+# (account, region, rule) combinations of the aggregator that have at least
+# one NON_COMPLIANT resource. Compliant combinations need no detail call.
+def list_aggregate_non_compliant_targets(config, aggregator):
+    targets = []
+    paginator = config.get_paginator("describe_aggregate_compliance_by_config_rules")
+    for page in paginator.paginate(ConfigurationAggregatorName=aggregator, Filters={"ComplianceType": "NON_COMPLIANT"}):
+        for rule in page["AggregateComplianceByConfigRules"]:
+            targets.append((rule["AccountId"], rule["AwsRegion"], rule["ConfigRuleName"]))
+    return sorted(set(targets))
+
+# get_aggregate_non_compliant_results
+#
+# All NON_COMPLIANT evaluation results of one (account, region, rule). With a
+# sink, pages are streamed to it as in get_non_compliant_results.
+def get_aggregate_non_compliant_results(config, aggregator, target, sink=None):
+    account_id, aws_region, rule_name = target
+    results = []
+    paginator = config.get_paginator("get_aggregate_compliance_details_by_config_rule")
+    for page in paginator.paginate(
+            ConfigurationAggregatorName=aggregator,
+            ConfigRuleName=rule_name,
+            AccountId=account_id,
+            AwsRegion=aws_region,
+            ComplianceType="NON_COMPLIANT",
+            PaginationConfig={"PageSize": 100}):
+        if sink is not None:
+            sink(aggregate_heading(target), page["AggregateEvaluationResults"])
+        else:
+            results.extend(page["AggregateEvaluationResults"])
+    return results
+
+def aggregate_heading(target):
+    account_id, aws_region, rule_name = target
+    return rule_name + " @ " + account_id + "/" + aws_region
+
+# collect_aggregate_non_compliant_results
+#
+# NON_COMPLIANT results of every account and region of the aggregator,
+# fetched per (account, region, rule) on the bounded thread pool.
+#
+# return values:
+#
+# a list of (heading, evaluation results), sorted by account, region and rule
+def collect_aggregate_non_compliant_results(config, aggregator, sink=None):
+    targets = list_aggregate_non_compliant_targets(config, aggregator)
+    print ("Aggregated targets with findings: ", len(targets))
+    collected = collect_concurrently(lambda target: get_aggregate_non_compliant_results(config, aggregator, target, sink), targets)
+    return [(aggregate_heading(target), results) for target, results in collected]
+
+# write_report
+#
+# Write the report to a file-like object, one rule at a time, instead of
+# growing one string by repeated concatenation.
+def write_report(out, scope, collected):
+    out.write("This is a auto-generated message, please approach DevOps team if you have any enquiry on the message's content.\n\n")
+    out.write("Below is the compliance status of " + scope + "\n\n")
 
-    message="This is a auto-generated message, please approach DevOps team if you have any enquiry on the message's content.\n\n"
-    message+="Below is the compliance status of account " + ACCOUNT_ID + "\n\n"
-
-    rules = config.describe_config_rules()
-    for rule in rules["ConfigRules"]:
-        rule_name = rule["ConfigRuleName"]
-        message += "Non-Compliance Result of [" + rule_name + "]: \n"
-        #message += "\n========== NON_COMPLIANT ============\n"
-        response = config.get_compliance_details_by_config_rule(ConfigRuleName=rule_name, ComplianceTypes=["NON_COMPLIANT"])
-        if len(response["EvaluationResults"]) > 0:
-            for result in response["EvaluationResults"]:
-                message += result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"]
+    for rule_name, results in collected:
+        out.write("Non-Compliance Result of [" + rule_name + "]: \n")
+        if len(results) > 0:
+            for result in results:
+                out.write(result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"])
                 if "Annotation" in result:
-                    message += ": " + result["Annotation"] + "\n"
+                    out.write(": " + result["Annotation"] + "\n")
                 else:
-                    message += "\n"
+                    out.write("\n")
         else:
-            message += "Nil\n"
-        message += "\n\n"
-#        message += "========== NON_COMPLIANT ============\n"
-#        response = config.get_compliance_details_by_config_rule(ConfigRuleName=rule_name, ComplianceTypes=["COMPLIANT"])
-#        for result in response["EvaluationResults"]:
-#            message += result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"]
-#        message += "\n\n"
+            out.write("Nil\n")
+        out.write("\n\n")
 
-    print ("Message: " + message)
-    subject = "[" + ACCOUNT_ID + "] compliance report"
+# annotation_hash
+#
+# Short digest of an annotation, enough to notice that it changed.
+def annotation_hash(annotation):
+    return hashlib.sha1(annotation.encode("utf-8")).hexdigest()[:12]
 
-    sns = boto3.client('sns')
+# snapshot_entries
+#
+# The compact snapshot of one run: a set of (rule, resourceId, annotation hash).
+def snapshot_entries(collected):
+    entries = set()
+    for rule_name, results in collected:
+        for result in results:
+            resource_id = result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"]
+            entries.add((rule_name, resource_id, annotation_hash(result.get("Annotation", ""))))
+    return entries
 
-    topic_arn = "arn:aws:sns:ap-southeast-1:" + ACCOUNT_ID + ":compliance-reporter-topic"
+# load_snapshot / save_snapshot
+#
+# The snapshot is stored as gzipped JSON of the sorted entries.
+#
+# load_snapshot returns None when there is no previous snapshot.
+def load_snapshot(location):
     try:
-        sns.publish(TopicArn=topic_arn, Subject=subject, Message=message)
+        if location.startswith("s3://"):
+            bucket, key = location[len("s3://"):].split("/", 1)
+            data = boto3.client('s3').get_object(Bucket=bucket, Key=key)["Body"].read()
+        else:
+            with open(location, "rb") as f:
+                data = f.read()
+    except FileNotFoundError:
+        return None
     except botocore.exceptions.ClientError as e:
-        print ("Fail to send message to topic " + topic_arn)
-        print ("Reason: ",e)
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return None
+        raise
+    return set(tuple(entry) for entry in json.loads(gzip.decompress(data)))
+
+def save_snapshot(location, entries):
+    data = gzip.compress(json.dumps(sorted(entries), separators=(",", ":")).encode("utf-8"))
+    if location.startswith("s3://"):
+        bucket, key = location[len("s3://"):].split("/", 1)
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+    else:
+        with open(location, "wb") as f:
+            f.write(data)
+
+# diff_snapshots
+#
+# Set difference of two snapshots on (rule, resourceId).
+#
+# return values:
+#
+# a dict with the sorted (rule, resourceId) pairs that are "new" (failing now,
+# not before), "resolved" (failing before, not now) and "still_failing", and
+# the number of still failing resources whose annotation "changed"
+def diff_snapshots(previous, current):
+    previous_hashes = {(rule, resource): digest for rule, resource, digest in previous}
+    current_hashes = {(rule, resource): digest for rule, resource, digest in current}
+    still_failing = current_hashes.keys() & previous_hashes.keys()
+    return {
+        "new": sorted(current_hashes.keys() - previous_hashes.keys()),
+        "resolved": sorted(previous_hashes.keys() - current_hashes.keys()),
+        "still_failing": sorted(still_failing),
+        "changed": sum(1 for key in still_failing if current_hashes[key] != previous_hashes[key])
+    }
+
+# write_delta_report
+#
+# Write only what changed since the previous run, with counts. Each listing
+# is cut at max_section_bytes (0 writes the counts only).
+def write_delta_report(out, scope, collected, delta, first_run=False, max_section_bytes=MAX_DELTA_SECTION_BYTES):
+    annotations = {}
+    for rule_name, results in collected:
+        for result in results:
+            resource_id = result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]["ResourceId"]
+            annotations[(rule_name, resource_id)] = result.get("Annotation")
+
+    out.write("This is a auto-generated message, please approach DevOps team if you have any enquiry on the message's content.\n\n")
+    out.write("Below are the compliance changes since the last report of " + scope + "\n\n")
+    if first_run:
+        out.write("There is no previous report: every NON_COMPLIANT result is newly failing.\n\n")
+    out.write("Newly failing: " + str(len(delta["new"])) + "\n")
+    out.write("Resolved: " + str(len(delta["resolved"])) + "\n")
+    out.write("Still failing: " + str(len(delta["still_failing"])) +
+              " (annotation changed: " + str(delta["changed"]) + ")\n\n")
+
+    for title, keys in [("Newly NON_COMPLIANT", delta["new"]), ("Resolved", delta["resolved"])]:
+        out.write("========== " + title + " ==========\n")
+        if len(keys) == 0:
+            out.write("Nil\n")
+        written = 0
+        size = 0
+        for rule_name, resource_id in keys:
+            line = "[" + rule_name + "] " + resource_id
+            if annotations.get((rule_name, resource_id)):
+                line += ": " + annotations[(rule_name, resource_id)]
+            line += "\n"
+            size += len(line.encode("utf-8"))
+            if size > max_section_bytes:
+                break
+            out.write(line)
+            written += 1
+        if written < len(keys):
+            out.write("... and " + str(len(keys) - written) + " more, not listed\n")
+        out.write("\n\n")
+
+# S3MultipartWriter
+#
+# File-like writer that uploads to S3 through a multipart upload, holding at
+# most one part (MULTIPART_PART_SIZE) in memory.
+class S3MultipartWriter:
+    def __init__(self, s3, bucket, key, content_type):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+
+    def write(self, text):
+        self.buffer += text.encode("utf-8")
+        if len(self.buffer) >= MULTIPART_PART_SIZE:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer = bytearray()
+
+    def close(self):
+        # The last part may be smaller than 5 MiB (or even empty)
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+# ReportOutput
+#
+# Sink for the collectors: writes every page of results to the CSV and JSON
+# Lines objects as it arrives and keeps only per-rule counts (and, for delta
+# reports, the compact snapshot entries). Called from the collector threads.
+class ReportOutput:
+    def __init__(self, s3, bucket, key_prefix, track_snapshot):
+        self.csv_key = key_prefix + "report.csv"
+        self.jsonl_key = key_prefix + "report.jsonl"
+        self.csv_out = S3MultipartWriter(s3, bucket, self.csv_key, "text/csv")
+        self.jsonl_out = S3MultipartWriter(s3, bucket, self.jsonl_key, "application/x-ndjson")
+        self.counts = {}
+        self.snapshot = set() if track_snapshot else None
+        self.lock = threading.Lock()
+        self._write_csv_row(CSV_COLUMNS)
+
+    def _write_csv_row(self, row):
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        self.csv_out.write(line.getvalue())
+
+    def add(self, rule_name, results):
+        with self.lock:
+            self.counts[rule_name] = self.counts.get(rule_name, 0) + len(results)
+            for result in results:
+                qualifier = result["EvaluationResultIdentifier"]["EvaluationResultQualifier"]
+                annotation = result.get("Annotation", "")
+                recorded = result.get("ResultRecordedTime")
+                row = {
+                    "rule": qualifier["ConfigRuleName"],
+                    "account_id": result.get("AccountId", ""),
+                    "region": result.get("AwsRegion", ""),
+                    "resource_type": qualifier["ResourceType"],
+                    "resource_id": qualifier["ResourceId"],
+                    "annotation": annotation,
+                    "result_recorded_time": recorded.isoformat() if recorded else ""
+                }
+                self._write_csv_row([row[column] for column in CSV_COLUMNS])
+                self.jsonl_out.write(json.dumps(row) + "\n")
+                if self.snapshot is not None:
+                    self.snapshot.add((rule_name, qualifier["ResourceId"], annotation_hash(annotation)))
+
+    def close(self):
+        self.csv_out.close()
+        self.jsonl_out.close()
+
+    def abort(self):
+        self.csv_out.abort()
+        self.jsonl_out.abort()
+
+# write_summary
+#
+# Compact SNS message for reports offloaded to S3: totals, per-rule counts
+# and the object keys. Per-rule lines are capped to stay under the SNS limit.
+def write_summary(out, scope, output, bucket, delta=None):
+    out.write("This is a auto-generated message, please approach DevOps team if you have any enquiry on the message's content.\n\n")
+    out.write("Below is the compliance summary of " + scope + "\n\n")
+    out.write("NON_COMPLIANT results: " + str(sum(output.counts.values())) + "\n")
+    if delta is not None:
+        out.write("Newly failing: " + str(len(delta["new"])) + "\n")
+        out.write("Resolved: " + str(len(delta["resolved"])) + "\n")
+        out.write("Still failing: " + str(len(delta["still_failing"])) + "\n")
+    out.write("\nFull report:\n")
+    out.write("s3://" + bucket + "/" + output.csv_key + "\n")
+    out.write("s3://" + bucket + "/" + output.jsonl_key + "\n\n")
+
+    out.write("Non-Compliance count per rule:\n")
+    rules = sorted(output.counts.items())
+    for rule_name, count in rules[:MAX_SUMMARY_RULE_LINES]:
+        out.write("[" + rule_name + "]: " + str(count) + "\n")
+    if len(rules) > MAX_SUMMARY_RULE_LINES:
+        out.write("... and " + str(len(rules) - MAX_SUMMARY_RULE_LINES) + " more rules, see the full report\n")
+
+# append_history
+#
+# Append the entries of this run to the history store.
+def append_history(location, scope, entries, run_time):
+    if not location.startswith("s3://"):
+        conn = compliance_history.connect(location)
+        compliance_history.append_run(conn, scope, entries, run_time)
+        conn.close()
+        return
+
+    bucket, key = location[len("s3://"):].split("/", 1)
+    local_path = "/tmp/" + key.replace("/", "_")
+    s3 = boto3.client('s3')
+    try:
+        s3.download_file(bucket, key, local_path)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            raise
+    conn = compliance_history.connect(local_path)
+    compliance_history.append_run(conn, scope, entries, run_time)
+    conn.close()
+    s3.upload_file(local_path, bucket, key)
+
+# lambda_handler
+#
+# In the default "account" mode the report covers the rules of this account.
+# In "aggregator" mode (REPORT_MODE environment variable, or "mode" in the
+# event) one consolidated report covers every account and region of the
+# config aggregator. With SNAPSHOT_LOCATION set only the delta to the last
+# run is published. With REPORT_BUCKET set the full report goes to S3 and
+# SNS only receives a summary. With HISTORY_LOCATION set every run is also
+# appended to the compliance history store.
+def lambda_handler(event, context):
+
+    ACCOUNT_ID = context.invoked_function_arn.split(":")[4]
+    config = boto3.client('config', config=CONFIG_CLIENT_CONFIG)
+    aggregator = os.environ.get("AGGREGATOR_NAME", "security-control-config-aggr")
+    region="ap-southeast-1"
+    mode = (event or {}).get("mode", REPORT_MODE)
+
+    if mode == "aggregator":
+        scope_id = aggregator
+        scope = "all accounts of aggregator " + aggregator
+        subject = "[" + aggregator + "] consolidated compliance report"
+        collect = lambda sink=None: collect_aggregate_non_compliant_results(config, aggregator, sink)
+    else:
+        scope_id = ACCOUNT_ID
+        scope = "account " + ACCOUNT_ID
+        subject = "[" + ACCOUNT_ID + "] compliance report"
+        collect = lambda sink=None: collect_non_compliant_results(config, list_config_rules(config), sink)
+
+    run_time = datetime.datetime.utcnow()
+    track_entries = bool(SNAPSHOT_LOCATION or HISTORY_LOCATION)
+    current = None
+    # No snapshot to compare with yet: this run's snapshot is the baseline
+    first_run = False
+    # Smaller message sent when the report itself cannot be published
+    fallback = None
+
+    report = io.StringIO()
+    if REPORT_BUCKET:
+        # Stream the results to S3 while collecting; memory stays bounded
+        key_prefix = REPORT_PREFIX + scope_id + "/" + run_time.strftime("%Y-%m-%dT%H%M%SZ") + "/"
+        output = ReportOutput(boto3.client('s3'), REPORT_BUCKET, key_prefix, track_entries)
+        try:
+            collect(output.add)
+            output.close()
+        except Exception:
+            output.abort()
+            raise
+        current = output.snapshot
+        delta = None
+        if SNAPSHOT_LOCATION:
+            previous = load_snapshot(SNAPSHOT_LOCATION)
+            first_run = previous is None
+            delta = diff_snapshots(previous or set(), current)
+        write_summary(report, scope, output, REPORT_BUCKET, delta)
+    elif SNAPSHOT_LOCATION:
+        collected = collect()
+        current = snapshot_entries(collected)
+        previous = load_snapshot(SNAPSHOT_LOCATION)
+        first_run = previous is None
+        delta = diff_snapshots(previous or set(), current)
+        write_delta_report(report, scope, collected, delta, first_run)
+        counts = io.StringIO()
+        write_delta_report(counts, scope, collected, delta, first_run, max_section_bytes=0)
+        fallback = counts.getvalue()
+    else:
+        collected = collect()
+        if track_entries:
+            current = snapshot_entries(collected)
+        write_report(report, scope, collected)
+    message = report.getvalue()
+
+    if HISTORY_LOCATION:
+        append_history(HISTORY_LOCATION, scope_id, current, run_time)
+
+    print ("Message: " + message)
+
+    sns = boto3.client('sns')
+
+    topic_arn = "arn:aws:sns:" + region + ":" + ACCOUNT_ID + ":compliance-reporter-topic"
+    delivered = False
+    for attempt in [message] if fallback is None else [message, fallback]:
+        try:
+            sns.publish(TopicArn=topic_arn, Subject=subject, Message=attempt)
+            delivered = True
+            break
+        except botocore.exceptions.ClientError as e:
+            print ("Fail to send message to topic " + topic_arn)
+            print ("Reason: ",e)
 
+    # Only move the snapshot forward once the delta (or at least its counts)
+    # has been delivered; the first snapshot is saved in any case, otherwise
+    # every run would be a first run
+    if SNAPSHOT_LOCATION and (delivered or first_run):
+        save_snapshot(SNAPSHOT_LOCATION, current)
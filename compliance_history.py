@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import json
+import sqlite3
+
+# Local history of compliance-reporter.py runs.
+#
+# Every run appends its NON_COMPLIANT results (rule, resource, annotation hash)
+# to a SQLite file, together with a row in "runs", so a resource that is
+# missing from a recorded run was compliant in that run. The indexes on
+# (scope, rule, resource_id, run_date) and (scope, run_date) answer "how long
+# has this resource been non-compliant", "which rules regressed" and trend
+# questions locally instead of replaying the Config history APIs.
+#
+# Runs are kept per scope (the account id, or the aggregator name in
+# aggregator mode), so one file can hold the history of several reporters;
+# every query is about one scope.
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        scope TEXT NOT NULL,
+        run_time TEXT NOT NULL,
+        run_date TEXT NOT NULL,
+        non_compliant INTEGER NOT NULL,
+        PRIMARY KEY (scope, run_time)
+    )""",
+    """CREATE TABLE IF NOT EXISTS evaluations (
+        scope TEXT NOT NULL,
+        run_time TEXT NOT NULL,
+        run_date TEXT NOT NULL,
+        rule TEXT NOT NULL,
+        resource_id TEXT NOT NULL,
+        annotation_hash TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_evaluations_scope_rule_resource_date ON evaluations (scope, rule, resource_id, run_date)",
+    "CREATE INDEX IF NOT EXISTS ix_evaluations_scope_date_rule ON evaluations (scope, run_date, rule)",
+    "CREATE INDEX IF NOT EXISTS ix_evaluations_scope_run ON evaluations (scope, run_time)",
+    "CREATE INDEX IF NOT EXISTS ix_runs_scope_date ON runs (scope, run_date)",
+]
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+# append_run
+#
+# Record one run. Recording the same scope and run_time again replaces it.
+#
+# Arguments:
+#
+# scope - the account id or aggregator name the run reported on
+# entries - iterable of (rule, resource_id, annotation_hash), as produced by
+#           snapshot_entries in compliance-reporter.py
+# run_time - datetime of the run (UTC)
+def append_run(conn, scope, entries, run_time):
+    run_time_value = run_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    run_date = run_time.strftime("%Y-%m-%d")
+    rows = [(scope, run_time_value, run_date, rule, resource_id, digest) for rule, resource_id, digest in entries]
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)", (scope, run_time_value, run_date, len(rows)))
+        conn.execute("DELETE FROM evaluations WHERE scope = ? AND run_time = ?", (scope, run_time_value))
+        conn.executemany("INSERT INTO evaluations VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+# time_in_violation
+#
+# How long a resource has been failing a rule without interruption, in the
+# runs of one scope.
+#
+# return values:
+#
+# None if the resource is not failing in the latest run, otherwise a dict with
+# the first run of the current streak ("since"), the latest run and the number
+# of days in between
+def time_in_violation(conn, scope, rule, resource_id):
+    latest = conn.execute("SELECT MAX(run_time) FROM runs WHERE scope = ?", (scope,)).fetchone()[0]
+    failing = conn.execute(
+        "SELECT 1 FROM evaluations WHERE scope = ? AND rule = ? AND resource_id = ? AND run_time = ?",
+        (scope, rule, resource_id, latest)).fetchone()
+    if latest is None or failing is None:
+        return None
+
+    # The last recorded run in which the resource was compliant
+    last_compliant = conn.execute(
+        """SELECT MAX(runs.run_time) FROM runs
+           WHERE runs.scope = ?
+             AND NOT EXISTS (
+               SELECT 1 FROM evaluations e
+               WHERE e.scope = runs.scope AND e.rule = ? AND e.resource_id = ? AND e.run_time = runs.run_time)""",
+        (scope, rule, resource_id)).fetchone()[0]
+    since = conn.execute(
+        "SELECT MIN(run_time) FROM evaluations WHERE scope = ? AND rule = ? AND resource_id = ? AND run_time > ?",
+        (scope, rule, resource_id, last_compliant or "")).fetchone()[0]
+
+    days = (parse_time(latest) - parse_time(since)).total_seconds() / 86400
+    return {"since": since, "latest": latest, "days": round(days, 2)}
+
+# regressions
+#
+# Rules with resources failing in the latest run of the scope that were not
+# failing in its last run before since_date (e.g. the start of the week).
+#
+# return values:
+#
+# a list of (rule, newly failing resources) sorted by count, highest first
+def regressions(conn, scope, since_date):
+    latest = conn.execute("SELECT MAX(run_time) FROM runs WHERE scope = ?", (scope,)).fetchone()[0]
+    baseline = conn.execute("SELECT MAX(run_time) FROM runs WHERE scope = ? AND run_date < ?",
+                            (scope, since_date)).fetchone()[0]
+    if latest is None:
+        return []
+    return conn.execute(
+        """SELECT cur.rule, COUNT(*) FROM evaluations cur
+           WHERE cur.scope = ? AND cur.run_time = ?
+             AND NOT EXISTS (
+                 SELECT 1 FROM evaluations base
+                 WHERE base.scope = cur.scope AND base.rule = cur.rule AND base.resource_id = cur.resource_id
+                   AND base.run_time = ?)
+           GROUP BY cur.rule
+           ORDER BY COUNT(*) DESC, cur.rule""",
+        (scope, latest, baseline or "")).fetchall()
+
+# trend
+#
+# Number of failing resources per day and rule (last run of each day) of the
+# scope, for the last `days` days, optionally for one rule only.
+#
+# return values:
+#
+# a list of (run_date, rule, non-compliant resources) ordered by date and rule
+def trend(conn, scope, days=30, rule=None):
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+    query = """SELECT e.run_date, e.rule, COUNT(*) FROM evaluations e
+               JOIN (SELECT run_date, MAX(run_time) AS run_time FROM runs
+                     WHERE scope = ? AND run_date >= ? GROUP BY run_date) last
+                 ON e.run_time = last.run_time
+               WHERE e.scope = ?"""
+    parameters = [scope, since, scope]
+    if rule is not None:
+        query += " AND e.rule = ?"
+        parameters.append(rule)
+    query += " GROUP BY e.run_date, e.rule ORDER BY e.run_date, e.rule"
+    return conn.execute(query, parameters).fetchall()
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+# only_scope
+#
+# The scope of a history file that holds a single one, for the command line.
+def only_scope(conn):
+    scopes = [row[0] for row in conn.execute("SELECT DISTINCT scope FROM runs ORDER BY scope")]
+    if len(scopes) != 1:
+        raise SystemExit("--scope is required, the history holds the scopes: " + ", ".join(scopes))
+    return scopes[0]
+
+# Command line helper, e.g.
+#
+#   python compliance_history.py history.db time-in-violation <rule> <resource id>
+#   python compliance_history.py history.db regressions 2026-10-12
+#   python compliance_history.py history.db --scope <account id> trend --days 7 --rule <rule>
+#
+# --scope can be left out when the file holds a single scope.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the compliance history")
+    parser.add_argument("path")
+    parser.add_argument("--scope")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("time-in-violation")
+    command.add_argument("rule")
+    command.add_argument("resource_id")
+    command = commands.add_parser("regressions")
+    command.add_argument("since_date")
+    command = commands.add_parser("trend")
+    command.add_argument("--days", type=int, default=30)
+    command.add_argument("--rule")
+    args = parser.parse_args()
+
+    conn = connect(args.path)
+    scope = args.scope or only_scope(conn)
+    if args.command == "time-in-violation":
+        result = time_in_violation(conn, scope, args.rule, args.resource_id)
+    elif args.command == "regressions":
+        result = regressions(conn, scope, args.since_date)
+    else:
+        result = trend(conn, scope, args.days, args.rule)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,221 @@
+import boto3
+import botocore
+import config_event_batch
+import importlib.util
+import json
+import network_classifier
+import os
+import resource_context
+
+# One custom Config rule per resource type that runs every registered rule
+# against a configuration item in a single invocation.
+#
+# The rules share one resource context (see resource_context.py), so the
+# configuration item is parsed once and a lookup such as the VPC CIDR of an
+# RDS instance or the ingress rules of an oversized security group is made
+# once, whatever the number of rules. Config attributes evaluations to the
+# rule that issued the result token, so the rule results are combined into
+# one evaluation per resource: NON_COMPLIANT if any rule fails, with the
+# failing rules named in the annotation.
+#
+# Rule parameters (all optional):
+#
+#   Rules              comma separated subset of the registered rules to run
+#   ProductionCidrs    see network_classifier.py
+#   NonProductionCidrs see network_classifier.py
+#   debug              print the event and the ingress rules
+
+# resource type -> rule modules (file names without .py), in evaluation order.
+# A rule module provides evaluate_context(context, debug_enabled).
+#
+# rds-failed-login stays a rule of its own: its clients are bound to
+# ap-southeast-1 and its remediation waits minutes for the instance to
+# reboot, which would hold up every other rule of the resource.
+RULE_REGISTRY = {
+    "AWS::EC2::SecurityGroup": ["security-group", "jumphost-checker"],
+    "AWS::RDS::DBInstance": ["rds-checker", "rds-encryption-checker"],
+}
+
+CONTEXT_TYPES = {
+    "AWS::EC2::SecurityGroup": resource_context.SecurityGroupContext,
+    "AWS::RDS::DBInstance": resource_context.RdsContext,
+}
+
+RULES_PARAMETER = "Rules"
+
+MAX_ANNOTATION_LENGTH = 256
+
+# Rule modules loaded by this container, by name
+LOADED_RULES = {}
+
+# load_rule
+#
+# The rule files have hyphenated names, so they are loaded from their path
+# next to this file instead of being imported.
+def load_rule(name):
+    if name not in LOADED_RULES:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py")
+        spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        LOADED_RULES[name] = module
+    return LOADED_RULES[name]
+
+# Helper function used to validate input
+def check_defined(reference, reference_name):
+    if not reference:
+        raise Exception('Error: ', reference_name, 'is not defined')
+    return reference
+
+# selected_rules
+#
+# The registered rules for resource_type, restricted to the Rules parameter
+# when it is set.
+def selected_rules(resource_type, rule_parameters):
+    rule_names = RULE_REGISTRY.get(resource_type, [])
+    selection = rule_parameters.get(RULES_PARAMETER)
+    if selection:
+        wanted = [name.strip() for name in selection.split(",") if name.strip()]
+        unknown = [name for name in wanted if name not in rule_names]
+        if unknown:
+            print("Ignoring rules not registered for " + resource_type + ": ", unknown)
+        rule_names = [name for name in rule_names if name in wanted]
+    return rule_names
+
+# evaluate_rules
+#
+# Run the given rules against one applicable, existing configuration item
+# with a shared context.
+#
+# return values:
+#
+# a list of (rule name, evaluation) in rule order
+def evaluate_rules(configuration_item, classifier, rule_names, debug_enabled):
+    try:
+        context = CONTEXT_TYPES[configuration_item["resourceType"]](configuration_item, classifier)
+    except (botocore.exceptions.ClientError, ValueError) as e:
+        print("e:", e)
+        failure = {
+            "compliance_type" : "NON_COMPLIANT",
+            "annotation" : "evaluation failure on resource " + configuration_item["resourceId"]
+        }
+        return [(name, failure) for name in rule_names]
+
+    results = []
+    for name in rule_names:
+        try:
+            evaluation = load_rule(name).evaluate_context(context, debug_enabled)
+        except Exception as e:
+            # One broken rule must not fail the evaluation of the others
+            print("Rule " + name + " failed: ", e)
+            evaluation = {
+                "compliance_type" : "NON_COMPLIANT",
+                "annotation" : "evaluation failure on resource " + configuration_item["resourceId"]
+            }
+        print("Rule " + name + ": ", evaluation)
+        results.append((name, evaluation))
+    return results
+
+# combine_evaluations
+#
+# Fold the rule results into the single evaluation reported for the resource.
+def combine_evaluations(results):
+    failed = [(name, evaluation) for name, evaluation in results if evaluation["compliance_type"] == "NON_COMPLIANT"]
+    if failed:
+        compliance_type = "NON_COMPLIANT"
+        annotation = "; ".join(name + ": " + evaluation["annotation"] for name, evaluation in failed)
+    elif any(evaluation["compliance_type"] == "COMPLIANT" for name, evaluation in results):
+        compliance_type = "COMPLIANT"
+        annotation = "passed " + ", ".join(name for name, evaluation in results if evaluation["compliance_type"] == "COMPLIANT")
+    else:
+        compliance_type = "NOT_APPLICABLE"
+        annotation = "; ".join(name + ": " + evaluation["annotation"] for name, evaluation in results) \
+            or "No rule applies to this resource."
+
+    if len(annotation) > MAX_ANNOTATION_LENGTH:
+        annotation = annotation[:MAX_ANNOTATION_LENGTH - 3] + "..."
+    return {
+        "compliance_type": compliance_type,
+        "annotation": annotation
+    }
+
+# evaluate_compliance
+#
+# This is the main compliance evaluation function.
+#
+# Arguments:
+#
+# configuration_item - the configuration item obtained from the AWS Config event
+# classifier - network_classifier.NetworkClassifier of the rule
+# rule_parameters - the raw rule parameters
+# debug_enabled - debug flag
+#
+# return values:
+#
+# compliance_type -
+#
+#     NOT_APPLICABLE - (1) no rule is registered for the resource type
+#                      (2) the configuration item is being deleted
+#                      (3) none of the rules applies
+#     NON_COMPLIANT  - at least one rule failed
+#     COMPLIANT      - no rule failed
+#
+# annotation         - the annotation message for AWS Config
+def evaluate_compliance(configuration_item, classifier, rule_parameters, debug_enabled):
+    rule_names = selected_rules(configuration_item["resourceType"], rule_parameters)
+    if not rule_names:
+        return {
+            "compliance_type" : "NOT_APPLICABLE",
+            "annotation" : "The rule doesn't apply to resources of type " +
+            configuration_item["resourceType"] + "."
+        }
+
+    if configuration_item["configurationItemStatus"] == "ResourceDeleted":
+        return {
+            "compliance_type": "NOT_APPLICABLE",
+            "annotation": "The configurationItem was deleted and therefore cannot be validated."
+        }
+
+    print ("Evaluating " + configuration_item["resourceId"] + " against: ", rule_names)
+    return combine_evaluations(evaluate_rules(configuration_item, classifier, rule_names, debug_enabled))
+
+def lambda_handler(event, context):
+    check_defined(event, 'event')
+    invoking_event = json.loads(event['invokingEvent'])
+
+    check_defined(invoking_event, 'invokingEvent')
+    configuration_item = config_event_batch.configuration_item_of(invoking_event)
+
+    rule_parameters = json.loads(event.get("ruleParameters") or "{}")
+    classifier = network_classifier.get_classifier(rule_parameters)
+    debug_enabled = str(rule_parameters.get("debug", "")).lower() == "true"
+
+    if debug_enabled:
+        print("Received event: " + json.dumps(event, indent=2))
+
+    evaluation = evaluate_compliance(configuration_item, classifier, rule_parameters, debug_enabled)
+
+    print ("Evaluation Result:", evaluation)
+    resource_context.publish_cache_metrics("ConfigRules/RuleDispatcher")
+
+    config = boto3.client('config')
+
+    response = config.put_evaluations(
+       Evaluations=[
+           {
+               'ComplianceResourceType': configuration_item['resourceType'],
+               'ComplianceResourceId': configuration_item['resourceId'],
+               'ComplianceType': evaluation["compliance_type"],
+               "Annotation": evaluation["annotation"],
+               'OrderingTimestamp': configuration_item['configurationItemCaptureTime']
+           },
+       ],
+       ResultToken=event['resultToken'])
+
+def evaluate_event(configuration_item, rule_parameters):
+    classifier = network_classifier.get_classifier(rule_parameters)
+    debug_enabled = str(rule_parameters.get("debug", "")).lower() == "true"
+    return evaluate_compliance(configuration_item, classifier, rule_parameters, debug_enabled)
+
+sqs_handler = config_event_batch.sqs_handler(
+    evaluate_event, lambda_handler, lambda: resource_context.publish_cache_metrics("ConfigRules/RuleDispatcher"))
@@ -0,0 +1,225 @@
+import boto3
+import botocore
+import json
+import resource_context
+
+# SQS batch entry point shared by the config rule handlers.
+#
+# Mass changes (e.g. a Terraform apply touching thousands of security groups)
+# produce one Config rule invocation per resource. When the rule events are
+# forwarded to an SQS queue instead, a handler's sqs_handler receives them in
+# batches: events for the same resource are collapsed to the latest
+# configuration item, the remaining ones are evaluated together and the
+# results are submitted per resultToken with up to PUT_EVALUATIONS_BATCH_SIZE
+# evaluations per put_evaluations call.
+#
+# Each message body is the event Config passes to a custom rule Lambda
+# (invokingEvent, ruleParameters, resultToken, ...). The event source mapping
+# must enable ReportBatchItemFailures: only the messages listed in
+# batchItemFailures go back to the queue. These are the messages that can
+# succeed on a retry (Config API errors); a message that cannot be evaluated
+# at all (no recorded configuration item, an evaluation error other than a
+# ClientError) is logged and acknowledged instead of ending up in the DLQ.
+#
+# Oversized change notifications only carry a configurationItemSummary; the
+# full item is read from the Config history before evaluate is called, so the
+# handlers always get an item with its configuration.
+#
+# A handler exposes the entry point with
+#
+#   sqs_handler = config_event_batch.sqs_handler(evaluate, lambda_handler)
+#
+# where evaluate adapts the handler's evaluate_compliance to one configuration
+# item and the raw rule parameters.
+#
+# put_evaluations_in_chunks is also used by the handlers that submit many
+# evaluations for one event (periodic sweeps).
+
+# Maximum number of evaluations accepted by a single put_evaluations call
+PUT_EVALUATIONS_BATCH_SIZE = 100
+
+# configuration_item_of
+#
+# The configuration item (or its summary for oversized notifications) of an
+# invoking event, None for events that are not about one resource such as
+# ScheduledNotification. The summary has the same resource fields but no
+# configuration: see full_configuration_item, and the contexts of
+# resource_context.py that fetch what is missing.
+def configuration_item_of(invoking_event):
+    if invoking_event["messageType"] == "OversizedConfigurationItemChangeNotification":
+        return invoking_event["configurationItemSummary"]
+    return invoking_event.get("configurationItem")
+
+# latest_events
+#
+# Parse the SQS records and keep, per rule and resource, the event with the
+# latest configurationItemCaptureTime. Older events of the same rule and
+# resource are acknowledged without evaluation.
+#
+# return values:
+#
+# latest - (rule name, resource type, resource id) -> (message id, rule event, configuration item)
+# other_events - (message id, rule event) for events without a configuration item
+# failed - message ids of unreadable messages
+def latest_events(records):
+    latest = {}
+    other_events = []
+    failed = []
+    superseded = 0
+
+    for record in records:
+        try:
+            rule_event = json.loads(record["body"])
+            configuration_item = configuration_item_of(json.loads(rule_event["invokingEvent"]))
+        except (KeyError, ValueError) as e:
+            print("Unreadable message " + record["messageId"] + ": ", e)
+            failed.append(record["messageId"])
+            continue
+
+        if configuration_item is None:
+            other_events.append((record["messageId"], rule_event))
+            continue
+
+        key = (rule_event.get("configRuleName"), configuration_item["resourceType"], configuration_item["resourceId"])
+        current = latest.get(key)
+        if current is not None:
+            superseded += 1
+            if current[2]["configurationItemCaptureTime"] >= configuration_item["configurationItemCaptureTime"]:
+                continue
+        latest[key] = (record["messageId"], rule_event, configuration_item)
+
+    print("Batch of " + str(len(records)) + " messages: " + str(len(latest)) + " resources, " +
+          str(superseded) + " superseded events, " + str(len(other_events)) + " other events")
+    return latest, other_events, failed
+
+# put_evaluations_in_chunks
+#
+# Submit the evaluations of one resultToken, PUT_EVALUATIONS_BATCH_SIZE per
+# put_evaluations call.
+#
+# return values:
+#
+# the FailedEvaluations reported by Config, empty if every evaluation was
+# accepted
+def put_evaluations_in_chunks(config, evaluations, result_token):
+    failed = []
+    for i in range(0, len(evaluations), PUT_EVALUATIONS_BATCH_SIZE):
+        chunk = evaluations[i:i + PUT_EVALUATIONS_BATCH_SIZE]
+        response = config.put_evaluations(Evaluations=chunk, ResultToken=result_token)
+        if response.get("FailedEvaluations"):
+            print("Failed evaluations: ", response["FailedEvaluations"])
+            failed.extend(response["FailedEvaluations"])
+    return failed
+
+# put_evaluations_by_token
+#
+# Submit the evaluations grouped by resultToken, one chunk of
+# PUT_EVALUATIONS_BATCH_SIZE at a time so a failed call only fails its chunk.
+#
+# Arguments:
+#
+# pending - resultToken -> list of (message id, evaluation)
+#
+# return values:
+#
+# the message ids whose evaluation was not accepted
+def put_evaluations_by_token(config, pending):
+    failed = []
+    for result_token, items in pending.items():
+        for i in range(0, len(items), PUT_EVALUATIONS_BATCH_SIZE):
+            chunk = items[i:i + PUT_EVALUATIONS_BATCH_SIZE]
+            try:
+                rejected_evaluations = put_evaluations_in_chunks(
+                    config, [evaluation for message_id, evaluation in chunk], result_token)
+            except botocore.exceptions.ClientError as e:
+                print("put_evaluations failure: ", e)
+                failed.extend(message_id for message_id, evaluation in chunk)
+                continue
+
+            rejected = set((evaluation["ComplianceResourceType"], evaluation["ComplianceResourceId"])
+                           for evaluation in rejected_evaluations)
+            failed.extend(message_id for message_id, evaluation in chunk
+                          if (evaluation["ComplianceResourceType"], evaluation["ComplianceResourceId"]) in rejected)
+    return failed
+
+# full_configuration_item
+#
+# The configuration item itself, or for the summary of an oversized
+# notification the latest item recorded by Config.
+#
+# Raises ValueError if Config has no recorded item for the resource
+def full_configuration_item(config, configuration_item):
+    if "configuration" in configuration_item:
+        return configuration_item
+    recorded = resource_context.get_recorded_configuration_item(
+        config, configuration_item["resourceType"], configuration_item["resourceId"])
+    if recorded is None:
+        raise ValueError("no recorded configuration item")
+    return recorded
+
+# handle_sqs_batch
+#
+# Arguments:
+#
+# event - the SQS event
+# evaluate - function(configuration item, raw rule parameters) returning the
+#            handler's compliance_type / annotation dict
+# handle_event - optional function(rule event, context) for events without a
+#                configuration item, usually the handler's lambda_handler
+#
+# return values:
+#
+# the partial batch response: the message ids to retry in batchItemFailures
+def handle_sqs_batch(event, evaluate, handle_event=None):
+    latest, other_events, failed = latest_events(event["Records"])
+
+    config = boto3.client("config")
+    pending = {}
+    for message_id, rule_event, configuration_item in latest.values():
+        try:
+            evaluation = evaluate(full_configuration_item(config, configuration_item),
+                                  json.loads(rule_event.get("ruleParameters") or "{}"))
+        except botocore.exceptions.ClientError as e:
+            print("Evaluation failure on " + configuration_item["resourceId"] + ": ", e)
+            failed.append(message_id)
+            continue
+        except Exception as e:
+            print("Cannot evaluate " + configuration_item["resourceId"] + ", dropping message " + message_id + ": ", e)
+            continue
+        pending.setdefault(rule_event["resultToken"], []).append((message_id, {
+            'ComplianceResourceType': configuration_item['resourceType'],
+            'ComplianceResourceId': configuration_item['resourceId'],
+            'ComplianceType': evaluation["compliance_type"],
+            "Annotation": evaluation["annotation"],
+            'OrderingTimestamp': configuration_item['configurationItemCaptureTime']
+        }))
+
+    if pending:
+        failed.extend(put_evaluations_by_token(config, pending))
+
+    for message_id, rule_event in other_events:
+        if handle_event is None:
+            print("No handler for message " + message_id + ", dropping it")
+            continue
+        try:
+            handle_event(rule_event, None)
+        except Exception as e:
+            print("Failure handling message " + message_id + ": ", e)
+            failed.append(message_id)
+
+    if failed:
+        print("Returning " + str(len(failed)) + " messages to the queue")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
+
+# sqs_handler
+#
+# The Lambda entry point of a handler's SQS event source: handle_sqs_batch with
+# the handler's functions, then after_batch (e.g. publishing cache metrics) if
+# given.
+def sqs_handler(evaluate, handle_event=None, after_batch=None):
+    def handler(event, context):
+        response = handle_sqs_batch(event, evaluate, handle_event)
+        if after_batch is not None:
+            after_batch()
+        return response
+    return handler
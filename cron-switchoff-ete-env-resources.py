@@ -1,29 +1,43 @@
 import boto3
+import resource_scheduler
 
-ec2 = boto3.resource('ec2')
+ec2 = boto3.client('ec2')
 
-def lambda_handler(event, context):
+STOP_TAG = 'StopAtNonWorkingHours'
+
+def plan_switchoff():
   filters = [
-    {
-      'Name': 'tag:StopAtNonWorkingHours',
-      'Values': ['true'],
-    },
     {
       'Name': 'instance-state-name',
-      'Values': ['running']
+      'Values': ['pending', 'running', 'stopping', 'stopped']
     }
   ]
   
-  instances = ec2.instances.filter(Filters=filters)
-  
-  RunningInstances = [instance.id for instance in instances]
+  instances = resource_scheduler.ec2_inventory(ec2, filters)
+  plan = resource_scheduler.build_plan('stop', STOP_TAG, instances, [], ec2.meta.region_name)
 
   # For debug purpose
-  print(RunningInstances)
-  
-  if len(RunningInstances) > 0:
-    shuttingDown = ec2.instances.filter(InstanceIds=RunningInstances).stop()
+  print([ entry['id'] for entry in plan['stop'] ])
+  return plan
+
+def lambda_handler(event, context):
+  # Same modes as cronjob-stop-resources-non-working-hours.py:
+  # {"mode": "plan" | "execute", "plan_location": ...}, default plan and execute
+  event = event or {}
+  mode = event.get('mode', 'run')
+  if mode == 'execute':
+    plan = resource_scheduler.load_plan(event['plan_location'])
+  else:
+    plan = plan_switchoff()
+    if mode == 'plan':
+      if event.get('plan_location'):
+        resource_scheduler.save_plan(plan, event['plan_location'])
+      return plan
+
+  if len(plan['stop']) > 0:
+    shuttingDown = resource_scheduler.execute_plan(ec2, None, plan, 'stop', STOP_TAG)['stop']['ec2']
     print(shuttingDown)
-    # print(RunningInstances)
+    return shuttingDown
   else:
-    print("WARNING: no instances in the specified env is running")
\ No newline at end of file
+    print("WARNING: no instances in the specified env is running")
+    return []
@@ -0,0 +1,117 @@
+import math
+import os
+import time
+import resource_scheduler
+import scheduler_targets
+
+# Working-hours scheduler for every account and region of the fleet, in place
+# of one copy of the cronjob scripts per account. See scheduler_targets.py for
+# the account x region matrix and the cross-account role.
+#
+# Event (all optional):
+#
+#   {"action": "start" | "stop", "accounts": [...], "regions": [...]}
+#
+# action defaults to the SCHEDULER_ACTION environment variable, the matrix to
+# SCHEDULER_TARGETS.
+#
+# Only TARGET_MAX_WORKERS targets run at a time, so a start run splits the
+# time left into one budget per round of targets: each target runs its waves
+# against its own deadline (at least WAVE_MIN_REMAINING_SECONDS, so its first
+# wave starts) instead of the first round using up the whole run. Targets with
+# waves left unstarted or with errors make the run "incomplete".
+
+START_TAG = 'StartAtWorkingHours'
+STOP_TAG = 'StopAtNonWorkingHours'
+
+# --
+# Discovery
+# --
+
+def find_to_be_started(ec2, rds):
+  filters = [
+    {
+      'Name': 'instance-state-name',
+      'Values': ['stopped'],
+    },
+    {
+      'Name': 'tag:' + START_TAG,
+      'Values': ['true'],
+    },
+  ]
+  return (
+    resource_scheduler.ec2_inventory(ec2, filters),
+    resource_scheduler.rds_select(resource_scheduler.rds_inventory(rds), 'stopped', START_TAG),
+  )
+
+def find_to_be_stopped(ec2, rds):
+  filters = [
+    {
+      'Name': 'instance-state-name',
+      'Values': ['running'],
+    },
+    {
+      'Name': 'tag:' + STOP_TAG,
+      'Values': ['true'],
+    },
+  ]
+  return (
+    resource_scheduler.ec2_inventory(ec2, filters),
+    resource_scheduler.rds_select(resource_scheduler.rds_inventory(rds), 'available', STOP_TAG),
+  )
+
+# --
+# Actions
+# --
+
+def start_target(target, ec2, rds, deadline=None):
+  ec2_instances, rds_resources = find_to_be_started(ec2, rds)
+  print(f'[INFO] {target["account"]}/{target["region"]}: starting {len(ec2_instances)} EC2 instances, {len(rds_resources)} RDS instances and clusters')
+  return resource_scheduler.start_waves(ec2, rds, ec2_instances, rds_resources, deadline)
+
+def target_starter(deadline, target_count):
+  '''
+  work function for run_targets: start_target against a deadline of its own,
+  the time left divided by the number of rounds of TARGET_MAX_WORKERS targets.
+  '''
+  if deadline is None:
+    return lambda target, ec2, rds: start_target(target, ec2, rds)
+  rounds = math.ceil(target_count / scheduler_targets.TARGET_MAX_WORKERS)
+  budget = max(resource_scheduler.WAVE_MIN_REMAINING_SECONDS, (deadline - time.time()) / max(1, rounds))
+  return lambda target, ec2, rds: start_target(target, ec2, rds, min(deadline, time.time() + budget))
+
+def stop_target(target, ec2, rds):
+  ec2_instances, rds_resources = find_to_be_stopped(ec2, rds)
+  print(f'[INFO] {target["account"]}/{target["region"]}: stopping {len(ec2_instances)} EC2 instances, {len(rds_resources)} RDS instances and clusters')
+  return {
+    'ec2': resource_scheduler.ec2_act(ec2, 'stop', [ instance['id'] for instance in ec2_instances ]),
+    'rds': resource_scheduler.rds_act(rds, 'stop', rds_resources),
+  }
+
+# --
+# Lambda
+# --
+
+def lambda_handler(event, context):
+  action = (event or {}).get('action') or os.environ.get('SCHEDULER_ACTION')
+  if action not in [ 'start', 'stop' ]:
+    raise Exception(f'[ERROR] Unknown action {action!r}, expected start or stop')
+
+  targets = scheduler_targets.load_targets(event)
+  print(f'[INFO] {action} on {len(targets)} targets')
+  if action == 'start':
+    deadline = resource_scheduler.run_deadline(context)
+    results = scheduler_targets.run_targets(targets, target_starter(deadline, len(targets)))
+  else:
+    results = scheduler_targets.run_targets(targets, stop_target)
+  failed = [ result for result in results if 'error' in result ]
+  if failed:
+    print(f'[WARN] {len(failed)} of {len(targets)} targets failed')
+  unstarted = [ result for result in results if result.get('result', {}).get('unstarted') ]
+  if unstarted:
+    print(f'[ERROR] {len(unstarted)} of {len(targets)} targets have waves left for the next run')
+  return {
+    'action': action,
+    'status': 'incomplete' if failed or unstarted else 'complete',
+    'targets': results,
+  }
@@ -0,0 +1,95 @@
+import datetime
+import resource_scheduler
+import schedule_expressions
+import scheduler_targets
+
+# Tag driven scheduler: triggered frequently (e.g. every 10 minutes), it
+# computes the desired state of every EC2 instance and RDS instance / Aurora
+# cluster with a Schedule tag (see schedule_expressions.py) and only starts or
+# stops the resources whose actual state differs. Replaces the fixed-time
+# start/stop Lambdas with hard-coded instance lists.
+#
+# Event (all optional): the EventBridge scheduled event, whose "time" is the
+# time evaluated, plus "accounts" / "regions" (see scheduler_targets.py).
+
+# --
+# Diff
+# --
+
+# Resource states that correspond to on / off. Resources in any other state
+# (pending, stopping, modifying, ...) are left alone until the next run.
+EC2_STATES = {'on': 'running', 'off': 'stopped'}
+RDS_STATES = {'on': 'available', 'off': 'stopped'}
+
+def diff(resources, desired, state_key, states):
+  '''
+  Returns:
+  tuple: (resources to start, resources to stop)
+  '''
+  to_start = []
+  to_stop = []
+  for resource in resources:
+    on = desired.get(resource['id'])
+    if on is True and resource[state_key] == states['off']:
+      to_start.append(resource)
+    elif on is False and resource[state_key] == states['on']:
+      to_stop.append(resource)
+  return to_start, to_stop
+
+# --
+# Reconcile
+# --
+
+def reconcile_target(target, ec2, rds, now, holidays):
+  filters = [
+    {
+      'Name': 'tag-key',
+      'Values': [schedule_expressions.SCHEDULE_TAG],
+    },
+    {
+      'Name': 'instance-state-name',
+      'Values': ['running', 'stopped'],
+    },
+  ]
+  instances = resource_scheduler.ec2_inventory(ec2, filters)
+  rds_resources = [
+    resource for resource in resource_scheduler.rds_inventory(rds)
+    if schedule_expressions.SCHEDULE_TAG in resource['tags']
+  ]
+
+  ec2_start, ec2_stop = diff(instances,
+                             schedule_expressions.ScheduleIndex(instances).desired_states(now, holidays),
+                             'state', EC2_STATES)
+  rds_start, rds_stop = diff(rds_resources,
+                             schedule_expressions.ScheduleIndex(rds_resources).desired_states(now, holidays),
+                             'status', RDS_STATES)
+  print(f'[INFO] {target["account"]}/{target["region"]}: {len(instances)} EC2 instances and {len(rds_resources)} RDS resources scheduled, '
+        f'starting {len(ec2_start) + len(rds_start)}, stopping {len(ec2_stop) + len(rds_stop)}')
+
+  return {
+    'started': {
+      'ec2': resource_scheduler.ec2_act(ec2, 'start', [ instance['id'] for instance in ec2_start ]),
+      'rds': resource_scheduler.rds_act(rds, 'start', rds_start),
+    },
+    'stopped': {
+      'ec2': resource_scheduler.ec2_act(ec2, 'stop', [ instance['id'] for instance in ec2_stop ]),
+      'rds': resource_scheduler.rds_act(rds, 'stop', rds_stop),
+    },
+  }
+
+# --
+# Lambda
+# --
+
+def lambda_handler(event, context):
+  event = event or {}
+  if event.get('time'):
+    now = datetime.datetime.fromisoformat(event['time'].replace('Z', '+00:00'))
+  else:
+    now = datetime.datetime.now(datetime.timezone.utc)
+  holidays = schedule_expressions.load_holidays()
+
+  targets = scheduler_targets.load_targets(event)
+  print(f'[INFO] Reconciling {len(targets)} targets at {now.isoformat()}')
+  results = scheduler_targets.run_targets(targets, lambda target, ec2, rds: reconcile_target(target, ec2, rds, now, holidays))
+  return {'time': now.isoformat(), 'targets': results}
@@ -1,71 +1,56 @@
 import boto3
+import resource_scheduler
 
-ec2 = boto3.resource('ec2')
-rds = boto3.client('rds')
+ec2 = boto3.client('ec2')
+rds = boto3.client('rds', config=resource_scheduler.RDS_CLIENT_CONFIG)
 
-# --
-# EC2
-# --
-
-def ec2_find_to_be_stopped_instances():
-  filters = [
-    {
-      'Name': 'instance-state-name',
-      'Values': ['running'],
-    },
-    {
-      'Name': 'tag:StopAtNonWorkingHours',
-      'Values': ['true'],
-    },
-  ]
-  instances = ec2.instances.filter(Filters=filters)
-  print(f'[DEBUG] EC2 instances to be stopped: {[ instance.id for instance in instances ]}')
-  return instances
+STOP_TAG = 'StopAtNonWorkingHours'
 
-def ec2_stop_instances():
-  print('[INFO] Preparing to stop the EC2 instances...')
-  instances = ec2_find_to_be_stopped_instances()
-  if len(list(instances)) > 0:
-    print(f'[INFO] Stopping {len(list(instances))} EC2 instances...')
-    instances.stop()
-  else:
-    print('[WARN] No EC2 instances to stop')
+# Every instance that can still be stopped, tagged or not, so the plan also
+# explains what is left alone
+EC2_FILTERS = [
+  {
+    'Name': 'instance-state-name',
+    'Values': ['pending', 'running', 'stopping', 'stopped'],
+  },
+]
 
 # --
-# RDS
+# Plan
 # --
 
-def rds_filter_to_be_stopped_instances_by_tag(instance):
-  tags = rds.list_tags_for_resource(ResourceName=instance['DBInstanceArn'])['TagList']
-  for tag in tags:
-    if tag['Key'] == 'StopAtNonWorkingHours' and tag['Value'] in [ 'true' ]:
-      return True
-  return False
-
-def rds_find_to_be_stopped_instances():
-  instances = rds.describe_db_instances()['DBInstances']
-  instances = [
-    instance for instance in instances
-    if instance['DBInstanceStatus'] == 'available'
-        and rds_filter_to_be_stopped_instances_by_tag(instance)
-  ]
-  print(f'[DEBUG] RDS instances to be stopped: {[ instance["DBInstanceIdentifier"] for instance in instances ]}')
-  return instances
-
-def rds_stop_instances():
-  print('[INFO] Preparing to stop the RDS instances...')
-  instances = rds_find_to_be_stopped_instances()
-  if len(instances) > 0:
-    print(f'[INFO] Stopping {len(instances)} RDS instances...')
-    for instance in instances:
-      rds.stop_db_instance(DBInstanceIdentifier=instance['DBInstanceIdentifier'])
-  else:
-    print('[WARN] No RDS instances to stop')
+def plan_stop():
+  print('[INFO] Describing the EC2 and RDS resources...')
+  plan = resource_scheduler.build_plan(
+    'stop',
+    STOP_TAG,
+    resource_scheduler.ec2_inventory(ec2, EC2_FILTERS),
+    resource_scheduler.rds_inventory(rds),
+    ec2.meta.region_name)
+  print(f'[DEBUG] Resources to be stopped: {[ entry["id"] for entry in plan["stop"] ]}')
+  return plan
 
 # --
 # Lambda
 # --
 
 def lambda_handler(event, context):
-  ec2_stop_instances()
-  rds_stop_instances()
+  # Event (optional):
+  #   {"mode": "plan", "plan_location": <path or s3://bucket/key>}
+  #       only build the plan, return it and save it if a location is given
+  #   {"mode": "execute", "plan_location": ...}
+  #       execute a saved plan without describing the resources again
+  # Without a mode the plan is built and executed in the same run.
+  event = event or {}
+  mode = event.get('mode', 'run')
+  if mode == 'execute':
+    plan = resource_scheduler.load_plan(event['plan_location'])
+    return resource_scheduler.execute_plan(ec2, rds, plan, 'stop', STOP_TAG)['stop']
+
+  plan = plan_stop()
+  if mode == 'plan':
+    if event.get('plan_location'):
+      resource_scheduler.save_plan(plan, event['plan_location'])
+    return plan
+  # The ids acted on, e.g. for the invocation result of a Step Functions task
+  return resource_scheduler.execute_plan(ec2, rds, plan)['stop']
@@ -1,6 +1,8 @@
 import boto3
 import botocore
+import config_event_batch
 import json
+import network_classifier
 
 APPLICABLE_RESOURCES = ["AWS::EC2::Instance"]
 
@@ -18,11 +20,28 @@ ALLOWED_PERMISSIONS = [
     "ToPort" : 443,
 }]
 
-def isProductionSubnet(ip):
-    parts = ip.split(".")
-    if parts[0] == "172" and parts[1] == "31" and int(parts[2]) >= 192 and int(parts[2]) <= 255:
-        return True 
-    return False
+# Encryption state by volume id. The flag cannot change for an existing volume,
+# so entries stay valid for the lifetime of a warm container.
+VOLUME_ENCRYPTION_CACHE = {}
+
+# get_volume_encryption
+#
+# Resolve the Encrypted flag of the given volumes. Volumes not yet in
+# VOLUME_ENCRYPTION_CACHE are looked up with a single paginated
+# describe_volumes call instead of one call per volume.
+#
+# return values:
+#
+# a dict volume id -> Encrypted
+def get_volume_encryption(volume_ids):
+    missing = [v for v in volume_ids if v not in VOLUME_ENCRYPTION_CACHE]
+    if len(missing) > 0:
+        paginator = ec2.get_paginator("describe_volumes")
+        for page in paginator.paginate(VolumeIds=missing):
+            for volume in page["Volumes"]:
+                VOLUME_ENCRYPTION_CACHE[volume["VolumeId"]] = volume["Encrypted"]
+    print ("Volumes resolved from cache: ", len(volume_ids) - len(missing), "/", len(volume_ids))
+    return {v: VOLUME_ENCRYPTION_CACHE[v] for v in volume_ids}
 
 # Helper function used to validate input
 def check_defined(reference, reference_name):
@@ -35,7 +54,7 @@ def check_defined(reference, reference_name):
 # Normalize all rule parameters so we can handle them consistently.
 # All keys are stored in lower case.  Only boolean and numeric keys are stored.
 def normalize_parameters(rule_parameters):
-    for key, value in rule_parameters.items():
+    for key, value in list(rule_parameters.items()):
         normalized_key=key.lower()
         normalized_value=value.lower()
 
@@ -70,7 +89,9 @@ def normalize_parameters(rule_parameters):
 #                      them
 #
 # annotation         - the annotation message for AWS Config
-def evaluate_compliance(configuration_item, debug_enabled):
+def evaluate_compliance(configuration_item, debug_enabled, classifier=None):
+    classifier = classifier or network_classifier.get_classifier()
+
     print("resourceType:", configuration_item["resourceType"])
     if configuration_item["resourceType"] not in APPLICABLE_RESOURCES:
         print("not applicable")
@@ -90,9 +111,9 @@ def evaluate_compliance(configuration_item, debug_enabled):
     instance_id = configuration_item["configuration"]["instanceId"]
     print ("Evaluating EC2: ", instance_id)
     print ("Details: ", configuration_item)
-    ip = configuration_item["configuration"]["networkInterfaces"][0]["privateIpAddresses"][0]["privateIpAddress"]
-    print ("IP from CI:" , ip)
-    if not isProductionSubnet(ip):
+    addresses = network_classifier.instance_addresses(configuration_item["configuration"])
+    print ("IPs from CI:" , addresses)
+    if not classifier.any_production(addresses):
         return {
             "compliance_type": "NOT_APPLICABLE",
             "annotation": "The instance is not in production subnet."
@@ -100,23 +121,23 @@ def evaluate_compliance(configuration_item, debug_enabled):
 
 
     try:
-#        response = client.describe_instances(InstanceIds=[instance_id])
-        unencrypted_list = []
         blockdevices = configuration_item["configuration"]["blockDeviceMappings"]
         rootdevice = configuration_item["configuration"]["rootDeviceName"]
         print ("RootDevice Name: ", rootdevice)
+        volume_ids = []
         for bd in blockdevices:
+            if "ebs" not in bd:
+                continue
             volume_id = bd["ebs"]["volumeId"]
             device_name = bd["deviceName"]
             print ("Block Device: ", volume_id)
             print ("Block Device Volume ID:", device_name)
             if not device_name == rootdevice:
                 # only check on data disk
-                response2 = ec2.describe_volumes(VolumeIds=[volume_id])
-                is_encrypted = response2["Volumes"][0]["Encrypted"]
-                print ("Encrypted? ", is_encrypted)
-                if not is_encrypted:
-                    unencrypted_list.append(volume_id)
+                volume_ids.append(volume_id)
+
+        encryption_state = get_volume_encryption(volume_ids)
+        unencrypted_list = [v for v in volume_ids if not encryption_state[v]]
         if len(unencrypted_list) > 0:
             v_str = ""
             for v in unencrypted_list:
@@ -150,7 +171,9 @@ def lambda_handler(event, context):
     check_defined(invoking_event, 'invokingEvent')
     configuration_item = invoking_event["configurationItem"]
 
-    rule_parameters = normalize_parameters(json.loads(event["ruleParameters"]))
+    raw_parameters = json.loads(event["ruleParameters"])
+    classifier = network_classifier.get_classifier(raw_parameters)
+    rule_parameters = normalize_parameters(dict(raw_parameters))
 
     debug_enabled = False
 
@@ -160,7 +183,7 @@ def lambda_handler(event, context):
     if debug_enabled:
         print("Received event: " + json.dumps(event, indent=2))
 
-    evaluation = evaluate_compliance(configuration_item, debug_enabled)
+    evaluation = evaluate_compliance(configuration_item, debug_enabled, classifier)
     print("Eva:", evaluation)
 
     config = boto3.client('config')
@@ -177,3 +200,9 @@ def lambda_handler(event, context):
        ],
        ResultToken=event['resultToken'])
 
+def evaluate_event(configuration_item, rule_parameters):
+    classifier = network_classifier.get_classifier(rule_parameters)
+    debug_enabled = normalize_parameters(dict(rule_parameters)).get("debug", False)
+    return evaluate_compliance(configuration_item, debug_enabled, classifier)
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_event, lambda_handler)
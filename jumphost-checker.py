@@ -1,6 +1,9 @@
 import boto3
 import botocore
+import config_event_batch
 import json
+import resource_context
+import sg_policy
 
 APPLICABLE_RESOURCES = ["AWS::EC2::SecurityGroup"]
 
@@ -16,6 +19,8 @@ UNALLOWED_PERMISSIONS = [
     "ToPort" : 22,
 }]
 
+UNALLOWED_INDEX = sg_policy.PortRangeIndex(UNALLOWED_PERMISSIONS)
+
 # Helper function used to validate input
 def check_defined(reference, reference_name):
     if not reference:
@@ -27,7 +32,7 @@ def check_defined(reference, reference_name):
 # Normalize all rule parameters so we can handle them consistently.
 # All keys are stored in lower case.  Only boolean and numeric keys are stored.
 def normalize_parameters(rule_parameters):
-    for key, value in rule_parameters.items():
+    for key, value in list(rule_parameters.items()):
         normalized_key=key.lower()
         normalized_value=value.lower()
 
@@ -76,44 +81,43 @@ def evaluate_compliance(configuration_item, debug_enabled):
             "annotation": "The configurationItem was deleted and therefore cannot be validated."
         }
 
-    group_id = configuration_item["configuration"]["groupId"]
-    client = boto3.client("ec2");
+    group_id = configuration_item["resourceId"]
 
-    print ("evaluating CI: ", configuration_item)
     print ("Evaluating security group: ", group_id)
 
+    return evaluate_context(resource_context.SecurityGroupContext(configuration_item), debug_enabled)
+
+# evaluate_context
+#
+# Check an applicable, existing security group for public SSH / RDP access,
+# using the ingress rules held by the (possibly shared) context.
+def evaluate_context(context, debug_enabled=False):
     try:
-        response = client.describe_security_groups(GroupIds=[group_id])
+        ip_permissions = context.ip_permissions()
     except botocore.exceptions.ClientError as e:
         print("e:", e)
         return {
             "compliance_type" : "NON_COMPLIANT",
-            "annotation" : "describe_security_groups failure on group " + group_id
+            "annotation" : "describe_security_groups failure on group " + context.group_id
         }
-    print ("Security Group Details: ", response)
 
     if debug_enabled:
-        print("security group definition: ", json.dumps(response, indent=2))
-
-    ip_permissions = response["SecurityGroups"][0]["IpPermissions"]
-    
-    for item in ip_permissions:
-        if len(item["IpRanges"]) > 0:
-            for x in item["IpRanges"]:
-                ip_ranges = x["CidrIp"]
-                print("ip_ranges: ", ip_ranges)
-                if ip_ranges == "0.0.0.0/0" and not item["IpProtocol"] == "icmp":
-                    print("source ip is any:", group_id)
-                    try:
-                        source = {"IpProtocol" : item["IpProtocol"], "FromPort" : item["FromPort"], "ToPort" : item["ToPort"]}
-                        print("source detail:", source)
-                        if source in UNALLOWED_PERMISSIONS:
-                            return {
-                                "compliance_type" : "NON_COMPLIANT",
-                                "annotation" : "security_groups_check failure on group " + group_id
-                            }
-                    except botocore.exceptions.ClientError as e:
-                        print("e:", e)
+        print("security group ingress rules: ", json.dumps(ip_permissions, indent=2))
+
+    return evaluate_ip_permissions(context.group_id, ip_permissions)
+
+# evaluate_ip_permissions
+#
+# Fail the group if any ingress rule reachable from a public CIDR (IPv4 or
+# IPv6) overlaps UNALLOWED_PERMISSIONS, including wide ranges such as 0-65535.
+def evaluate_ip_permissions(group_id, ip_permissions):
+    violation = sg_policy.find_public_violations([(group_id, ip_permissions)], forbidden=UNALLOWED_INDEX)[group_id]
+    if violation is not None:
+        print("source detail:", violation)
+        return {
+            "compliance_type" : "NON_COMPLIANT",
+            "annotation" : "security_groups_check failure on group " + group_id
+        }
 
     return {
         "compliance_type": "COMPLIANT",
@@ -125,7 +129,7 @@ def lambda_handler(event, context):
     invoking_event = json.loads(event['invokingEvent'])
 
     check_defined(invoking_event, 'invokingEvent')
-    configuration_item = invoking_event["configurationItem"]
+    configuration_item = config_event_batch.configuration_item_of(invoking_event)
 
     rule_parameters = normalize_parameters(json.loads(event["ruleParameters"]))
 
@@ -144,11 +148,17 @@ def lambda_handler(event, context):
     response = config.put_evaluations(
        Evaluations=[
            {
-               'ComplianceResourceType': invoking_event['configurationItem']['resourceType'],
-               'ComplianceResourceId': invoking_event['configurationItem']['resourceId'],
+               'ComplianceResourceType': configuration_item['resourceType'],
+               'ComplianceResourceId': configuration_item['resourceId'],
                'ComplianceType': evaluation["compliance_type"],
                "Annotation": evaluation["annotation"],
-               'OrderingTimestamp': invoking_event['configurationItem']['configurationItemCaptureTime']
+               'OrderingTimestamp': configuration_item['configurationItemCaptureTime']
            },
        ],
        ResultToken=event['resultToken'])
+
+def evaluate_event(configuration_item, rule_parameters):
+    debug_enabled = normalize_parameters(dict(rule_parameters)).get("debug", False)
+    return evaluate_compliance(configuration_item, debug_enabled)
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_event, lambda_handler)
@@ -0,0 +1,151 @@
+import bisect
+import ipaddress
+
+# Shared network classification for the config rules that only apply to
+# production resources (instance-volume-checker.py, rds-checker.py,
+# rds-encryption-checker.py).
+#
+# The production / non-production CIDRs (IPv4 and IPv6) are read from the rule
+# parameters and compiled once per container into a sorted list of disjoint
+# address intervals per IP version.  CIDRs are either nested or disjoint, so
+# the most specific CIDR wins: a non-production block inside a production
+# range is carved out of it.  Classifying an address is a single bisect.
+
+PRODUCTION = "production"
+NON_PRODUCTION = "non-production"
+
+# Used when the rule has no ProductionCidrs parameter
+DEFAULT_PRODUCTION_CIDRS = ["172.31.192.0/18"]
+
+PRODUCTION_CIDRS_PARAMETER = "ProductionCidrs"
+NON_PRODUCTION_CIDRS_PARAMETER = "NonProductionCidrs"
+
+# split_cidrs
+#
+# Rule parameters are strings; accept CIDRs separated by commas or spaces.
+def split_cidrs(value):
+    if not value:
+        return []
+    return [cidr for cidr in value.replace(",", " ").split() if cidr]
+
+# flatten_networks
+#
+# Turn nested/disjoint networks, sorted by start address and then by size
+# (largest first), into disjoint (start, end, label) segments where the most
+# specific network labels each address.
+def flatten_networks(networks):
+    segments = []
+    stack = []
+    cursor = None
+
+    def close_top():
+        nonlocal cursor
+        top_end, top_label = stack.pop()
+        if cursor <= top_end:
+            segments.append((cursor, top_end, top_label))
+            cursor = top_end + 1
+
+    for start, end, label in networks:
+        while stack and stack[-1][0] < start:
+            close_top()
+        if stack and cursor < start:
+            segments.append((cursor, start - 1, stack[-1][1]))
+        stack.append((end, label))
+        cursor = start
+    while stack:
+        close_top()
+
+    # Merge adjacent segments with the same label
+    merged = []
+    for start, end, label in segments:
+        if merged and merged[-1][2] == label and merged[-1][1] + 1 == start:
+            merged[-1] = (merged[-1][0], end, label)
+        else:
+            merged.append((start, end, label))
+    return merged
+
+class NetworkClassifier:
+    '''
+    Sorted-interval index of labelled CIDRs.
+
+    Parameters:
+    production_cidrs (list): CIDR strings of production networks
+    non_production_cidrs (list): CIDR strings carved out as non-production
+    '''
+
+    def __init__(self, production_cidrs, non_production_cidrs=()):
+        networks = {4: [], 6: []}
+        for label, cidrs in [(PRODUCTION, production_cidrs), (NON_PRODUCTION, non_production_cidrs)]:
+            for cidr in cidrs:
+                network = ipaddress.ip_network(cidr, strict=False)
+                networks[network.version].append(
+                    (int(network.network_address), int(network.broadcast_address), label))
+
+        self.index = {}
+        for version, entries in networks.items():
+            # start ascending, larger networks first so that nested ones follow
+            entries.sort(key=lambda entry: (entry[0], -entry[1]))
+            segments = flatten_networks(entries)
+            self.index[version] = (
+                [segment[0] for segment in segments],
+                [segment[1] for segment in segments],
+                [segment[2] for segment in segments],
+            )
+
+    def classify(self, address):
+        '''
+        Return PRODUCTION, NON_PRODUCTION or None for an unknown address.
+        '''
+        address = ipaddress.ip_address(address)
+        starts, ends, labels = self.index[address.version]
+        value = int(address)
+        i = bisect.bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return labels[i]
+        return None
+
+    def classify_many(self, addresses):
+        '''
+        Classify a list of addresses; returns a dict address -> label.
+        '''
+        return {address: self.classify(address) for address in addresses}
+
+    def is_production(self, address):
+        return self.classify(address) == PRODUCTION
+
+    def any_production(self, addresses):
+        return any(self.classify(address) == PRODUCTION for address in addresses)
+
+# Compiled classifiers keyed by their CIDR lists, so a warm container compiles
+# each rule's ranges only once.
+CLASSIFIER_CACHE = {}
+
+# get_classifier
+#
+# Return the compiled classifier for the given rule parameters (the raw
+# ruleParameters dict, before normalize_parameters turns strings into flags).
+def get_classifier(rule_parameters=None):
+    rule_parameters = rule_parameters or {}
+    production_cidrs = tuple(split_cidrs(rule_parameters.get(PRODUCTION_CIDRS_PARAMETER))) \
+        or tuple(DEFAULT_PRODUCTION_CIDRS)
+    non_production_cidrs = tuple(split_cidrs(rule_parameters.get(NON_PRODUCTION_CIDRS_PARAMETER)))
+
+    key = (production_cidrs, non_production_cidrs)
+    if key not in CLASSIFIER_CACHE:
+        CLASSIFIER_CACHE[key] = NetworkClassifier(production_cidrs, non_production_cidrs)
+    return CLASSIFIER_CACHE[key]
+
+# instance_addresses
+#
+# Every private IPv4 and IPv6 address of every network interface of an
+# AWS::EC2::Instance configuration item.
+def instance_addresses(configuration):
+    addresses = []
+    for interface in configuration.get("networkInterfaces", []):
+        for private_ip in interface.get("privateIpAddresses", []):
+            addresses.append(private_ip["privateIpAddress"])
+        for ipv6 in interface.get("ipv6Addresses", []):
+            addresses.append(ipv6["ipv6Address"])
+    if not addresses and configuration.get("privateIpAddress"):
+        addresses.append(configuration["privateIpAddress"])
+    return addresses
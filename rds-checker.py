@@ -1,6 +1,9 @@
 import boto3
 import botocore
+import config_event_batch
 import json
+import network_classifier
+import resource_context
 
 APPLICABLE_RESOURCES = ["AWS::RDS::DBInstance"]
 
@@ -15,12 +18,107 @@ RDS_REQUIRED_TAGS = [
 }
 ]
 
+# RDS checks
+#
+# Each check returns None when it passes, or the evaluation to report.
+# RDS_CI_CHECKS only read the configuration item and run first; the
+# evaluation stops at the first finding. The production scope is then
+# checked once, and only in scope do RDS_REMOTE_CHECKS run when the
+# configuration item checks passed.
+#
+# The scope check needs the VPC CIDR of the instance (describe_vpcs), served
+# from resource_context.METADATA_CACHE. An instance failing a configuration
+# item check is therefore evaluated without any API call only in a warm
+# container whose cache already holds its VPC.
+def check_storage_encrypted(context):
+    if not context.configuration["storageEncrypted"]:
+        return {
+            "compliance_type": "NON_COMPLIANT",
+            "annotation": "The RDS instance [" + context.instance_id + "] with un-encrypted volume(s) "
+        }
+
+def check_publicly_accessible(context):
+    if context.configuration["publiclyAccessible"]:
+        return {
+            "compliance_type": "NON_COMPLIANT",
+            "annotation": "The RDS instance [" + context.instance_id + "] is publicly accessible "
+        }
+
+def check_license_model(context):
+    license_model = context.configuration["licenseModel"]
+    print ("LicenseModel: ", license_model)
+    if license_model != "general-public-license" and license_model != "license-included" and license_model != "postgresql-license":
+        return {
+            "compliance_type": "NON_COMPLIANT",
+            "annotation": "The RDS instance [" + context.instance_id + "] is not using general public license "
+        }
+
+def check_tags(context):
+    tags = context.configuration_item["tags"]
+    if len(tags) == 0:
+        return {
+            "compliance_type": "NON_COMPLIANT",
+            "annotation": "The RDS instance [" + context.instance_id + "] is missing all/some of the standard tags"
+        }
+    for required_tag in RDS_REQUIRED_TAGS:
+        r_tag_name = required_tag["TagName"]
+        r_tag_values = required_tag["TagValues"]
+        if r_tag_name in tags:
+            tag_value = tags[r_tag_name]
+            if len(r_tag_values)>0 and tag_value not in r_tag_values:
+                return {
+                    "compliance_type": "NON_COMPLIANT",
+                    "annotation": "The RDS instance [" + context.instance_id + "] with incorrect value of tag " + r_tag_name
+                }
+        else:
+            return {
+                "compliance_type": "NON_COMPLIANT",
+                "annotation": "The RDS instance [" + context.instance_id + "] with missing tag " + r_tag_name
+            }
+
+def check_production_scope(context):
+    if not context.is_production():
+        return {
+            "compliance_type": "NOT_APPLICABLE",
+            "annotation": "The RDS instance [" + context.instance_id + "] is not in production subnet."
+        }
 
-def isProductionSubnet(ip):
-    parts = ip.split(".")
-    if parts[0] == "172" and parts[1] == "31" and int(parts[2]) >= 192 and int(parts[2]) <= 255:
-        return True 
-    return False
+def check_multi_az(context):
+    db_engine = context.configuration["engine"]
+    print ("DB Engine: ", db_engine)
+    if db_engine.startswith("aurora"):
+        # Aurora instances report MultiAZ on the cluster only
+        is_multi_az = context.db_cluster()["MultiAZ"]
+    else:
+        is_multi_az = context.configuration["multiAZ"]
+    print ("multi-AZ: ", is_multi_az)
+    if not is_multi_az:
+        return {
+            "compliance_type": "NON_COMPLIANT",
+            "annotation": "The RDS instance [" + context.instance_id + "] is not multi-AZ "
+        }
+
+RDS_CI_CHECKS = [
+    check_storage_encrypted,
+    check_publicly_accessible,
+    check_license_model,
+    check_tags,
+]
+
+RDS_REMOTE_CHECKS = [
+    check_multi_az,
+]
+
+# first_finding
+#
+# The evaluation of the first failing check, None if they all pass.
+def first_finding(context, checks):
+    for check in checks:
+        result = check(context)
+        if result is not None:
+            print ("Stopped at check: ", check.__name__)
+            return result
+    return None
 
 # Helper function used to validate input
 def check_defined(reference, reference_name):
@@ -33,7 +131,7 @@ def check_defined(reference, reference_name):
 # Normalize all rule parameters so we can handle them consistently.
 # All keys are stored in lower case.  Only boolean and numeric keys are stored.
 def normalize_parameters(rule_parameters):
-    for key, value in rule_parameters.items():
+    for key, value in list(rule_parameters.items()):
         normalized_key=key.lower()
         normalized_value=value.lower()
 
@@ -68,7 +166,9 @@ def normalize_parameters(rule_parameters):
 #                      them
 #
 # annotation         - the annotation message for AWS Config
-def evaluate_compliance(configuration_item, debug_enabled):
+def evaluate_compliance(configuration_item, debug_enabled, classifier=None):
+    classifier = classifier or network_classifier.get_classifier()
+
     if configuration_item["resourceType"] not in APPLICABLE_RESOURCES:
         print("not applicable")
         return {
@@ -87,104 +187,37 @@ def evaluate_compliance(configuration_item, debug_enabled):
     instance_id = configuration_item["configuration"]["dBInstanceIdentifier"]
     print ("Evaluating RDS [ " + instance_id +  "] against CPA security guideline described in https://cathaypacific-prod.atlassian.net/wiki/spaces/CPD/pages/389612524/Security+Guideline+for+your+AWS+account")
     print ("CI Details:", configuration_item["configuration"])
-    client = boto3.client("rds")
-    ec2 = boto3.client('ec2')
+    return evaluate_context(resource_context.RdsContext(configuration_item, classifier))
 
+# evaluate_context
+#
+# Run the RDS checks against an applicable, existing instance. The context may
+# be shared with the other RDS rules (see config-rule-dispatcher.py).
+def evaluate_context(context, debug_enabled=False):
     try:
-        response = client.describe_db_instances(DBInstanceIdentifier=instance_id)
-        print("RDS Details: ", response)
-
-
-        vpc_id = response["DBInstances"][0]["DBSubnetGroup"]["VpcId"]
-        response2 = ec2.describe_vpcs(VpcIds=[vpc_id])
-        cidr_block = response2["Vpcs"][0]["CidrBlock"]
-        print ("cidr_block ip: ", cidr_block.split("/")[0])
-        if not isProductionSubnet(cidr_block.split("/")[0]):
-            return {
-                "compliance_type": "NOT_APPLICABLE",
-                "annotation": "The RDS instance [" + instance_id + "] is not in production subnet."
-            }            
-
-        is_encrypted = response["DBInstances"][0]["StorageEncrypted"]
-        if not is_encrypted:
-            return {
-                "compliance_type": "NON_COMPLIANT",
-                "annotation": "The RDS instance [" + instance_id + "] with un-encrypted volume(s) "
-            }
-
-        db_engine = response["DBInstances"][0]["Engine"]
-        print ("DB Engine: ", db_engine)
+        result = first_finding(context, RDS_CI_CHECKS)
 
-        if db_engine.startswith("aurora"):
-            db_cluster_id = response["DBInstances"][0]["DBClusterIdentifier"]
-            print ("Aurora Cluster ID: ", db_cluster_id)
-            db_cluster_response = client.describe_db_clusters(DBClusterIdentifier=db_cluster_id)
-            print ("Aurora Cluster Response: ", db_cluster_response)
-            is_multi_az = db_cluster_response["DBClusters"][0]["MultiAZ"]
-        else:
-            is_multi_az = response["DBInstances"][0]["MultiAZ"]
-        print ("multi-AZ: ", is_multi_az)
+        # A finding only counts for production databases
+        scope = check_production_scope(context)
+        if scope is not None:
+            return scope
 
-        if not is_multi_az:
-            return {
-                "compliance_type": "NON_COMPLIANT",
-                "annotation": "The RDS instance [" + instance_id + "] is not multi-AZ "
-            }
-
-        is_publicly_accessible = response["DBInstances"][0]["PubliclyAccessible"]
-        if is_publicly_accessible:
-            return {
-                "compliance_type": "NON_COMPLIANT",
-                "annotation": "The RDS instance [" + instance_id + "] is publicly accessible "
-            }
-
-        license_model = response["DBInstances"][0]["LicenseModel"]
-        print ("LicenseModel: ", license_model)
-        if license_model != "general-public-license" and license_model != "license-included" and license_model != "postgresql-license":
-            return {
-                "compliance_type": "NON_COMPLIANT",
-                "annotation": "The RDS instance [" + instance_id + "] is not using general public license "
-            }
-
-        tags = configuration_item["tags"]
-        if len(tags) == 0:
-            return {
-                "compliance_type": "NON_COMPLIANT",
-                "annotation": "The RDS instance [" + instance_id + "] is missing all/some of the standard tags" 
-            }
-        for required_tag in RDS_REQUIRED_TAGS:
-            r_tag_name = required_tag["TagName"]
-            r_tag_values = required_tag["TagValues"]
-            if r_tag_name in tags:
-                tag_value = tags[r_tag_name]
-                if len(r_tag_values)>0 and tag_value not in r_tag_values:
-                    return {
-                        "compliance_type": "NON_COMPLIANT",
-                        "annotation": "The RDS instance [" + instance_id + "] with incorrect value of tag " + r_tag_name
-                    }
-            else:
-                return {
-                    "compliance_type": "NON_COMPLIANT",
-                    "annotation": "The RDS instance [" + instance_id + "] with missing tag " + r_tag_name
-                }
+        if result is None:
+            result = first_finding(context, RDS_REMOTE_CHECKS)
+        if result is not None:
+            return result
 
         return {
             "compliance_type": "COMPLIANT",
-            "annotation": "The RDS instance [" + instance_id + "] is comply with CPA standard."
+            "annotation": "The RDS instance [" + context.instance_id + "] is comply with CPA standard."
         }
-           
-            
+
     except botocore.exceptions.ClientError as e:
         print ("e:", e)
         return {
             "compliance_type" : "NON_COMPLIANT",
-            "annotation" : "describe_instances failure on instance " + instance_id
+            "annotation" : "describe_instances failure on instance " + context.instance_id
         }
-        
-    return {
-        "compliance_type": "COMPLIANT",
-        "annotation": "rds compliance checking passed on instance " + instance_id
-    }
 
 def lambda_handler(event, context):
     check_defined(event, 'event')
@@ -193,7 +226,9 @@ def lambda_handler(event, context):
     check_defined(invoking_event, 'invokingEvent')
     configuration_item = invoking_event["configurationItem"]
 
-    rule_parameters = normalize_parameters(json.loads(event["ruleParameters"]))
+    raw_parameters = json.loads(event["ruleParameters"])
+    classifier = network_classifier.get_classifier(raw_parameters)
+    rule_parameters = normalize_parameters(dict(raw_parameters))
 
     debug_enabled = False
 
@@ -203,9 +238,10 @@ def lambda_handler(event, context):
     if debug_enabled:
         print("Received event: " + json.dumps(event, indent=2))
 
-    evaluation = evaluate_compliance(configuration_item, debug_enabled)
+    evaluation = evaluate_compliance(configuration_item, debug_enabled, classifier)
 
     print ("Evaluation Result:", evaluation)
+    resource_context.publish_cache_metrics()
 
 
     config = boto3.client('config')
@@ -222,3 +258,9 @@ def lambda_handler(event, context):
        ],
        ResultToken=event['resultToken'])
 
+def evaluate_event(configuration_item, rule_parameters):
+    classifier = network_classifier.get_classifier(rule_parameters)
+    debug_enabled = normalize_parameters(dict(rule_parameters)).get("debug", False)
+    return evaluate_compliance(configuration_item, debug_enabled, classifier)
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_event, lambda_handler, resource_context.publish_cache_metrics)
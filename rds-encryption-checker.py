@@ -1,6 +1,9 @@
 import boto3
 import botocore
+import config_event_batch
 import json
+import network_classifier
+import resource_context
 
 APPLICABLE_RESOURCES = ["AWS::RDS::DBInstance"]
 
@@ -16,12 +19,6 @@ RDS_REQUIRED_TAGS = [
 ]
 
 
-def isProductionSubnet(ip):
-    parts = ip.split(".")
-    if parts[0] == "172" and parts[1] == "31" and int(parts[2]) >= 192 and int(parts[2]) <= 255:
-        return True 
-    return False
-
 # Helper function used to validate input
 def check_defined(reference, reference_name):
     if not reference:
@@ -33,7 +30,7 @@ def check_defined(reference, reference_name):
 # Normalize all rule parameters so we can handle them consistently.
 # All keys are stored in lower case.  Only boolean and numeric keys are stored.
 def normalize_parameters(rule_parameters):
-    for key, value in rule_parameters.items():
+    for key, value in list(rule_parameters.items()):
         normalized_key=key.lower()
         normalized_value=value.lower()
 
@@ -68,7 +65,9 @@ def normalize_parameters(rule_parameters):
 #                      them
 #
 # annotation         - the annotation message for AWS Config
-def evaluate_compliance(configuration_item, debug_enabled):
+def evaluate_compliance(configuration_item, debug_enabled, classifier=None):
+    classifier = classifier or network_classifier.get_classifier()
+
     if configuration_item["resourceType"] not in APPLICABLE_RESOURCES:
         print("not applicable")
         return {
@@ -88,38 +87,30 @@ def evaluate_compliance(configuration_item, debug_enabled):
     print ("Evaluating RDS [ " + instance_id +  "] against CPA security guideline described in https://cathaypacific-prod.atlassian.net/wiki/spaces/CPD/pages/389612524/Security+Guideline+for+your+AWS+account")
     print ("CI Details:", configuration_item["configuration"])
 
-    is_encrypted = configuration_item["configuration"]["storageEncrypted"]
+    return evaluate_context(resource_context.RdsContext(configuration_item, classifier))
+
+# evaluate_context
+#
+# Check the encryption of an applicable, existing instance. The VPC lookup of
+# the production scope check goes through the shared context (see
+# config-rule-dispatcher.py) and its metadata cache.
+def evaluate_context(context, debug_enabled=False):
+    is_encrypted = context.configuration["storageEncrypted"]
     if is_encrypted:
         return {
             "compliance_type": "COMPLIANT",
-            "annotation": "The RDS instance [" + instance_id + "] is comply with CPA standard."
+            "annotation": "The RDS instance [" + context.instance_id + "] is comply with CPA standard."
         }
 
-    client = boto3.client("rds")
-    ec2 = boto3.client('ec2')
-
-    response = client.describe_db_instances(DBInstanceIdentifier=instance_id)
-    print("RDS Details: ", response)
-
-
-    vpc_id = response["DBInstances"][0]["DBSubnetGroup"]["VpcId"]
-    response2 = ec2.describe_vpcs(VpcIds=[vpc_id])
-    cidr_block = response2["Vpcs"][0]["CidrBlock"]
-    print ("cidr_block ip: ", cidr_block.split("/")[0])
-    if not isProductionSubnet(cidr_block.split("/")[0]):
+    if not context.is_production():
         return {
             "compliance_type": "NOT_APPLICABLE",
-            "annotation": "The RDS instance [" + instance_id + "] is not in production subnet."
-        }            
+            "annotation": "The RDS instance [" + context.instance_id + "] is not in production subnet."
+        }
 
     return {
         "compliance_type": "NON_COMPLIANT",
-        "annotation": "The RDS instance [" + instance_id + "] with un-encrypted volume(s) "
-    }
-
-    return {
-        "compliance_type": "COMPLIANT",
-        "annotation": "rds compliance checking passed on instance " + instance_id
+        "annotation": "The RDS instance [" + context.instance_id + "] with un-encrypted volume(s) "
     }
 
 def lambda_handler(event, context):
@@ -129,7 +120,9 @@ def lambda_handler(event, context):
     check_defined(invoking_event, 'invokingEvent')
     configuration_item = invoking_event["configurationItem"]
 
-    rule_parameters = normalize_parameters(json.loads(event["ruleParameters"]))
+    raw_parameters = json.loads(event["ruleParameters"])
+    classifier = network_classifier.get_classifier(raw_parameters)
+    rule_parameters = normalize_parameters(dict(raw_parameters))
 
     debug_enabled = False
 
@@ -139,7 +132,7 @@ def lambda_handler(event, context):
     if debug_enabled:
         print("Received event: " + json.dumps(event, indent=2))
 
-    evaluation = evaluate_compliance(configuration_item, debug_enabled)
+    evaluation = evaluate_compliance(configuration_item, debug_enabled, classifier)
 
     print ("Evaluation Result:", evaluation)
 
@@ -158,3 +151,9 @@ def lambda_handler(event, context):
        ],
        ResultToken=event['resultToken'])
 
+def evaluate_event(configuration_item, rule_parameters):
+    classifier = network_classifier.get_classifier(rule_parameters)
+    debug_enabled = normalize_parameters(dict(rule_parameters)).get("debug", False)
+    return evaluate_compliance(configuration_item, debug_enabled, classifier)
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_event, lambda_handler)
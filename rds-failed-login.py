@@ -1,4 +1,5 @@
 import json, boto3, time
+import resource_context
 from botocore.exceptions import ClientError
 
 rds = boto3.client('rds', region_name='ap-southeast-1')
@@ -165,73 +166,96 @@ def check_and_modify_rds(profile):
     'engine': profile['engine']
   }
     
+def evaluate_context(context, debug_enabled=False):
+  '''
+  Make sure the failed login attempts of the rds are exported, counted and
+  alarmed on
+
+  Parameters:
+  context (resource_context.RdsContext): the rds configuration item, possibly
+                                         shared with the other rds rules
+
+
+  Returns:
+  dict:
+    compliance_type (str): always COMPLIANT, missing settings are fixed
+    annotation (str): the annotation message for AWS Config
+
+  '''
+  profile = context.configuration
+  identifier = profile['dBInstanceIdentifier'] if profile['dBInstanceIdentifier'] else profile['dBClusterIdentifier']
+
+  print(f'Checking rds {identifier}...')
+  result = check_and_modify_rds(profile)
+  
+  '''
+  This block create metric filters for the error log
+  '''
+  print(f'{identifier} has missing metric filter. Setting it up...')
+  prefix = '/aws/rds/cluster/' if result['is_cluster'] else '/aws/rds/instance/'
+  identifier = result['identifier']
+  postfix = log_group_postfix_mapping(result['engine'])
+  
+  log_group_name = prefix + identifier + postfix
+  print(f'Setting up metric filter for {log_group_name}')
+  
+  cloudwatchlogs.put_metric_filter(
+    logGroupName = log_group_name,
+    filterName='Access-denied-' + result['engine'],
+    filterPattern=failed_login_keyword_mapping(result['engine']),
+    metricTransformations=[
+      {
+        'metricName': 'AccessDeniedCount',
+        'metricNamespace': 'LogMetrics',
+        'metricValue': '1',
+        'defaultValue': 0.0
+      }
+    ]
+  )
+  
+  '''
+  This block create alarm based on the metric filters previously setup
+  '''
+  print(f'Setting alert for {identifier}...')
+  response = sns.create_topic(Name='compliance-reporter-topic')
+  rds_sns_alert_topic = response['TopicArn']
+
+  cloudwatch.put_metric_alarm(
+    AlarmName='RDS-Frequent-Failed-Login-Attempts',
+    AlarmDescription='Alarm for frequent failed login attempts, which indicates that the databases are under attack potentially.',
+    ActionsEnabled=False,
+    Namespace='LogMetrics',
+    MetricName='AccessDeniedCount',
+    Statistic='Sum',
+    Period=300,
+    EvaluationPeriods=1,
+    DatapointsToAlarm=1,
+    Threshold=5.0,
+    ComparisonOperator='GreaterThanOrEqualToThreshold',
+    TreatMissingData='missing',
+    AlarmActions=[
+      rds_sns_alert_topic
+    ]
+  )
+
+  return {
+    'compliance_type': 'COMPLIANT',
+    'annotation': 'The filter is set for this RDS'
+  }
+    
 def lambda_handler(event, context):
     if event and 'invokingEvent' in event:
       invoking_event = json.loads(event['invokingEvent'])
       config_item = invoking_event['configurationItem']
-      profile = config_item['configuration']
-      identifier = profile['dBInstanceIdentifier'] if profile['dBInstanceIdentifier'] else profile['dBClusterIdentifier']
-    
-      print(f'Checking rds {identifier}...')
-      result = check_and_modify_rds(profile)
-      
-      '''
-      This block create metric filters for the error log
-      '''
-      print(f'{identifier} has missing metric filter. Setting it up...')
-      prefix = '/aws/rds/cluster/' if result['is_cluster'] else '/aws/rds/instance/'
-      identifier = result['identifier']
-      postfix = log_group_postfix_mapping(result['engine'])
-      
-      log_group_name = prefix + identifier + postfix
-      print(f'Setting up metric filter for {log_group_name}')
-      
-      cloudwatchlogs.put_metric_filter(
-        logGroupName = log_group_name,
-        filterName='Access-denied-' + result['engine'],
-        filterPattern=failed_login_keyword_mapping(result['engine']),
-        metricTransformations=[
-          {
-            'metricName': 'AccessDeniedCount',
-            'metricNamespace': 'LogMetrics',
-            'metricValue': '1',
-            'defaultValue': 0.0
-          }
-        ]
-      )
-      
-      '''
-      This block create alarm based on the metric filters previously setup
-      '''
-      print(f'Setting alert for {identifier}...')
-      response = sns.create_topic(Name='compliance-reporter-topic')
-      rds_sns_alert_topic = response['TopicArn']
-
-      cloudwatch.put_metric_alarm(
-        AlarmName='RDS-Frequent-Failed-Login-Attempts',
-        AlarmDescription='Alarm for frequent failed login attempts, which indicates that the databases are under attack potentially.',
-        ActionsEnabled=False,
-        Namespace='LogMetrics',
-        MetricName='AccessDeniedCount',
-        Statistic='Sum',
-        Period=300,
-        EvaluationPeriods=1,
-        DatapointsToAlarm=1,
-        Threshold=5.0,
-        ComparisonOperator='GreaterThanOrEqualToThreshold',
-        TreatMissingData='missing',
-        AlarmActions=[
-          rds_sns_alert_topic
-        ]
-      )
+      evaluation = evaluate_context(resource_context.RdsContext(config_item))
     
     response = config.put_evaluations(
     Evaluations=[
            {
                'ComplianceResourceType': invoking_event['configurationItem']['resourceType'],
                'ComplianceResourceId': invoking_event['configurationItem']['resourceId'],
-               'ComplianceType': 'COMPLIANT',
-               'Annotation': 'The filter is set for this RDS',
+               'ComplianceType': evaluation['compliance_type'],
+               'Annotation': evaluation['annotation'],
                'OrderingTimestamp': invoking_event['configurationItem']['configurationItemCaptureTime']
            },
        ],
@@ -0,0 +1,175 @@
+import boto3
+import json
+import sg_policy
+import time
+
+# Lazily fetched resource data shared by the config rules.
+#
+# A context wraps one configuration item. Data that is in the configuration
+# item is read directly; anything that needs an API call is fetched the first
+# time a rule asks for it and kept for the other rules evaluating the same
+# item (see config-rule-dispatcher.py). VPC CIDRs and Aurora cluster topology
+# are additionally cached per warm container.
+
+# VPC CIDRs and Aurora cluster topology rarely change, so they are cached per
+# warm container. Bursts of RDS change notifications (e.g. a parameter group
+# rollout) then reuse the metadata instead of describing it again.
+METADATA_CACHE_TTL_SECONDS = 900
+METADATA_CACHE_MAX_ENTRIES = 1024
+
+# key -> (expiry timestamp, value)
+METADATA_CACHE = {}
+METADATA_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# cached_metadata
+#
+# Return the cached value for key, or call loader and cache its result for
+# METADATA_CACHE_TTL_SECONDS.
+def cached_metadata(key, loader):
+    now = time.time()
+    entry = METADATA_CACHE.get(key)
+    if entry is not None and entry[0] > now:
+        METADATA_CACHE_STATS["hits"] += 1
+        return entry[1]
+
+    METADATA_CACHE_STATS["misses"] += 1
+    value = loader()
+
+    if len(METADATA_CACHE) >= METADATA_CACHE_MAX_ENTRIES:
+        for expired_key in [k for k, v in METADATA_CACHE.items() if v[0] <= now]:
+            del METADATA_CACHE[expired_key]
+    if len(METADATA_CACHE) >= METADATA_CACHE_MAX_ENTRIES:
+        del METADATA_CACHE[next(iter(METADATA_CACHE))]
+    METADATA_CACHE[key] = (now + METADATA_CACHE_TTL_SECONDS, value)
+    return value
+
+def get_vpc_cidr(ec2, vpc_id):
+    return cached_metadata(("vpc", vpc_id),
+        lambda: ec2.describe_vpcs(VpcIds=[vpc_id])["Vpcs"][0]["CidrBlock"])
+
+def get_db_cluster(client, db_cluster_id):
+    return cached_metadata(("cluster", db_cluster_id),
+        lambda: client.describe_db_clusters(DBClusterIdentifier=db_cluster_id)["DBClusters"][0])
+
+# publish_cache_metrics
+#
+# Emit the cache size and hit rate in CloudWatch embedded metric format, so
+# the metrics are extracted from the log line without a PutMetricData call.
+def publish_cache_metrics(namespace="ConfigRules/RdsChecker"):
+    lookups = METADATA_CACHE_STATS["hits"] + METADATA_CACHE_STATS["misses"]
+    hit_rate = 100.0 * METADATA_CACHE_STATS["hits"] / lookups if lookups > 0 else 0.0
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [[]],
+                "Metrics": [
+                    {"Name": "MetadataCacheSize", "Unit": "Count"},
+                    {"Name": "MetadataCacheHitRate", "Unit": "Percent"}
+                ]
+            }]
+        },
+        "MetadataCacheSize": len(METADATA_CACHE),
+        "MetadataCacheHitRate": hit_rate
+    }))
+
+# get_recorded_configuration_item
+#
+# The latest configuration item recorded by Config, in the format of the
+# invoking event. Oversized change notifications only carry a
+# configurationItemSummary without configuration or tags.
+#
+# return values:
+#
+# the configuration item, None if Config has not recorded the resource
+def get_recorded_configuration_item(config, resource_type, resource_id):
+    response = config.get_resource_config_history(resourceType=resource_type, resourceId=resource_id, limit=1)
+    if not response["configurationItems"]:
+        return None
+    item = dict(response["configurationItems"][0])
+    item["ARN"] = item.pop("arn", None)
+    item["awsAccountId"] = item.pop("accountId", None)
+    item["configurationItemVersion"] = item.pop("version", None)
+    item["configuration"] = json.loads(item.get("configuration") or "null")
+    return item
+
+# ResourceContext
+#
+# Common part of the contexts: the configuration item and one boto3 client
+# per service.
+class ResourceContext:
+    def __init__(self, configuration_item, classifier=None):
+        self.configuration_item = configuration_item
+        self.configuration = configuration_item.get("configuration")
+        self.resource_id = configuration_item["resourceId"]
+        self.classifier = classifier
+        self._clients = {}
+
+    def client(self, service):
+        if service not in self._clients:
+            self._clients[service] = boto3.client(service)
+        return self._clients[service]
+
+# SecurityGroupContext
+#
+# The ingress rules of one security group. They are part of the configuration
+# item; only oversized change notifications need a describe_security_groups
+# round trip, made once whatever the number of rules asking.
+class SecurityGroupContext(ResourceContext):
+    def __init__(self, configuration_item, classifier=None):
+        ResourceContext.__init__(self, configuration_item, classifier)
+        self.group_id = self.resource_id
+        self._ip_permissions = None
+
+    # Raises botocore.exceptions.ClientError if the group cannot be described
+    def ip_permissions(self):
+        if self._ip_permissions is None:
+            ip_permissions = sg_policy.ci_ip_permissions(self.configuration_item)
+            if ip_permissions is None:
+                response = self.client("ec2").describe_security_groups(GroupIds=[self.group_id])
+                ip_permissions = response["SecurityGroups"][0]["IpPermissions"]
+            self._ip_permissions = ip_permissions
+        return self._ip_permissions
+
+# RdsContext
+#
+# Everything a check may need about one RDS instance. Configuration item data
+# is read directly; remote lookups (VPC CIDR, Aurora cluster) are fetched only
+# when a check asks for them, at most once per evaluation. For oversized
+# change notifications the full configuration item is read from Config first.
+#
+# Raises botocore.exceptions.ClientError if the item cannot be read, and
+# ValueError if Config has no configuration for the instance.
+class RdsContext(ResourceContext):
+    def __init__(self, configuration_item, classifier=None):
+        ResourceContext.__init__(self, configuration_item, classifier)
+        if self.configuration is None:
+            recorded = get_recorded_configuration_item(self.client("config"),
+                configuration_item["resourceType"], self.resource_id)
+            if recorded is None or recorded["configuration"] is None:
+                raise ValueError("no recorded configuration for " + self.resource_id)
+            self.configuration_item = recorded
+            self.configuration = recorded["configuration"]
+        self.instance_id = self.configuration["dBInstanceIdentifier"]
+        self._is_production = None
+
+    def vpc_id(self):
+        subnet_group = self.configuration.get("dBSubnetGroup")
+        if subnet_group and subnet_group.get("vpcId"):
+            return subnet_group["vpcId"]
+        # Not in the CI (e.g. oversized item), ask RDS
+        response = self.client("rds").describe_db_instances(DBInstanceIdentifier=self.instance_id)
+        return response["DBInstances"][0]["DBSubnetGroup"]["VpcId"]
+
+    def is_production(self):
+        if self._is_production is None:
+            cidr_block = get_vpc_cidr(self.client("ec2"), self.vpc_id())
+            print ("cidr_block ip: ", cidr_block.split("/")[0])
+            self._is_production = self.classifier.is_production(cidr_block.split("/")[0])
+        return self._is_production
+
+    def db_cluster(self):
+        db_cluster_id = self.configuration["dBClusterIdentifier"]
+        print ("Aurora Cluster ID: ", db_cluster_id)
+        return get_db_cluster(self.client("rds"), db_cluster_id)
@@ -0,0 +1,531 @@
+import boto3
+import concurrent.futures
+import datetime
+import json
+import os
+import re
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Shared inventory, actions and plans of the resource schedulers
+# (cronjob-start-resources-working-hours.py,
+# cronjob-stop-resources-non-working-hours.py,
+# cron-switchoff-ete-env-resources.py, cronjob-fleet-resources-scheduler.py,
+# cronjob-schedule-reconciler.py).
+#
+# Each run describes the resources once into a plain list (the inventory
+# snapshot) and every later step works on that list, so the resources are not
+# described again and the set cannot change between the log line, the count
+# and the action.
+
+# --
+# EC2
+# --
+
+# Instance ids per start_instances / stop_instances call, the size of one
+# describe_instances page that the boto3 collection batch actions send too
+EC2_ACTION_BATCH_SIZE = 1000
+# Errors caused by some of the ids of a call (terminated, unknown or not in a
+# state to start / stop). The ids named in the message are skipped and the
+# rest of the chunk is sent again.
+EC2_INSTANCE_ERRORS = {'InvalidInstanceID.NotFound', 'InvalidInstanceID.Malformed', 'IncorrectInstanceState'}
+INSTANCE_ID_PATTERN = re.compile(r'i-[0-9a-f]+')
+
+def tag_dict(tags):
+  return {tag['Key']: tag['Value'] for tag in tags or []}
+
+def ec2_inventory(ec2, filters):
+  '''
+  Describe the instances matching the filters in one paginated pass.
+
+  Parameters:
+  ec2 (EC2.Client): client of the account and region to describe
+  filters (list): describe_instances filters
+
+  Returns:
+  list: {'id', 'state', 'tags'} per instance
+  '''
+  instances = []
+  for page in ec2.get_paginator('describe_instances').paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+    for reservation in page['Reservations']:
+      for instance in reservation['Instances']:
+        instances.append({
+          'id': instance['InstanceId'],
+          'state': instance['State']['Name'],
+          'tags': tag_dict(instance.get('Tags')),
+        })
+  return instances
+
+def ec2_act(ec2, action, instance_ids):
+  '''
+  Start or stop the instances, EC2_ACTION_BATCH_SIZE ids per call. Instances
+  rejected with one of EC2_INSTANCE_ERRORS are logged and left out of the
+  retried call; any other failed call is logged and the remaining chunks are
+  still sent.
+
+  Parameters:
+  action (str): 'start' or 'stop'
+  instance_ids (list): ids to act on
+
+  Returns:
+  list: ids of the instances EC2 reported as starting / stopping
+  '''
+  if action == 'start':
+    call, result_key = ec2.start_instances, 'StartingInstances'
+  else:
+    call, result_key = ec2.stop_instances, 'StoppingInstances'
+
+  acted = []
+  for i in range(0, len(instance_ids), EC2_ACTION_BATCH_SIZE):
+    chunk = instance_ids[i:i + EC2_ACTION_BATCH_SIZE]
+    while chunk:
+      try:
+        response = call(InstanceIds=chunk)
+      except ClientError as e:
+        rejected = set(INSTANCE_ID_PATTERN.findall(e.response['Error'].get('Message', ''))) & set(chunk)
+        if e.response['Error'].get('Code') not in EC2_INSTANCE_ERRORS or not rejected:
+          print(f'[ERROR] Could not {action} EC2 instances {chunk}: {e}')
+          break
+        print(f'[WARN] Skipping EC2 instances {sorted(rejected)}: {e}')
+        chunk = [ instance_id for instance_id in chunk if instance_id not in rejected ]
+        continue
+      acted.extend(change['InstanceId'] for change in response[result_key])
+      break
+  return acted
+
+# --
+# RDS
+# --
+
+# Concurrent start/stop calls. The adaptive retry mode slows the client down
+# when RDS throttles, RDS_MAX_WORKERS only bounds the fan-out.
+RDS_MAX_WORKERS = int(os.environ.get('RDS_MAX_WORKERS', '8'))
+RDS_CLIENT_CONFIG = Config(
+  retries={'max_attempts': 10, 'mode': 'adaptive'},
+  max_pool_connections=RDS_MAX_WORKERS)
+
+def rds_inventory(rds):
+  '''
+  Describe every RDS instance and Aurora cluster in one paginated pass each.
+  describe_db_instances and describe_db_clusters embed the tags, so no
+  list_tags_for_resource call is needed.
+
+  Instances that belong to a cluster are left out: Aurora starts and stops
+  them with their cluster.
+
+  Parameters:
+  rds (RDS.Client): client of the account and region to describe
+
+  Returns:
+  list: {'kind' ('instance' or 'cluster'), 'id', 'status', 'tags'} per resource
+  '''
+  resources = []
+  for page in rds.get_paginator('describe_db_instances').paginate():
+    for instance in page['DBInstances']:
+      if instance.get('DBClusterIdentifier'):
+        continue
+      resources.append({
+        'kind': 'instance',
+        'id': instance['DBInstanceIdentifier'],
+        'status': instance['DBInstanceStatus'],
+        'tags': tag_dict(instance.get('TagList')),
+      })
+  for page in rds.get_paginator('describe_db_clusters').paginate():
+    for cluster in page['DBClusters']:
+      if not cluster['Engine'].startswith('aurora'):
+        continue
+      resources.append({
+        'kind': 'cluster',
+        'id': cluster['DBClusterIdentifier'],
+        'status': cluster['Status'],
+        'tags': tag_dict(cluster.get('TagList')),
+      })
+  return resources
+
+def rds_select(resources, status, tag_key):
+  '''
+  The resources in the given status whose tag_key tag is 'true'.
+  '''
+  return [
+    resource for resource in resources
+    if resource['status'] == status and resource['tags'].get(tag_key) in [ 'true' ]
+  ]
+
+def rds_act(rds, action, resources):
+  '''
+  Start or stop the instances and clusters, RDS_MAX_WORKERS calls at a time.
+  A failed call is logged and does not stop the others.
+
+  Parameters:
+  action (str): 'start' or 'stop'
+  resources (list): entries of rds_inventory
+
+  Returns:
+  list: ids of the resources acted on, in the order of resources
+  '''
+  def act(resource):
+    try:
+      if resource['kind'] == 'cluster':
+        call = rds.start_db_cluster if action == 'start' else rds.stop_db_cluster
+        call(DBClusterIdentifier=resource['id'])
+      else:
+        call = rds.start_db_instance if action == 'start' else rds.stop_db_instance
+        call(DBInstanceIdentifier=resource['id'])
+    except ClientError as e:
+      print(f'[ERROR] Could not {action} RDS {resource["kind"]} {resource["id"]}: {e}')
+      return False
+    return True
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=RDS_MAX_WORKERS) as executor:
+    results = list(executor.map(act, resources))
+  return [ resource['id'] for resource, done in zip(resources, results) if done ]
+
+# --
+# Start waves
+# --
+
+# Resources start in ascending StartWave order (e.g. databases in wave 1, app
+# servers in wave 2). Each wave is started and waited for before the next
+# one; resources without the tag are in wave 0. A wave is waited for with
+# one polling loop that describes all its pending resources every
+# READY_POLL_SECONDS (describe_instances per EC2_ACTION_BATCH_SIZE ids,
+# describe_db_instances / describe_db_clusters per RDS_FILTER_BATCH_SIZE ids),
+# so the whole wave shares one budget however many resources it has.
+#
+# A Lambda run ends after at most 15 minutes, so the waves are run against a
+# deadline (see run_deadline): the waits are cut to the time left and no wave
+# is started with less than WAVE_MIN_REMAINING_SECONDS left. The waves not
+# started are reported; their resources are still stopped, so the next run
+# picks them up.
+WAVE_TAG = 'StartWave'
+ENVIRONMENT_TAG = 'Environment'
+WAVE_MAX_WAIT_SECONDS = int(os.environ.get('WAVE_MAX_WAIT_SECONDS', '600'))
+WAVE_MIN_REMAINING_SECONDS = 60
+# Kept free at the end of the run to report the results and metrics
+RUN_MARGIN_SECONDS = 30
+READY_POLL_SECONDS = 15
+# Values per describe_db_instances / describe_db_clusters filter
+RDS_FILTER_BATCH_SIZE = 100
+# The failure states of the instance_running, db_instance_available and
+# db_cluster_available waiters: the resource will not become ready
+EC2_FAILED_STATES = {'shutting-down', 'terminated', 'stopping'}
+RDS_FAILED_STATUSES = {'deleted', 'deleting', 'failed', 'incompatible-restore', 'incompatible-parameters'}
+
+def run_deadline(context):
+  '''
+  The time.time() by which start_waves must return: the end of the Lambda
+  run less RUN_MARGIN_SECONDS, None without a Lambda context.
+  '''
+  if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+    return None
+  return time.time() + context.get_remaining_time_in_millis() / 1000 - RUN_MARGIN_SECONDS
+
+def start_wave(resource):
+  value = resource['tags'].get(WAVE_TAG, '0')
+  try:
+    return int(value)
+  except ValueError:
+    print(f'[WARN] Invalid {WAVE_TAG} tag {value!r} on {resource["id"]}, starting it in wave 0')
+    return 0
+
+def environment(resource):
+  return resource['tags'].get(ENVIRONMENT_TAG, 'untagged')
+
+def group_waves(ec2_instances, rds_resources):
+  '''
+  Returns:
+  list: (wave, EC2 instances, RDS resources) in ascending wave order
+  '''
+  waves = {}
+  for instance in ec2_instances:
+    waves.setdefault(start_wave(instance), ([], []))[0].append(instance)
+  for resource in rds_resources:
+    waves.setdefault(start_wave(resource), ([], []))[1].append(resource)
+  return [ (wave, waves[wave][0], waves[wave][1]) for wave in sorted(waves) ]
+
+def ec2_states(ec2, instance_ids):
+  '''
+  Returns:
+  dict: instance id -> state name, without the ids that could not be described
+  '''
+  states = {}
+  for i in range(0, len(instance_ids), EC2_ACTION_BATCH_SIZE):
+    chunk = instance_ids[i:i + EC2_ACTION_BATCH_SIZE]
+    try:
+      for page in ec2.get_paginator('describe_instances').paginate(InstanceIds=chunk):
+        for reservation in page['Reservations']:
+          for instance in reservation['Instances']:
+            states[instance['InstanceId']] = instance['State']['Name']
+    except ClientError as e:
+      print(f'[ERROR] Could not describe EC2 instances {chunk}: {e}')
+  return states
+
+def rds_statuses(rds, kind, ids):
+  '''
+  Parameters:
+  kind (str): 'instance' or 'cluster'
+
+  Returns:
+  dict: id -> status, without the ids that could not be described
+  '''
+  if kind == 'cluster':
+    operation, filter_name, items_key, id_key, status_key = \
+      'describe_db_clusters', 'db-cluster-id', 'DBClusters', 'DBClusterIdentifier', 'Status'
+  else:
+    operation, filter_name, items_key, id_key, status_key = \
+      'describe_db_instances', 'db-instance-id', 'DBInstances', 'DBInstanceIdentifier', 'DBInstanceStatus'
+  statuses = {}
+  for i in range(0, len(ids), RDS_FILTER_BATCH_SIZE):
+    chunk = ids[i:i + RDS_FILTER_BATCH_SIZE]
+    try:
+      for page in rds.get_paginator(operation).paginate(Filters=[{'Name': filter_name, 'Values': chunk}]):
+        for item in page[items_key]:
+          statuses[item[id_key]] = item[status_key]
+    except ClientError as e:
+      print(f'[ERROR] Could not describe RDS {kind}s {chunk}: {e}')
+  return statuses
+
+def wait_ready(ec2, rds, ec2_instances, rds_resources, max_wait_seconds=WAVE_MAX_WAIT_SECONDS):
+  '''
+  Poll the started resources every READY_POLL_SECONDS until they are all
+  running / available, at most max_wait_seconds. They are described at
+  least once.
+
+  Returns:
+  list: (environment, time.time() when ready or None if it never was) per
+        resource
+  '''
+  deadline = time.time() + max_wait_seconds
+  # (service or RDS kind, id) -> environment
+  pending = {}
+  for instance in ec2_instances:
+    pending[('ec2', instance['id'])] = environment(instance)
+  for resource in rds_resources:
+    pending[(resource['kind'], resource['id'])] = environment(resource)
+
+  results = []
+  while pending:
+    states = {}
+    for kind in ('ec2', 'instance', 'cluster'):
+      ids = [ resource_id for pending_kind, resource_id in pending if pending_kind == kind ]
+      if not ids:
+        continue
+      described = ec2_states(ec2, ids) if kind == 'ec2' else rds_statuses(rds, kind, ids)
+      states.update(((kind, resource_id), state) for resource_id, state in described.items())
+
+    now = time.time()
+    for key, state in states.items():
+      if key not in pending:
+        continue
+      if state in ('running', 'available'):
+        results.append((pending.pop(key), now))
+      elif state in EC2_FAILED_STATES or state in RDS_FAILED_STATUSES:
+        print(f'[ERROR] {key[0]} {key[1]} will not become ready: {state}')
+        results.append((pending.pop(key), None))
+
+    if not pending or now + READY_POLL_SECONDS > deadline:
+      break
+    time.sleep(READY_POLL_SECONDS)
+
+  if pending:
+    print(f'[ERROR] Not ready after {max_wait_seconds:.0f}s: {[ resource_id for kind, resource_id in pending ]}')
+  results.extend((env, None) for env in pending.values())
+  return results
+
+def start_waves(ec2, rds, ec2_instances, rds_resources, deadline=None):
+  '''
+  Start the resources wave by wave. Within a wave EC2 and RDS are started in
+  parallel; the next wave starts once the resources of the current one are
+  ready (or after WAVE_MAX_WAIT_SECONDS, or at the deadline).
+
+  Parameters:
+  deadline (float): time.time() by which to return, see run_deadline
+
+  Returns:
+  dict:
+    ec2, rds (list): ids acted on
+    waves (list): {'wave', 'ec2', 'rds', 'ready'} per wave
+    unstarted (list): {'wave', 'ec2', 'rds'} ids of the waves left for the
+                      next run because the deadline was near
+    time_to_ready (dict): environment -> seconds from the start of the run
+                          until its last resource was ready, None if one never was
+  '''
+  run_start = time.time()
+  result = {'ec2': [], 'rds': [], 'waves': [], 'unstarted': [], 'time_to_ready': {}}
+  ready_at = {}
+
+  for wave, ec2_instances_wave, rds_resources_wave in group_waves(ec2_instances, rds_resources):
+    if result['unstarted'] or (deadline is not None and deadline - time.time() < WAVE_MIN_REMAINING_SECONDS):
+      result['unstarted'].append({
+        'wave': wave,
+        'ec2': [ instance['id'] for instance in ec2_instances_wave ],
+        'rds': [ resource['id'] for resource in rds_resources_wave ],
+      })
+      continue
+    print(f'[INFO] Starting wave {wave}: {len(ec2_instances_wave)} EC2 instances, {len(rds_resources_wave)} RDS instances and clusters')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      ec2_future = executor.submit(ec2_act, ec2, 'start', [ instance['id'] for instance in ec2_instances_wave ])
+      rds_future = executor.submit(rds_act, rds, 'start', rds_resources_wave)
+      ec2_started, rds_started = ec2_future.result(), rds_future.result()
+
+    ec2_started_ids, rds_started_ids = set(ec2_started), set(rds_started)
+    max_wait_seconds = WAVE_MAX_WAIT_SECONDS
+    if deadline is not None:
+      max_wait_seconds = max(0, min(max_wait_seconds, deadline - time.time()))
+    waits = wait_ready(ec2,
+                       rds,
+                       [ instance for instance in ec2_instances_wave if instance['id'] in ec2_started_ids ],
+                       [ resource for resource in rds_resources_wave if resource['id'] in rds_started_ids ],
+                       max_wait_seconds)
+    for env, ready in waits:
+      if ready is None or ready_at.get(env, 0) is None:
+        ready_at[env] = None
+      else:
+        ready_at[env] = max(ready, ready_at.get(env, 0))
+
+    result['ec2'].extend(ec2_started)
+    result['rds'].extend(rds_started)
+    result['waves'].append({
+      'wave': wave,
+      'ec2': ec2_started,
+      'rds': rds_started,
+      'ready': all(ready is not None for env, ready in waits),
+    })
+    print(f'[INFO] Wave {wave} done after {time.time() - run_start:.0f}s')
+
+  if result['unstarted']:
+    print(f'[ERROR] Out of time, waves not started: {[ wave["wave"] for wave in result["unstarted"] ]}')
+  result['time_to_ready'] = {
+    env: round(ready - run_start, 1) if ready is not None else None for env, ready in ready_at.items()
+  }
+  publish_time_to_ready(result['time_to_ready'])
+  return result
+
+def publish_time_to_ready(time_to_ready):
+  '''
+  Emit the time-to-ready per environment in CloudWatch embedded metric
+  format. Environments that never became ready are left out.
+  '''
+  for env, seconds in time_to_ready.items():
+    if seconds is None:
+      continue
+    print(json.dumps({
+      '_aws': {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+          'Namespace': 'Schedulers/WorkingHours',
+          'Dimensions': [['Environment']],
+          'Metrics': [{'Name': 'TimeToReady', 'Unit': 'Seconds'}]
+        }]
+      },
+      'Environment': env,
+      'TimeToReady': seconds
+    }))
+
+# --
+# Plans
+# --
+
+# A plan is the JSON result of one discovery: which resources to start, to
+# stop and to leave alone, each with the reason. It can be reviewed (e.g.
+# before a holiday change) and executed later without describing anything
+# again:
+#
+#   {"created": ..., "region": ..., "action": "stop", "tag": "StopAtNonWorkingHours",
+#    "start": [], "stop": [{"service": "ec2", "kind": "instance", "id": ..., "reason": ...}],
+#    "leave": [...]}
+
+# State a resource must be in to be started / stopped
+ACTION_FROM_STATES = {
+  'start': {'ec2': 'stopped', 'rds': 'stopped'},
+  'stop': {'ec2': 'running', 'rds': 'available'},
+}
+
+def build_plan(action, tag_key, ec2_instances, rds_resources, region=None):
+  '''
+  Plan action ('start' or 'stop') for the resources tagged tag_key=true.
+
+  Parameters:
+  ec2_instances (list): the full ec2_inventory, untagged instances included,
+                        so the plan explains why they are left alone
+  rds_resources (list): the full rds_inventory
+
+  Returns:
+  dict: the plan
+  '''
+  plan = {
+    'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'region': region,
+    'action': action,
+    'tag': tag_key,
+    'start': [],
+    'stop': [],
+    'leave': [],
+  }
+  resources = [ ('ec2', 'instance', instance['state'], instance) for instance in ec2_instances ] + \
+    [ ('rds', resource['kind'], resource['status'], resource) for resource in rds_resources ]
+  for service, kind, state, resource in resources:
+    entry = {'service': service, 'kind': kind, 'id': resource['id']}
+    from_state = ACTION_FROM_STATES[action][service]
+    if resource['tags'].get(tag_key) not in [ 'true' ]:
+      plan['leave'].append(dict(entry, reason=f'not tagged {tag_key}=true'))
+    elif state != from_state:
+      plan['leave'].append(dict(entry, reason=f'tagged {tag_key}=true but {state}, not {from_state}'))
+    else:
+      plan[action].append(dict(entry, reason=f'tagged {tag_key}=true and {state}'))
+  print(f'[INFO] Plan: {len(plan["start"])} to start, {len(plan["stop"])} to stop, {len(plan["leave"])} left alone')
+  return plan
+
+def save_plan(plan, location):
+  '''
+  Write the plan to a local path or s3://bucket/key.
+  '''
+  body = json.dumps(plan, indent=2)
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json')
+  else:
+    with open(location, 'w') as f:
+      f.write(body)
+  print(f'[INFO] Plan saved to {location}')
+
+def load_plan(location):
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    return json.loads(boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+  with open(location) as f:
+    return json.load(f)
+
+def execute_plan(ec2, rds, plan, action=None, tag_key=None):
+  '''
+  Start and stop the resources of the plan, with the chunked and concurrent
+  calls of ec2_act / rds_act and no discovery. Resources whose state changed
+  since the plan was made are reported by the failed calls.
+
+  Parameters:
+  rds (RDS.Client): None for a scheduler that only handles EC2; plans with
+                    RDS entries are then rejected
+  action, tag_key (str): when given, the plan must have been built for this
+                         action and tag (see build_plan)
+
+  Returns:
+  dict: {'start': {'ec2', 'rds'}, 'stop': {'ec2', 'rds'}} ids acted on
+  '''
+  if plan.get('region') and plan['region'] != ec2.meta.region_name:
+    raise Exception(f'[ERROR] The plan is for region {plan["region"]}, not {ec2.meta.region_name}')
+  if action is not None and plan.get('action') != action:
+    raise Exception(f'[ERROR] The plan is a {plan.get("action")} plan, not a {action} plan')
+  if tag_key is not None and plan.get('tag') != tag_key:
+    raise Exception(f'[ERROR] The plan is for tag {plan.get("tag")}, not {tag_key}')
+  if rds is None and any(entry['service'] == 'rds' for entry in plan.get('start', []) + plan.get('stop', [])):
+    raise Exception('[ERROR] The plan has RDS entries, this scheduler only handles EC2')
+
+  result = {}
+  for action in [ 'start', 'stop' ]:
+    entries = plan.get(action, [])
+    result[action] = {
+      'ec2': ec2_act(ec2, action, [ entry['id'] for entry in entries if entry['service'] == 'ec2' ]),
+      'rds': rds_act(rds, action, [ entry for entry in entries if entry['service'] == 'rds' ]),
+    }
+  return result
@@ -1,51 +1,110 @@
-import json, boto3
+import json, boto3, time
+import config_event_batch
+import tag_policy
 from botocore.exceptions import ClientError
 s3 = boto3.client('s3')
 config = boto3.client('config')
 
-required_tags = [
-  { 'Key': 'ApplicationID', 'Value': [] }
-]
-    
-def check_tags(tag_set):
-  existing_keys = [ tag['Key'] for tag in tag_set ]
-  required_keys = [ tag['Key'] for tag in required_tags ]
-  
-  if not all( tag_key in existing_keys for tag_key in required_keys ):
-    return False
-  
-  for required_tag in required_tags:
-    matched_tag = next( tag for tag in tag_set if tag['Key'] == required_tag['Key'] )
-      
-    if len(required_tag['Value']) > 0 and matched_tag not in required_tag['Value']:
-      return False
-      
-  return True
-  
-  
+# Used when the rule parameters define no tag policy, see tag_policy.py
+DEFAULT_TAG_POLICY = {
+  'ApplicationID': {}
+}
+
+
+# get_bucket_tagging results per bucket: (CI capture time, expiry, TagSet or
+# None when the bucket has no tags). Re-deliveries of the same configuration
+# item within the TTL reuse the result of the warm container.
+BUCKET_TAGGING_CACHE_TTL_SECONDS = 300
+BUCKET_TAGGING_CACHE = {}
+
+def ci_tags(config_item):
+  '''
+  Tags of the bucket as delivered in the configuration item.
+
+  Returns:
+  dict: the tags (empty if the CI states the bucket has none), or None when
+        the configuration item does not carry them
+  '''
+  tags = config_item.get('tags')
+  if tags:
+    return tags
+
+  supplementary = config_item.get('supplementaryConfiguration')
+  if supplementary is None:
+    return None
+  tagging = supplementary.get('BucketTaggingConfiguration')
+  if isinstance(tagging, str):
+    tagging = json.loads(tagging)
+  if tagging:
+    merged = {}
+    for tag_set in tagging.get('tagSets', []):
+      merged.update(tag_set.get('tags', {}))
+    return merged
+  return tags
+
+def get_bucket_tagging(bucket, capture_time):
+  '''
+  TagSet of the bucket from the S3 API, cached per bucket and CI capture
+  time. Returns None when the bucket has no tags.
+
+  Raises:
+  ClientError: get_bucket_tagging failed for another reason than NoSuchTagSet
+  '''
+  now = time.time()
+  cached = BUCKET_TAGGING_CACHE.get(bucket)
+  if cached and cached[0] == capture_time and cached[1] > now:
+    return cached[2]
+
+  try:
+    tag_set = s3.get_bucket_tagging(Bucket = bucket)['TagSet']
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'NoSuchTagSet':
+      print('Exception when getting tags for bucket: ', bucket)
+      raise
+    tag_set = None
+  BUCKET_TAGGING_CACHE[bucket] = (capture_time, now + BUCKET_TAGGING_CACHE_TTL_SECONDS, tag_set)
+  return tag_set
+
+
+def evaluate_config_item(config_item, rule_parameters, policy=None):
+  '''
+  Evaluate the tags of the bucket of one configuration item.
+
+  Returns:
+  dict: compliance_type and annotation for AWS Config
+  '''
+  policy = policy or tag_policy.get_policy(rule_parameters, DEFAULT_TAG_POLICY)
+  bucket = (config_item.get('configuration') or {}).get('name') or config_item['resourceName']
+
+  # Config already delivers the bucket tags; only ask S3 when it did not
+  tags = ci_tags(config_item)
+  if tags is None:
+    print('No tags in the configuration item, calling get_bucket_tagging for ', bucket)
+    try:
+      tags = get_bucket_tagging(bucket, config_item['configurationItemCaptureTime'])
+    except ClientError as e:
+      print('e:', e)
+      return {'compliance_type': 'NON_COMPLIANT', 'annotation': 'evaluation failure on resource ' + bucket}
+
+  print('taggings of bucket ', bucket, ': ', tags)
+  if not tags:
+    print('No tag set for ', bucket)
+    return {'compliance_type': 'NON_COMPLIANT', 'annotation': bucket + ' does not have any taggings'}
+
+  result = policy.evaluate(tags)
+  return {
+    'compliance_type': 'COMPLIANT' if result['valid'] else 'NON_COMPLIANT',
+    'annotation': tag_policy.annotation(result)
+  }
+
+
 def lambda_handler(event, context):
   if event and 'invokingEvent' in event:
     invoking_event = json.loads(event['invokingEvent'])
     config_item = invoking_event['configurationItem']
-    bucket = config_item['configuration']['name']
-    
-    app_id_tag_compliance = 'COMPLIANT'
-    compliance_msg = ''
-    try:
-      tag_set = s3.get_bucket_tagging(Bucket = bucket)['TagSet']
-      print('taggings of bucket ', bucket, ': ', tag_set)
-      if check_tags(tag_set):
-        app_id_tag_compliance = 'COMPLIANT'
-        compliance_msg = 'All tags are set appropriately'
-      else:
-        app_id_tag_compliance = 'NON_COMPLIANT'
-        compliance_msg = 'Some tags are missing'
-    except ClientError as e:
-      print('Exception when getting tags for bucket: ', bucket)
-      if e.response['Error']['Code'] == 'NoSuchTagSet':
-        print('No tag set for ', bucket)
-        app_id_tag_compliance = 'NON_COMPLIANT'
-        compliance_msg = bucket + ' does not have any taggings'
+    evaluation = evaluate_config_item(config_item, json.loads(event.get('ruleParameters') or '{}'))
+    app_id_tag_compliance = evaluation['compliance_type']
+    compliance_msg = evaluation['annotation']
   else:
     raise Exception('[ERROR] event argument not passed in lambda handler')
   
@@ -63,3 +122,5 @@ def lambda_handler(event, context):
      ResultToken=event['resultToken']
   )
 
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_config_item, lambda_handler)
@@ -0,0 +1,212 @@
+import datetime
+import json
+import os
+import boto3
+from zoneinfo import ZoneInfo
+
+# Schedule expressions read from the Schedule tag of EC2 and RDS resources.
+#
+# A resource is on during its time windows on its weekdays, in its time
+# zone, and off otherwise. The expression is a space separated list of
+# (tag values cannot hold commas or semicolons, lists use "+"):
+#
+#   weekdays     mon-fri, sat+sun, daily (default: daily)
+#   windows      08:00-20:00, 07:30-12:00+13:00-19:00, 22:00-06:00 (a window
+#                ending before it starts runs past midnight); required
+#   tz=<zone>    IANA time zone, e.g. tz=Asia/Hong_Kong (default:
+#                SCHEDULE_DEFAULT_TZ, else UTC)
+#   holidays=on  keep the schedule on holidays; by default the resource is
+#                off on the dates of the holiday calendar
+#
+# e.g. "mon-fri 08:00-20:00 tz=Asia/Hong_Kong"
+#
+# Each distinct expression is compiled once per container. ScheduleIndex
+# groups the resources of a run by expression, so the desired state is
+# computed once per expression and then looked up per resource.
+
+SCHEDULE_TAG = 'Schedule'
+DEFAULT_TIME_ZONE = os.environ.get('SCHEDULE_DEFAULT_TZ', 'UTC')
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# --
+# Parsing
+# --
+
+def parse_minutes(value):
+  hours, minutes = value.split(':')
+  minutes = int(hours) * 60 + int(minutes)
+  if not 0 <= minutes <= 24 * 60:
+    raise ValueError(f'invalid time {value}')
+  return minutes
+
+def parse_weekdays(token):
+  if token == 'daily':
+    return frozenset(range(7))
+  days = set()
+  for part in token.split('+'):
+    if '-' in part:
+      first, last = (WEEKDAYS.index(day) for day in part.split('-'))
+      day = first
+      days.add(day)
+      while day != last:
+        day = (day + 1) % 7
+        days.add(day)
+    else:
+      days.add(WEEKDAYS.index(part))
+  return frozenset(days)
+
+class Schedule:
+  '''
+  Compiled schedule expression.
+
+  Parameters:
+  expression (str): see the module comment
+
+  Raises:
+  ValueError: the expression is invalid
+  '''
+
+  def __init__(self, expression):
+    self.expression = expression
+    self.weekdays = frozenset(range(7))
+    self.windows = []
+    self.time_zone = ZoneInfo(DEFAULT_TIME_ZONE)
+    self.observe_holidays = True
+
+    for original in expression.split():
+      token = original.lower()
+      if token.startswith('tz='):
+        # zone names are case sensitive
+        self.time_zone = ZoneInfo(original[len('tz='):])
+      elif token.startswith('holidays='):
+        self.observe_holidays = token[len('holidays='):] != 'on'
+      elif token[0].isdigit():
+        for window in token.split('+'):
+          start, end = window.split('-')
+          self.windows.append((parse_minutes(start), parse_minutes(end)))
+      else:
+        try:
+          self.weekdays = parse_weekdays(token)
+        except ValueError:
+          raise ValueError(f'unknown token {token}')
+    if not self.windows:
+      raise ValueError('no time window')
+
+  def is_on(self, now, holidays=frozenset()):
+    '''
+    Parameters:
+    now (datetime): timezone aware current time
+    holidays (frozenset): datetime.date of the holiday calendar
+
+    Returns:
+    bool: True if the resource should be on at now
+    '''
+    local = now.astimezone(self.time_zone)
+    minute = local.hour * 60 + local.minute
+    today = local.date()
+    yesterday = today - datetime.timedelta(days=1)
+
+    def working_day(day):
+      return day.weekday() in self.weekdays and not (self.observe_holidays and day in holidays)
+
+    for start, end in self.windows:
+      if start <= end:
+        if start <= minute < end and working_day(today):
+          return True
+      else:
+        # Runs past midnight: the evening part belongs to today, the morning
+        # part to the window that started yesterday
+        if minute >= start and working_day(today):
+          return True
+        if minute < end and working_day(yesterday):
+          return True
+    return False
+
+# Compiled schedules by expression, None for invalid ones
+SCHEDULE_CACHE = {}
+
+def compile_schedule(expression):
+  if expression not in SCHEDULE_CACHE:
+    try:
+      SCHEDULE_CACHE[expression] = Schedule(expression)
+    except (ValueError, KeyError) as e:
+      print(f'[WARN] Invalid schedule {expression!r}: {e}')
+      SCHEDULE_CACHE[expression] = None
+  return SCHEDULE_CACHE[expression]
+
+# --
+# Holiday calendar
+# --
+
+HOLIDAY_CACHE = {}
+
+def load_holidays(location=None):
+  '''
+  The holiday calendar, once per container: a JSON list of YYYY-MM-DD dates
+  or a text file with one date per line (# starts a comment).
+
+  Parameters:
+  location (str): local path (packaged with the function) or s3://bucket/key,
+                  defaults to the HOLIDAY_CALENDAR environment variable
+
+  Returns:
+  frozenset: datetime.date of every holiday (empty without a calendar)
+  '''
+  location = location or os.environ.get('HOLIDAY_CALENDAR')
+  if not location:
+    return frozenset()
+  if location in HOLIDAY_CACHE:
+    return HOLIDAY_CACHE[location]
+
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    content = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+  else:
+    with open(location) as f:
+      content = f.read()
+
+  if content.lstrip().startswith('['):
+    values = json.loads(content)
+  else:
+    values = [ line.split('#')[0].strip() for line in content.splitlines() ]
+  holidays = frozenset(datetime.date.fromisoformat(value) for value in values if value)
+
+  HOLIDAY_CACHE[location] = holidays
+  return holidays
+
+# --
+# Index
+# --
+
+class ScheduleIndex:
+  '''
+  The resources of one run grouped by their compiled schedule.
+
+  Parameters:
+  resources (list): inventory entries with 'id' and 'tags' (see
+                    resource_scheduler); resources without a valid Schedule
+                    tag are left out and listed in unscheduled
+  '''
+
+  def __init__(self, resources):
+    self.groups = {}
+    self.unscheduled = []
+    for resource in resources:
+      expression = resource['tags'].get(SCHEDULE_TAG)
+      schedule = compile_schedule(expression) if expression else None
+      if schedule is None:
+        self.unscheduled.append(resource)
+      else:
+        self.groups.setdefault(schedule, []).append(resource)
+
+  def desired_states(self, now, holidays=frozenset()):
+    '''
+    Returns:
+    dict: resource id -> True (on) / False (off)
+    '''
+    desired = {}
+    for schedule, resources in self.groups.items():
+      on = schedule.is_on(now, holidays)
+      for resource in resources:
+        desired[resource['id']] = on
+    return desired
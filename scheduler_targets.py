@@ -0,0 +1,130 @@
+import boto3
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import threading
+from botocore.config import Config
+
+# Account x region fan-out for the resource schedulers.
+#
+# Every target (account, region) gets its own clients, created from
+# credentials of the role SCHEDULER_ROLE_NAME assumed in the account. The
+# credentials are cached per account until CREDENTIALS_REFRESH_SECONDS before
+# they expire, so a run over many regions of one account assumes the role
+# once and a warm container reuses it across runs.
+#
+# Each target's clients have their own adaptive retry rate limiter, so a
+# throttled account or region slows down on its own without holding back the
+# others (the per-target throttling budget); TARGET_MAX_WORKERS bounds how
+# many targets are worked on at the same time.
+
+SCHEDULER_ROLE_NAME = os.environ.get('SCHEDULER_ROLE_NAME', 'resource-scheduler')
+CREDENTIALS_REFRESH_SECONDS = 300
+TARGET_MAX_WORKERS = int(os.environ.get('TARGET_MAX_WORKERS', '10'))
+TARGET_CLIENT_CONFIG = Config(
+  retries={'max_attempts': 10, 'mode': 'adaptive'},
+  max_pool_connections=16)
+
+# account id -> (expiration, boto3 Session)
+SESSION_CACHE = {}
+# account id -> lock held while the account's session is looked up or
+# created, so the regions of one account assume the role once while the
+# other accounts go ahead
+SESSION_LOCKS = {}
+SESSION_LOCKS_LOCK = threading.Lock()
+# Sessions are shared by the threads, client creation is not thread safe
+CLIENT_LOCK = threading.Lock()
+CALLER_ACCOUNT = None
+
+def caller_account():
+  global CALLER_ACCOUNT
+  if CALLER_ACCOUNT is None:
+    with CLIENT_LOCK:
+      sts = boto3.client('sts')
+    CALLER_ACCOUNT = sts.get_caller_identity()['Account']
+  return CALLER_ACCOUNT
+
+def session_for(account_id):
+  '''
+  boto3 session for the account: the Lambda's own credentials for its own
+  account, otherwise the cached assumed role session.
+  '''
+  with SESSION_LOCKS_LOCK:
+    account_lock = SESSION_LOCKS.setdefault(account_id, threading.Lock())
+  with account_lock:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cached = SESSION_CACHE.get(account_id)
+    if cached is not None and (cached[0] - now).total_seconds() > CREDENTIALS_REFRESH_SECONDS:
+      return cached[1]
+
+    if account_id == caller_account():
+      # The Lambda's own credentials are refreshed by botocore
+      session = boto3.session.Session()
+      SESSION_CACHE[account_id] = (datetime.datetime.max.replace(tzinfo=datetime.timezone.utc), session)
+      return session
+
+    with CLIENT_LOCK:
+      sts = boto3.client('sts')
+    credentials = sts.assume_role(
+      RoleArn=f'arn:aws:iam::{account_id}:role/{SCHEDULER_ROLE_NAME}',
+      RoleSessionName='resource-scheduler'
+    )['Credentials']
+    session = boto3.session.Session(
+      aws_access_key_id=credentials['AccessKeyId'],
+      aws_secret_access_key=credentials['SecretAccessKey'],
+      aws_session_token=credentials['SessionToken'])
+    SESSION_CACHE[account_id] = (credentials['Expiration'], session)
+    return session
+
+def clients(target):
+  '''
+  The EC2 and RDS clients of one target.
+
+  Returns:
+  tuple: (EC2.Client, RDS.Client)
+  '''
+  session = session_for(target['account'])
+  with CLIENT_LOCK:
+    return (
+      session.client('ec2', region_name=target['region'], config=TARGET_CLIENT_CONFIG),
+      session.client('rds', region_name=target['region'], config=TARGET_CLIENT_CONFIG),
+    )
+
+def load_targets(event):
+  '''
+  The account x region matrix, from the event or else the SCHEDULER_TARGETS
+  environment variable (same JSON format):
+
+    {"accounts": ["111111111111", ...], "regions": ["ap-southeast-1", ...]}
+
+  An explicit "targets" list of {"account", "region"} is used as is.
+  Without accounts, the Lambda's own account is the only one.
+  '''
+  matrix = event if event and ('accounts' in event or 'regions' in event or 'targets' in event) \
+    else json.loads(os.environ.get('SCHEDULER_TARGETS') or '{}')
+  if matrix.get('targets'):
+    return matrix['targets']
+  accounts = matrix.get('accounts') or [ caller_account() ]
+  regions = matrix.get('regions') or [ boto3.session.Session().region_name ]
+  return [ {'account': account, 'region': region} for account, region in itertools.product(accounts, regions) ]
+
+def run_targets(targets, work):
+  '''
+  Run work(target, ec2, rds) for every target, TARGET_MAX_WORKERS at a time.
+  A failing target is reported and does not stop the others.
+
+  Returns:
+  list: {'account', 'region', 'result'} or {'account', 'region', 'error'} per target
+  '''
+  def run(target):
+    try:
+      ec2, rds = clients(target)
+      return dict(target, result=work(target, ec2, rds))
+    except Exception as e:
+      print(f'[ERROR] {target["account"]}/{target["region"]}: {e}')
+      return dict(target, error=str(e))
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=TARGET_MAX_WORKERS) as executor:
+    return list(executor.map(run, targets))
@@ -1,6 +1,9 @@
 import boto3
 import botocore
+import config_event_batch
 import json
+import resource_context
+import sg_policy
 
 APPLICABLE_RESOURCES = ["AWS::EC2::SecurityGroup"]
 
@@ -16,6 +19,9 @@ ALLOWED_PERMISSIONS = [
     "ToPort" : 443,
 }]
 
+ALLOWED_INDEX = sg_policy.PortRangeIndex(ALLOWED_PERMISSIONS)
+
+
 # Helper function used to validate input
 def check_defined(reference, reference_name):
     if not reference:
@@ -27,7 +33,7 @@ def check_defined(reference, reference_name):
 # Normalize all rule parameters so we can handle them consistently.
 # All keys are stored in lower case.  Only boolean and numeric keys are stored.
 def normalize_parameters(rule_parameters):
-    for key, value in rule_parameters.items():
+    for key, value in list(rule_parameters.items()):
         normalized_key=key.lower()
         normalized_value=value.lower()
 
@@ -76,57 +82,107 @@ def evaluate_compliance(configuration_item, debug_enabled):
             "annotation": "The configurationItem was deleted and therefore cannot be validated."
         }
 
-    group_id = configuration_item["configuration"]["groupId"]
-    client = boto3.client("ec2");
+    group_id = configuration_item["resourceId"]
 
-    print ("evaluating CI: ", configuration_item)
     print ("Evaluating security group: ", group_id)
 
+    return evaluate_context(resource_context.SecurityGroupContext(configuration_item), debug_enabled)
+
+# evaluate_context
+#
+# Evaluate an applicable, existing security group. The ingress rules come from
+# the context, which may be shared with the other security group rules (see
+# config-rule-dispatcher.py).
+def evaluate_context(context, debug_enabled=False):
     try:
-        response = client.describe_security_groups(GroupIds=[group_id])
+        ip_permissions = context.ip_permissions()
     except botocore.exceptions.ClientError as e:
         print("e:", e)
         return {
             "compliance_type" : "NON_COMPLIANT",
-            "annotation" : "describe_security_groups failure on group " + group_id
+            "annotation" : "describe_security_groups failure on group " + context.group_id
         }
-    print ("Security Group Details: ", response)
 
     if debug_enabled:
-        print("security group definition: ", json.dumps(response, indent=2))
-
-    ip_permissions = response["SecurityGroups"][0]["IpPermissions"]
-    
-    for item in ip_permissions:
-        if len(item["IpRanges"]) > 0:
-            ip_ranges = item["IpRanges"][0]["CidrIp"]
-            print("ip_ranges: ", ip_ranges)
-            if ip_ranges == "0.0.0.0/0" and not item["IpProtocol"] == "icmp":
-                print("source ip is any:", group_id)
-                try:
-                    source = {"IpProtocol" : item["IpProtocol"], "FromPort" : item["FromPort"], "ToPort" : item["ToPort"]}
-                    print("source detail:", source)
-                    if not source in ALLOWED_PERMISSIONS:
-                        return {
-                            "compliance_type" : "NON_COMPLIANT",
-                            "annotation" : "security_groups_check failure on group " + group_id + " due to this ingress (" + json.dumps(source) + ") is opening to all internet (0.0.0.0/0)"
-                        }
-                except botocore.exceptions.ClientError as e:
-                    print("e:", e)
+        print("security group ingress rules: ", json.dumps(ip_permissions, indent=2))
+
+    return evaluate_ip_permissions(context.group_id, ip_permissions)
+
+# evaluate_ip_permissions
+#
+# Check the ingress rules of one security group against ALLOWED_PERMISSIONS.
+# Shared by the change-triggered and the periodic (sweep) evaluation paths.
+#
+# Arguments:
+#
+# group_id - the security group id, used in the annotation
+# ip_permissions - the IpPermissions list as returned by describe_security_groups
+def evaluate_ip_permissions(group_id, ip_permissions):
+    violations = sg_policy.find_public_violations([(group_id, ip_permissions)], allowed=ALLOWED_INDEX)
+    return build_evaluation(group_id, violations[group_id])
+
+# build_evaluation
+#
+# Turn the result of sg_policy.find_public_violations for one group into a
+# compliance_type / annotation pair.
+def build_evaluation(group_id, violation):
+    if violation is not None:
+        protocol, from_port, to_port, cidr = violation
+        source = {"IpProtocol" : protocol, "FromPort" : from_port, "ToPort" : to_port}
+        print("source detail:", source, cidr)
+        return {
+            "compliance_type" : "NON_COMPLIANT",
+            "annotation" : "security_groups_check failure on group " + group_id + " due to this ingress (" + json.dumps(source) + ") is opening to all internet (" + cidr + ")"
+        }
 
     return {
         "compliance_type": "COMPLIANT",
         "annotation": "security_groups_check pass on group " + group_id
     }
 
+# evaluate_all_security_groups
+#
+# Periodic (sweep) evaluation. Pages through describe_security_groups once and
+# evaluates every group of the account/region in memory, instead of one
+# describe_security_groups call per configuration change notification.
+#
+# return values:
+#
+# a list of evaluations ready for put_evaluations
+def evaluate_all_security_groups(ordering_timestamp, debug_enabled):
+    client = boto3.client("ec2")
+    paginator = client.get_paginator("describe_security_groups")
+
+    groups = []
+    for page in paginator.paginate(PaginationConfig={"PageSize": 1000}):
+        for group in page["SecurityGroups"]:
+            if debug_enabled:
+                print("security group definition: ", json.dumps(group, indent=2))
+            groups.append((group["GroupId"], group["IpPermissions"]))
+
+    violations = sg_policy.find_public_violations(groups, allowed=ALLOWED_INDEX)
+
+    evaluations = []
+    for group_id, ip_permissions in groups:
+        evaluation = build_evaluation(group_id, violations[group_id])
+        evaluations.append({
+            'ComplianceResourceType': APPLICABLE_RESOURCES[0],
+            'ComplianceResourceId': group_id,
+            'ComplianceType': evaluation["compliance_type"],
+            "Annotation": evaluation["annotation"],
+            'OrderingTimestamp': ordering_timestamp
+        })
+
+    print("Evaluated security groups: ", len(evaluations))
+    return evaluations
+
 def lambda_handler(event, context):
     check_defined(event, 'event')
     invoking_event = json.loads(event['invokingEvent'])
 
     check_defined(invoking_event, 'invokingEvent')
-    configuration_item = invoking_event["configurationItem"]
 
-    rule_parameters = normalize_parameters(json.loads(event["ruleParameters"]))
+    rule_parameters = normalize_parameters(json.loads(event.get("ruleParameters", "{}")))
 
     debug_enabled = False
 
@@ -136,19 +192,32 @@ def lambda_handler(event, context):
     if debug_enabled:
         print("Received event: " + json.dumps(event, indent=2))
 
-    evaluation = evaluate_compliance(configuration_item, debug_enabled)
-
     config = boto3.client('config')
 
+    # Periodic trigger: sweep every security group in one invocation
+    if invoking_event["messageType"] == "ScheduledNotification":
+        evaluations = evaluate_all_security_groups(invoking_event["notificationCreationTime"], debug_enabled)
+        config_event_batch.put_evaluations_in_chunks(config, evaluations, event['resultToken'])
+        return
+
+    configuration_item = config_event_batch.configuration_item_of(invoking_event)
+
+    evaluation = evaluate_compliance(configuration_item, debug_enabled)
+
     response = config.put_evaluations(
        Evaluations=[
            {
-               'ComplianceResourceType': invoking_event['configurationItem']['resourceType'],
-               'ComplianceResourceId': invoking_event['configurationItem']['resourceId'],
+               'ComplianceResourceType': configuration_item['resourceType'],
+               'ComplianceResourceId': configuration_item['resourceId'],
                'ComplianceType': evaluation["compliance_type"],
                "Annotation": evaluation["annotation"],
-               'OrderingTimestamp': invoking_event['configurationItem']['configurationItemCaptureTime']
+               'OrderingTimestamp': configuration_item['configurationItemCaptureTime']
            },
        ],
        ResultToken=event['resultToken'])
 
+def evaluate_event(configuration_item, rule_parameters):
+    debug_enabled = normalize_parameters(dict(rule_parameters)).get("debug", False)
+    return evaluate_compliance(configuration_item, debug_enabled)
+
+sqs_handler = config_event_batch.sqs_handler(evaluate_event, lambda_handler)
@@ -0,0 +1,268 @@
+import bisect
+import ipaddress
+
+# Shared port-range policy engine used by the security group rules
+# (security-group.py, jumphost-checker.py).
+#
+# A permission list such as ALLOWED_PERMISSIONS / UNALLOWED_PERMISSIONS is
+# compiled once per container into a PortRangeIndex: for every protocol a
+# sorted list of merged, disjoint [FromPort, ToPort] intervals.  Single
+# lookups are a bisect (O(log n)); the *_many batch variants sort the queries
+# once and sweep them against the intervals in a single pass.
+
+ALL_PROTOCOLS = "-1"
+MIN_PORT = 0
+MAX_PORT = 65535
+
+# IpProtocol may be given as a name or as a protocol number
+PROTOCOL_NAMES = {
+    "6": "tcp",
+    "17": "udp",
+    "1": "icmp",
+    "58": "icmpv6",
+}
+
+# ICMP rules carry type/code in FromPort/ToPort, not ports
+ICMP_PROTOCOLS = ["icmp", "icmpv6"]
+
+# A CIDR counts as open to the internet when it is not private and its
+# prefix is not longer than this limit (0 means only 0.0.0.0/0 and ::/0).
+PUBLIC_PREFIX_LIMITS = {
+    4: 0,
+    6: 0,
+}
+
+# normalize_protocol
+#
+# Map an IpProtocol value to a lower case protocol name.
+def normalize_protocol(protocol):
+    protocol = str(protocol).lower()
+    return PROTOCOL_NAMES.get(protocol, protocol)
+
+# rule_port_range
+#
+# Return (protocol, from_port, to_port) for one IpPermissions entry or one
+# ALLOWED/UNALLOWED permission.  "All traffic" rules and rules without ports
+# span the whole port range.
+def rule_port_range(permission):
+    protocol = normalize_protocol(permission["IpProtocol"])
+    from_port = permission.get("FromPort")
+    to_port = permission.get("ToPort")
+    if protocol == ALL_PROTOCOLS or from_port is None or from_port < 0:
+        from_port = MIN_PORT
+    if protocol == ALL_PROTOCOLS or to_port is None or to_port < 0:
+        to_port = MAX_PORT
+    return (protocol, from_port, to_port)
+
+# is_public_cidr
+#
+# True if the CIDR is open to the internet according to PUBLIC_PREFIX_LIMITS.
+def is_public_cidr(cidr, prefix_limits=PUBLIC_PREFIX_LIMITS):
+    network = ipaddress.ip_network(cidr, strict=False)
+    if network.is_private:
+        return False
+    return network.prefixlen <= prefix_limits[network.version]
+
+# public_cidrs
+#
+# Return every public IPv4 and IPv6 CIDR of an IpPermissions entry.
+def public_cidrs(permission, prefix_limits=PUBLIC_PREFIX_LIMITS):
+    cidrs = [ip_range["CidrIp"] for ip_range in permission.get("IpRanges", [])]
+    cidrs += [ip_range["CidrIpv6"] for ip_range in permission.get("Ipv6Ranges", [])]
+    return [cidr for cidr in cidrs if is_public_cidr(cidr, prefix_limits)]
+
+# merge_intervals
+#
+# Sort and merge overlapping or adjacent port intervals.
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+class PortRangeIndex:
+    '''
+    Per-protocol sorted interval index compiled from a permission list.
+
+    Parameters:
+    permissions (list): dicts with IpProtocol, FromPort and ToPort
+    '''
+
+    def __init__(self, permissions):
+        by_protocol = {}
+        for permission in permissions:
+            protocol, from_port, to_port = rule_port_range(permission)
+            by_protocol.setdefault(protocol, []).append((from_port, to_port))
+
+        # "All traffic" entries apply to every protocol
+        any_protocol = by_protocol.pop(ALL_PROTOCOLS, [])
+
+        self.intervals = {}
+        for protocol, intervals in by_protocol.items():
+            self.intervals[protocol] = self._compile(intervals + any_protocol)
+        self.any_protocol = self._compile(any_protocol)
+
+    @staticmethod
+    def _compile(intervals):
+        merged = merge_intervals(intervals)
+        return ([start for start, end in merged], [end for start, end in merged])
+
+    def _lookup(self, protocol):
+        return self.intervals.get(protocol, self.any_protocol)
+
+    def overlaps(self, protocol, from_port, to_port):
+        '''
+        True if [from_port, to_port] shares at least one port with the index.
+        '''
+        protocol = normalize_protocol(protocol)
+        if protocol == ALL_PROTOCOLS:
+            return any(starts for starts, ends in self.intervals.values()) or bool(self.any_protocol[0])
+        starts, ends = self._lookup(protocol)
+        i = bisect.bisect_left(ends, from_port)
+        return i < len(starts) and starts[i] <= to_port
+
+    def covers(self, protocol, from_port, to_port):
+        '''
+        True if every port of [from_port, to_port] is inside the index.
+        '''
+        protocol = normalize_protocol(protocol)
+        starts, ends = self.any_protocol if protocol == ALL_PROTOCOLS else self._lookup(protocol)
+        i = bisect.bisect_left(ends, from_port)
+        return i < len(starts) and starts[i] <= from_port and ends[i] >= to_port
+
+    def overlaps_many(self, ranges):
+        '''
+        Batch variant of overlaps.
+
+        Parameters:
+        ranges (list): (protocol, from_port, to_port) tuples
+
+        Returns:
+        list: one bool per entry of ranges, in the same order
+        '''
+        return self._sweep(ranges, self.overlaps, lambda starts, ends, i, from_port, to_port:
+            i < len(starts) and starts[i] <= to_port)
+
+    def covers_many(self, ranges):
+        '''
+        Batch variant of covers.
+
+        Parameters:
+        ranges (list): (protocol, from_port, to_port) tuples
+
+        Returns:
+        list: one bool per entry of ranges, in the same order
+        '''
+        return self._sweep(ranges, self.covers, lambda starts, ends, i, from_port, to_port:
+            i < len(starts) and starts[i] <= from_port and ends[i] >= to_port)
+
+    def _sweep(self, ranges, single, test):
+        # Group the queries per protocol and sort them by FromPort, so that a
+        # single forward pass over the intervals answers all of them.
+        results = [False] * len(ranges)
+        by_protocol = {}
+        for position, (protocol, from_port, to_port) in enumerate(ranges):
+            protocol = normalize_protocol(protocol)
+            if protocol == ALL_PROTOCOLS:
+                results[position] = single(protocol, from_port, to_port)
+                continue
+            by_protocol.setdefault(protocol, []).append((from_port, to_port, position))
+
+        for protocol, queries in by_protocol.items():
+            starts, ends = self._lookup(protocol)
+            queries.sort()
+            i = 0
+            for from_port, to_port, position in queries:
+                while i < len(ends) and ends[i] < from_port:
+                    i += 1
+                results[position] = test(starts, ends, i, from_port, to_port)
+        return results
+
+# public_port_ranges
+#
+# Flatten a list of IpPermissions into the port ranges that are reachable from
+# a public CIDR.  ICMP rules are skipped.
+#
+# return values:
+#
+# a list of (protocol, from_port, to_port, cidr, permission) tuples
+def public_port_ranges(ip_permissions, prefix_limits=PUBLIC_PREFIX_LIMITS):
+    ranges = []
+    for permission in ip_permissions:
+        protocol, from_port, to_port = rule_port_range(permission)
+        if protocol in ICMP_PROTOCOLS:
+            continue
+        for cidr in public_cidrs(permission, prefix_limits):
+            ranges.append((protocol, from_port, to_port, cidr, permission))
+    return ranges
+
+# find_public_violations
+#
+# Evaluate the IpPermissions of many security groups at once.
+#
+# Arguments:
+#
+# groups - a list of (group_id, ip_permissions) tuples
+# allowed - PortRangeIndex; public rules must be fully covered by it
+# forbidden - PortRangeIndex; public rules must not overlap it
+#
+# return values:
+#
+# a dict group_id -> first offending (protocol, from_port, to_port, cidr) or
+# None when the group is compliant
+def find_public_violations(groups, allowed=None, forbidden=None):
+    queries = []
+    owners = []
+    violations = {}
+    for group_id, ip_permissions in groups:
+        violations[group_id] = None
+        for protocol, from_port, to_port, cidr, permission in public_port_ranges(ip_permissions):
+            queries.append((protocol, from_port, to_port))
+            owners.append((group_id, cidr))
+
+    failed = [False] * len(queries)
+    if allowed is not None:
+        failed = [not covered for covered in allowed.covers_many(queries)]
+    if forbidden is not None:
+        failed = [f or hit for f, hit in zip(failed, forbidden.overlaps_many(queries))]
+
+    for (group_id, cidr), query, is_failed in zip(owners, queries, failed):
+        if is_failed and violations[group_id] is None:
+            violations[group_id] = query + (cidr,)
+    return violations
+
+# ci_ip_permissions
+#
+# Read the ingress rules from an AWS::EC2::SecurityGroup configuration item
+# and convert them to the IpPermissions shape of describe_security_groups.
+#
+# return values:
+#
+# the IpPermissions list, or None when the configuration item carries no
+# configuration (oversized change notifications only deliver a summary)
+def ci_ip_permissions(configuration_item):
+    configuration = configuration_item.get("configuration")
+    if not configuration or "ipPermissions" not in configuration:
+        return None
+
+    ip_permissions = []
+    for item in configuration["ipPermissions"]:
+        if "ipv4Ranges" in item:
+            ip_ranges = [{"CidrIp": ip_range["cidrIp"]} for ip_range in item["ipv4Ranges"]]
+        else:
+            ip_ranges = [{"CidrIp": cidr} for cidr in item.get("ipRanges", [])]
+        permission = {
+            "IpProtocol": item["ipProtocol"],
+            "IpRanges": ip_ranges,
+            "Ipv6Ranges": [{"CidrIpv6": ip_range["cidrIpv6"]} for ip_range in item.get("ipv6Ranges", [])],
+        }
+        if item.get("fromPort") is not None:
+            permission["FromPort"] = item["fromPort"]
+        if item.get("toPort") is not None:
+            permission["ToPort"] = item["toPort"]
+        ip_permissions.append(permission)
+    return ip_permissions
@@ -0,0 +1,178 @@
+import json, re, time
+
+# Shared tag policy for tagging-checker.py and s3-bucket-tagging-checker.py.
+#
+# The policy is read from the rule parameters and compiled once per container:
+# every required key gets its regex compiled and its allowed values turned
+# into a set, so evaluating a resource is a few dict lookups per required tag.
+#
+# Rule parameters (all optional, strings as delivered by AWS Config):
+#
+#   TagPolicy  JSON object, key -> options:
+#                regex          value must match this regex
+#                values         list of allowed values
+#                case           "sensitive" (default) or "insensitive", applies
+#                               to the key lookup and to the value checks
+#                split          check every whitespace separated word of the
+#                               value on its own
+#   tag1Key / tag1Value ... tag50Key / tag50Value
+#              same format as the AWS managed required-tags rule: a required
+#              key and an optional comma separated list of allowed values
+
+POLICY_PARAMETER = 'TagPolicy'
+MAX_KEY_PARAMETERS = 50
+
+def parse_policy(rule_parameters, default_policy):
+  '''
+  Build the policy dict (key -> options) from the raw rule parameters.
+
+  Parameters:
+  rule_parameters (dict): raw ruleParameters, before any normalization
+  default_policy (dict): policy used when the parameters define none
+
+  Returns:
+  dict: key -> options
+  '''
+  policy = {}
+  if rule_parameters.get(POLICY_PARAMETER):
+    policy.update(json.loads(rule_parameters[POLICY_PARAMETER]))
+
+  for i in range(1, MAX_KEY_PARAMETERS + 1):
+    key = rule_parameters.get(f'tag{i}Key')
+    if not key:
+      continue
+    options = policy.setdefault(key, {})
+    values = rule_parameters.get(f'tag{i}Value')
+    if values:
+      options['values'] = [value.strip() for value in values.split(',') if value.strip()]
+
+  return policy or default_policy
+
+
+class TagPolicy:
+  '''
+  Compiled tag policy.
+
+  Parameters:
+  policy (dict): key -> options, see the module comment
+  '''
+
+  def __init__(self, policy):
+    self.rules = []
+    self.case_insensitive = False
+    for key, options in policy.items():
+      insensitive = options.get('case', 'sensitive') == 'insensitive'
+      self.case_insensitive = self.case_insensitive or insensitive
+      regex = options.get('regex')
+      pattern = re.compile(regex, re.IGNORECASE if insensitive else 0).match if regex else None
+      values = options.get('values') or []
+      allowed = frozenset(value.lower() for value in values) if insensitive else frozenset(values)
+      self.rules.append((
+        key,
+        key.lower() if insensitive else key,
+        insensitive,
+        pattern,
+        allowed,
+        bool(options.get('split', False)),
+      ))
+    self.required_keys = [rule[0] for rule in self.rules]
+
+  def evaluate(self, tags):
+    '''
+    Check the tags of one resource.
+
+    Parameters:
+    tags (dict or list): {key: value}, or a TagSet list of {'Key', 'Value'}
+
+    Returns:
+    dict:
+      valid (bool): True if every required tag is present and correct
+      missing (list): required keys that are absent
+      wrong (list): keys whose value does not satisfy the policy
+    '''
+    if isinstance(tags, list):
+      tags = {tag['Key']: tag['Value'] for tag in tags}
+    lower_tags = {key.lower(): value for key, value in tags.items()} if self.case_insensitive else None
+
+    missing = []
+    wrong = []
+    for key, lookup_key, insensitive, pattern, allowed, split in self.rules:
+      value = (lower_tags if insensitive else tags).get(lookup_key)
+      if value is None:
+        missing.append(key)
+        continue
+
+      items = value.split() if split else [value]
+      if pattern is not None and (not items or not all(pattern(item) for item in items)):
+        wrong.append(key)
+      elif allowed and (value.lower() if insensitive else value) not in allowed:
+        wrong.append(key)
+
+    return {'valid': not missing and not wrong, 'missing': missing, 'wrong': wrong}
+
+  def evaluate_many(self, resources):
+    '''
+    Batch variant of evaluate.
+
+    Parameters:
+    resources (list): tag dicts or TagSet lists, one per resource
+
+    Returns:
+    list: one evaluate() result per resource, in the same order
+    '''
+    evaluate = self.evaluate
+    return [evaluate(tags) for tags in resources]
+
+
+# Compiled policies keyed by their definition, so a warm container compiles
+# each policy only once.
+POLICY_CACHE = {}
+
+def get_policy(rule_parameters, default_policy):
+  policy = parse_policy(rule_parameters or {}, default_policy)
+  cache_key = json.dumps(policy, sort_keys=True)
+  if cache_key not in POLICY_CACHE:
+    POLICY_CACHE[cache_key] = TagPolicy(policy)
+  return POLICY_CACHE[cache_key]
+
+
+def annotation(result):
+  '''
+  Compliance message for one evaluate() result.
+  '''
+  if result['valid']:
+    return 'All tags are set appropriately'
+  message = ''
+  if len(result['missing']) > 0:
+    message += f"Tags {result['missing']} is/are missing. "
+  if len(result['wrong']) > 0:
+    message += f"Tags {result['wrong']} is/are of wrong format. "
+  return message
+
+
+def benchmark(count=200000):
+  '''
+  Micro-benchmark of evaluate_many over a mix of valid, wrong and untagged
+  resources. Returns the throughput in resources per second.
+  '''
+  policy = TagPolicy({
+    'ApplicationID': {'regex': r'^\d{4}$'},
+    'Environment': {'regex': r'^[DPT]\d{1,3}$|^cp1$|^ct1$', 'split': True},
+    'DataClass': {'values': ['Public', 'Internal', 'Sensitive', 'Highly Sensitive'], 'case': 'insensitive'},
+  })
+  samples = [
+    {'ApplicationID': '1234', 'Environment': 'P1', 'DataClass': 'internal', 'Name': 'web'},
+    {'ApplicationID': '12a4', 'Environment': 'cp1 X9', 'DataClass': 'Secret'},
+    {'Name': 'untagged'},
+    [{'Key': 'ApplicationID', 'Value': '0001'}, {'Key': 'Environment', 'Value': 'T12'}],
+  ]
+  resources = [samples[i % len(samples)] for i in range(count)]
+
+  start = time.perf_counter()
+  policy.evaluate_many(resources)
+  elapsed = time.perf_counter() - start
+  return count / elapsed
+
+
+if __name__ == '__main__':
+  print(f'tag policy throughput: {benchmark():,.0f} resources/sec')
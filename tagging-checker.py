@@ -1,74 +1,418 @@
-import json, boto3, re
+import json, boto3, csv, io, os, random, time
+import config_event_batch
+import tag_policy
+from botocore.config import Config
 from botocore.exceptions import ClientError
 s3 = boto3.client('s3')
 config = boto3.client('config')
 
-required_tags = [
-  { 'Key': 'ApplicationID', 'Regex': '^\d{4}$' },
-  { 'Key': 'Environment', 'Regex': '^[DPT]\d{1,3}$|^cp1$|^ct1$' }
-]
-    
-def check_tags(tags):
-  result =  {'valid':True, 'missing': [], 'wrong': []}
-  existing_keys = tags.keys()
-  required_keys = [ tag['Key'] for tag in required_tags ]
+# Used when the rule parameters define no tag policy, see tag_policy.py
+DEFAULT_TAG_POLICY = {
+  'ApplicationID': { 'regex': '^\\d{4}$', 'split': True },
+  'Environment': { 'regex': '^[DPT]\\d{1,3}$|^cp1$|^ct1$', 'split': True }
+}
+
+def check_tags(tags, policy=None):
+  policy = policy or tag_policy.get_policy({}, DEFAULT_TAG_POLICY)
+  return policy.evaluate(tags)
   
-  for required_key in required_keys:
-    if not required_key in existing_keys:
-      result['missing'].append(required_key)
-      result['valid'] = False
   
-  for required_tag in required_tags:
-    if not required_tag['Key'] in tags:
+# --
+# Periodic sweep
+# --
+
+# Resource types swept by default (Resource Groups Tagging API notation),
+# overridable with the comma separated SweepResourceTypes rule parameter
+DEFAULT_SWEEP_RESOURCE_TYPES = [
+  'ec2:instance', 'ec2:volume', 'ec2:security-group', 'ec2:vpc', 'ec2:subnet',
+  'rds:db', 'rds:cluster', 's3', 'lambda:function', 'dynamodb:table',
+  'elasticloadbalancing:loadbalancer', 'sns'
+]
+
+# (service, ARN resource type) -> AWS Config resource type. The Config
+# resource id is the last part of the ARN unless listed in ARN_RESOURCE_IDS.
+CONFIG_RESOURCE_TYPES = {
+  ('ec2', 'instance'): 'AWS::EC2::Instance',
+  ('ec2', 'volume'): 'AWS::EC2::Volume',
+  ('ec2', 'security-group'): 'AWS::EC2::SecurityGroup',
+  ('ec2', 'vpc'): 'AWS::EC2::VPC',
+  ('ec2', 'subnet'): 'AWS::EC2::Subnet',
+  ('rds', 'db'): 'AWS::RDS::DBInstance',
+  ('rds', 'cluster'): 'AWS::RDS::DBCluster',
+  ('s3', ''): 'AWS::S3::Bucket',
+  ('lambda', 'function'): 'AWS::Lambda::Function',
+  ('dynamodb', 'table'): 'AWS::DynamoDB::Table',
+  ('elasticloadbalancing', 'loadbalancer'): 'AWS::ElasticLoadBalancingV2::LoadBalancer',
+  ('sns', ''): 'AWS::SNS::Topic',
+}
+
+# Config identifies these by ARN instead of name
+ARN_RESOURCE_IDS = ['AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::SNS::Topic']
+
+def config_resource(arn, rds_resource_ids):
+  '''
+  Map a resource ARN to its AWS Config resource type and id.
+
+  Parameters:
+  arn (str): the resource ARN returned by get_resources
+  rds_resource_ids (dict): RDS ARN -> DbiResourceId / DbClusterResourceId
+
+  Returns:
+  tuple: (resource type, resource id), or None for unsupported resources
+  '''
+  parts = arn.split(':', 5)
+  service, resource = parts[2], parts[5]
+  if '/' in resource:
+    arn_type, name = resource.split('/', 1)
+  elif ':' in resource:
+    arn_type, name = resource.split(':', 1)
+  else:
+    arn_type, name = '', resource
+
+  resource_type = CONFIG_RESOURCE_TYPES.get((service, arn_type))
+  if resource_type is None:
+    return None
+  if service == 'elasticloadbalancing' and not name.startswith(('app/', 'net/', 'gwy/')):
+    # Classic load balancer
+    return ('AWS::ElasticLoadBalancing::LoadBalancer', name)
+  if resource_type in ARN_RESOURCE_IDS:
+    return (resource_type, arn)
+  if service == 'rds':
+    # Config knows RDS resources by their resource id, not their name
+    return (resource_type, rds_resource_ids[arn]) if arn in rds_resource_ids else None
+  return (resource_type, name)
+
+def rds_resource_ids():
+  '''
+  ARN -> Config resource id for every RDS instance and cluster, with one
+  paginated describe call each.
+  '''
+  rds = boto3.client('rds')
+  ids = {}
+  for page in rds.get_paginator('describe_db_instances').paginate():
+    for instance in page['DBInstances']:
+      ids[instance['DBInstanceArn']] = instance['DbiResourceId']
+  for page in rds.get_paginator('describe_db_clusters').paginate():
+    for cluster in page['DBClusters']:
+      ids[cluster['DBClusterArn']] = cluster['DbClusterResourceId']
+  return ids
+
+def sweep_evaluations(policy, resource_types, ordering_timestamp, account_id, mapping=None):
+  '''
+  Page through every tagged resource of the given types once and evaluate
+  the tags in memory.
+
+  Note: the Resource Groups Tagging API only returns resources that have (or
+  had) at least one tag; never-tagged resources are still evaluated by the
+  change-triggered path.
+
+  With a remediation mapping, missing tags are derived and applied first and
+  the remediated resources are evaluated with their new tags.
+
+  Returns:
+  list: evaluations ready for put_evaluations
+  '''
+  tagging = boto3.client('resourcegroupstaggingapi')
+  resources = []
+  tag_sets = []
+  for page in tagging.get_paginator('get_resources').paginate(ResourceTypeFilters=resource_types, ResourcesPerPage=100):
+    for tag_mapping in page['ResourceTagMappingList']:
+      resources.append(tag_mapping['ResourceARN'])
+      tag_sets.append(tag_mapping.get('Tags', []))
+
+  rds_ids = rds_resource_ids() if any(':rds:' in arn for arn in resources) else {}
+  results = policy.evaluate_many(tag_sets)
+
+  if mapping is not None:
+    try:
+      vpc_ids = ec2_vpc_ids() if mapping.get('vpcs') else {}
+      candidates = []
+      for arn in resources:
+        resource_id = arn.split(':', 5)[5].split('/')[-1]
+        candidates.append((arn, resource_id, vpc_ids.get(resource_id), arn.split(':')[4] or account_id))
+      fixed = remediate(mapping, candidates, results)
+    except ClientError as e:
+      # Report the pre-remediation results
+      print('[ERROR] Remediation failed: ', e)
+      fixed = {}
+    for i, arn in enumerate(resources):
+      if arn in fixed:
+        tags = {tag['Key']: tag['Value'] for tag in tag_sets[i]}
+        tags.update(fixed[arn])
+        results[i] = policy.evaluate(tags)
+
+  evaluations = []
+  skipped = 0
+  for arn, result in zip(resources, results):
+    resource = config_resource(arn, rds_ids)
+    if resource is None:
+      skipped += 1
       continue
-    
-    matched_tag = tags[required_tag['Key']]
-      
-    pattern = re.compile(required_tag['Regex'])
-    wrong=False
-    for item in matched_tag.split():
-      if not pattern.match(item):
-        wrong = True
-    
-    if wrong:    
-      result['wrong'].append(required_tag['Key'])
-      result['valid'] = False
-  
-  return result
-  
-  
+    evaluations.append({
+      'ComplianceResourceType': resource[0],
+      'ComplianceResourceId': resource[1],
+      'ComplianceType': 'COMPLIANT' if result['valid'] else 'NON_COMPLIANT',
+      'Annotation': tag_policy.annotation(result),
+      'OrderingTimestamp': ordering_timestamp
+    })
+  print(f'Swept {len(resources)} resources, {len(evaluations)} evaluations, {skipped} unsupported')
+  return evaluations
+
+def put_evaluations_by_type(evaluations, result_token):
+  '''
+  Submit the evaluations in chunks (see config_event_batch), each chunk
+  holding a single resource type.
+  '''
+  by_type = {}
+  for evaluation in evaluations:
+    by_type.setdefault(evaluation['ComplianceResourceType'], []).append(evaluation)
+  for resource_type, type_evaluations in sorted(by_type.items()):
+    config_event_batch.put_evaluations_in_chunks(config, type_evaluations, result_token)
+
+# --
+# Remediation
+# --
+
+# tag_resources accepts at most 20 ARNs per call
+TAG_RESOURCES_BATCH_SIZE = 20
+TAG_RESOURCES_MAX_ATTEMPTS = 6
+THROTTLING_ERROR_CODES = ['ThrottlingException', 'Throttling', 'RequestLimitExceeded', 'TooManyRequestsException']
+
+REMEDIATION_MAPPING_CACHE = {}
+
+def load_remediation_mapping(location):
+  '''
+  Load the mapping used to derive missing tags, once per container.
+
+  The JSON file has up to three sections, looked up in this order:
+    "resources": ARN or resource id -> tags (e.g. a CMDB export)
+    "vpcs":      VPC id -> tags
+    "accounts":  account id -> tags
+  A .csv file is read as a CMDB export for the "resources" section: the
+  first column is the ARN or resource id, the other columns are tag keys.
+
+  Parameters:
+  location (str): local path (packaged with the function) or s3://bucket/key
+  '''
+  if location in REMEDIATION_MAPPING_CACHE:
+    return REMEDIATION_MAPPING_CACHE[location]
+
+  if location.startswith('s3://'):
+    bucket, key = location[len('s3://'):].split('/', 1)
+    content = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+  else:
+    with open(location) as f:
+      content = f.read()
+
+  if location.endswith('.csv'):
+    rows = list(csv.reader(io.StringIO(content)))
+    header = rows[0]
+    resources = {}
+    for row in rows[1:]:
+      if row:
+        resources[row[0]] = {key: value for key, value in zip(header[1:], row[1:]) if value}
+    mapping = {'resources': resources}
+  else:
+    mapping = json.loads(content)
+
+  REMEDIATION_MAPPING_CACHE[location] = mapping
+  return mapping
+
+def derive_tags(mapping, missing_keys, arn, resource_id, vpc_id, account_id):
+  '''
+  Values for the missing tag keys of one resource, from the most specific
+  mapping entry that has them (resource, then VPC, then account).
+  '''
+  sources = [
+    mapping.get('resources', {}).get(arn),
+    mapping.get('resources', {}).get(resource_id),
+    mapping.get('vpcs', {}).get(vpc_id) if vpc_id else None,
+    mapping.get('accounts', {}).get(account_id),
+  ]
+  derived = {}
+  for key in missing_keys:
+    for source in sources:
+      if source and key in source:
+        derived[key] = source[key]
+        break
+  return derived
+
+def apply_tags(fixes):
+  '''
+  Apply the derived tags. Resources needing the identical tag set are grouped
+  and tagged with one tag_resources call per TAG_RESOURCES_BATCH_SIZE ARNs.
+  Throttled resources are retried with exponential backoff and jitter on top
+  of the client's adaptive retry mode; other failures are logged and the
+  resources are left untagged.
+
+  Parameters:
+  fixes (dict): ARN -> tags to add
+
+  Returns:
+  set: ARNs that were tagged successfully
+  '''
+  tagging = boto3.client('resourcegroupstaggingapi', config=Config(retries={'max_attempts': 5, 'mode': 'adaptive'}))
+  groups = {}
+  for arn, tags in fixes.items():
+    groups.setdefault(tuple(sorted(tags.items())), []).append(arn)
+
+  tagged = set()
+  calls = 0
+  for tag_set, arns in groups.items():
+    tags = dict(tag_set)
+    for i in range(0, len(arns), TAG_RESOURCES_BATCH_SIZE):
+      pending = arns[i:i + TAG_RESOURCES_BATCH_SIZE]
+      for attempt in range(TAG_RESOURCES_MAX_ATTEMPTS):
+        calls += 1
+        try:
+          failed = tagging.tag_resources(ResourceARNList=pending, Tags=tags).get('FailedResourcesMap', {})
+        except ClientError as e:
+          # Throttled calls are retried, any other error fails the chunk
+          failed = {arn: {'ErrorCode': e.response['Error']['Code'], 'ErrorMessage': e.response['Error'].get('Message')}
+                    for arn in pending}
+        tagged.update(arn for arn in pending if arn not in failed)
+        retry = [arn for arn, error in failed.items()
+                 if error.get('ErrorCode') in THROTTLING_ERROR_CODES or error.get('StatusCode', 0) >= 500]
+        for arn, error in failed.items():
+          if arn not in retry:
+            print(f'[WARN] Could not tag {arn}: {error}')
+        if not retry:
+          break
+        pending = retry
+        time.sleep(min(30, (2 ** attempt) * 0.5) * random.uniform(0.5, 1.0))
+  print(f'Remediated {len(tagged)} of {len(fixes)} resources with {calls} tag_resources calls')
+  return tagged
+
+def ec2_vpc_ids():
+  '''
+  Resource id -> VPC id for EC2 instances, security groups and subnets.
+  '''
+  ec2 = boto3.client('ec2')
+  vpc_ids = {}
+  for page in ec2.get_paginator('describe_instances').paginate():
+    for reservation in page['Reservations']:
+      for instance in reservation['Instances']:
+        if instance.get('VpcId'):
+          vpc_ids[instance['InstanceId']] = instance['VpcId']
+  for page in ec2.get_paginator('describe_security_groups').paginate():
+    for group in page['SecurityGroups']:
+      if group.get('VpcId'):
+        vpc_ids[group['GroupId']] = group['VpcId']
+  for page in ec2.get_paginator('describe_subnets').paginate():
+    for subnet in page['Subnets']:
+      vpc_ids[subnet['SubnetId']] = subnet['VpcId']
+  return vpc_ids
+
+def remediate(mapping, candidates, results):
+  '''
+  Derive and apply the missing tags of the non compliant candidates.
+
+  Parameters:
+  mapping (dict): see load_remediation_mapping
+  candidates (list): (arn, resource id, vpc id, account id), one per result
+  results (list): tag policy results of the candidates
+
+  Returns:
+  dict: ARN -> tags added, for the resources tagged successfully
+  '''
+  fixes = {}
+  for (arn, resource_id, vpc_id, account_id), result in zip(candidates, results):
+    if result['missing']:
+      derived = derive_tags(mapping, result['missing'], arn, resource_id, vpc_id, account_id)
+      if derived:
+        fixes[arn] = derived
+  if not fixes:
+    return {}
+  tagged = apply_tags(fixes)
+  return {arn: tags for arn, tags in fixes.items() if arn in tagged}
+
+def remediation_mapping(rule_parameters):
+  '''
+  The remediation mapping, or None unless remediation is enabled with the
+  Remediate rule parameter.
+  '''
+  if str(rule_parameters.get('Remediate', 'false')).lower() != 'true':
+    return None
+  location = rule_parameters.get('RemediationMapping') or os.environ.get('REMEDIATION_MAPPING')
+  if not location:
+    print('[WARN] Remediate is enabled but no RemediationMapping is configured')
+    return None
+  return load_remediation_mapping(location)
+
+# --
+# Lambda
+# --
+
+def evaluate_config_item(config_item, rule_parameters, policy=None):
+  '''
+  Evaluate (and remediate, when enabled) the tags of one configuration item.
+
+  Parameters:
+  config_item (dict): the configuration item of the invoking event
+  rule_parameters (dict): raw ruleParameters
+  policy (TagPolicy): compiled policy, read from rule_parameters if omitted
+
+  Returns:
+  dict:
+    compliance_type (str): COMPLIANT or NON_COMPLIANT
+    annotation (str): the annotation message for AWS Config
+  '''
+  policy = policy or tag_policy.get_policy(rule_parameters, DEFAULT_TAG_POLICY)
+  print(config_item['resourceId'])
+  print(config_item['resourceType'])
+  print(config_item['tags'])
+
+  app_id_tag_compliance = 'COMPLIANT'
+  compliance_msg = ''
+  try:
+    tags = config_item['tags']
+    print('taggings of resource ', config_item['resourceId'], ' of type ', config_item['resourceType'], ': ', tags)
+    result = check_tags(tags, policy)
+
+    if result['missing'] and config_item.get('ARN'):
+      configuration = config_item.get('configuration') or {}
+      candidate = (config_item['ARN'], config_item['resourceId'], configuration.get('vpcId'), config_item['awsAccountId'])
+      try:
+        mapping = remediation_mapping(rule_parameters)
+        fixed = remediate(mapping, [candidate], [result]) if mapping is not None else {}
+      except ClientError as e:
+        # Report the pre-remediation result
+        print('[ERROR] Remediation of ', config_item['resourceId'], ' failed: ', e)
+        fixed = {}
+      if config_item['ARN'] in fixed:
+        tags = dict(tags, **fixed[config_item['ARN']])
+        result = check_tags(tags, policy)
+    app_id_tag_compliance = 'COMPLIANT' if result['valid'] else 'NON_COMPLIANT'
+    compliance_msg = tag_policy.annotation(result)
+
+  except ClientError as e:
+    print('Exception when getting tags for resource: ', config_item['resourceId'])
+    if e.response['Error']['Code'] == 'NoSuchTagSet':
+      print('No tag set for ', config_item['resourceId'])
+      app_id_tag_compliance = 'NON_COMPLIANT'
+      compliance_msg = config_item['resourceId'] + ' does not have any taggings'
+
+  return {'compliance_type': app_id_tag_compliance, 'annotation': compliance_msg}
+
 def lambda_handler(event, context):
   if event and 'invokingEvent' in event:
     invoking_event = json.loads(event['invokingEvent'])
-    config_item = invoking_event['configurationItem']
-    print(config_item['resourceId'])
-    print(config_item['resourceType'])
-    print(config_item['tags'])
+    rule_parameters = json.loads(event.get('ruleParameters') or '{}')
+    policy = tag_policy.get_policy(rule_parameters, DEFAULT_TAG_POLICY)
 
-    app_id_tag_compliance = 'COMPLIANT'
-    compliance_msg = ''
-    try:
-      tags = config_item['tags']
-      print('taggings of resource ', config_item['resourceId'], ' of type ', config_item['resourceType'], ': ', tags)
-      result = check_tags(tags)
-      if result['valid']:
-        app_id_tag_compliance = 'COMPLIANT'
-        compliance_msg = 'All tags are set appropriately'
-      else:
-        app_id_tag_compliance = 'NON_COMPLIANT'
-        compliance_msg=''
-        if len(result['missing']) > 0:
-          compliance_msg += f"Tags {result['missing']} is/are missing. "
-          
-        if len(result['wrong']) > 0:
-          compliance_msg += f"Tags {result['wrong']} is/are of wrong format. "
+    if invoking_event['messageType'] == 'ScheduledNotification':
+      resource_types = DEFAULT_SWEEP_RESOURCE_TYPES
+      if rule_parameters.get('SweepResourceTypes'):
+        resource_types = [t.strip() for t in rule_parameters['SweepResourceTypes'].split(',') if t.strip()]
+      evaluations = sweep_evaluations(policy, resource_types, invoking_event['notificationCreationTime'],
+                                      event['accountId'], remediation_mapping(rule_parameters))
+      put_evaluations_by_type(evaluations, event['resultToken'])
+      return
 
-    except ClientError as e:
-      print('Exception when getting tags for bucket: ', bucket)
-      if e.response['Error']['Code'] == 'NoSuchTagSet':
-        print('No tag set for ', bucket)
-        app_id_tag_compliance = 'NON_COMPLIANT'
-        compliance_msg = bucket + ' does not have any taggings'
+    config_item = invoking_event['configurationItem']
+    evaluation = evaluate_config_item(config_item, rule_parameters, policy)
+    app_id_tag_compliance = evaluation['compliance_type']
+    compliance_msg = evaluation['annotation']
   else:
     raise Exception('[ERROR] event argument not passed in lambda handler')
   
@@ -86,3 +430,4 @@ def lambda_handler(event, context):
      ResultToken=event['resultToken']
   )
 
+sqs_handler = config_event_batch.sqs_handler(evaluate_config_item, lambda_handler)
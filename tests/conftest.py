@@ -0,0 +1,27 @@
+import importlib.util
+import os
+import sys
+
+import boto3
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-1')
+
+
+@pytest.fixture
+def load_module(monkeypatch):
+  '''
+  Load a Lambda file by name (the files have hyphenated names), as
+  config-rule-dispatcher.py does. When client is given, boto3.client returns
+  it for every service, so the module level clients are the fake.
+  '''
+  def load(name, client=None):
+    if client is not None:
+      monkeypatch.setattr(boto3, 'client', lambda service, **kwargs: client)
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+  return load
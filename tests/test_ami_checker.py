@@ -0,0 +1,47 @@
+import pytest
+from botocore.exceptions import ClientError
+
+EVENT = {'accountId': '111111111111', 'resultToken': 'token'}
+
+
+class FakeClients:
+  def __init__(self):
+    self.saved = []
+    self.rejected = False
+
+  def get_paginator(self, operation):
+    return self
+
+  def paginate(self, **kwargs):
+    public = kwargs['Filters'] and kwargs['Filters'][0]['Name'] == 'is-public'
+    return [{'Images': [{'ImageId': 'ami-1', 'CreationDate': '2026-01-01T00:00:00.000Z', 'Public': public}]}]
+
+  def get_parameter(self, Name):
+    raise ClientError({'Error': {'Code': 'ParameterNotFound', 'Message': ''}}, 'GetParameter')
+
+  def put_parameter(self, **kwargs):
+    self.saved.append(kwargs['Value'])
+
+  def put_evaluations(self, Evaluations, ResultToken):
+    if self.rejected:
+      return {'FailedEvaluations': Evaluations}
+    return {}
+
+
+@pytest.fixture
+def clients():
+  return FakeClients()
+
+@pytest.fixture
+def checker(load_module, clients):
+  return load_module('ami-checker', clients)
+
+
+def test_state_saved_after_evaluations(checker, clients):
+  checker.lambda_handler(EVENT, None)
+  assert len(clients.saved) == 1
+
+def test_state_not_saved_when_evaluations_fail(checker, clients):
+  clients.rejected = True
+  checker.lambda_handler(EVENT, None)
+  assert clients.saved == []
@@ -0,0 +1,22 @@
+import datetime
+
+import compliance_history
+
+RUN_TIME = datetime.datetime(2026, 10, 12, 8, 0, 0)
+
+
+def test_scopes_written_in_the_same_second_are_kept_apart():
+  conn = compliance_history.connect(':memory:')
+  compliance_history.append_run(conn, '111111111111', [('rule', 'sg-1', 'digest')], RUN_TIME)
+  compliance_history.append_run(conn, 'aggregator', [], RUN_TIME)
+
+  assert compliance_history.time_in_violation(conn, '111111111111', 'rule', 'sg-1')['since'] == '2026-10-12T08:00:00Z'
+  assert compliance_history.time_in_violation(conn, 'aggregator', 'rule', 'sg-1') is None
+
+def test_regressions_compare_runs_of_one_scope():
+  conn = compliance_history.connect(':memory:')
+  compliance_history.append_run(conn, '111111111111', [('rule', 'sg-1', 'digest')], RUN_TIME - datetime.timedelta(days=7))
+  compliance_history.append_run(conn, 'aggregator', [], RUN_TIME - datetime.timedelta(days=6))
+  compliance_history.append_run(conn, '111111111111', [('rule', 'sg-1', 'digest'), ('rule', 'sg-2', 'digest')], RUN_TIME)
+
+  assert compliance_history.regressions(conn, '111111111111', '2026-10-10') == [('rule', 1)]
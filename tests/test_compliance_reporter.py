@@ -0,0 +1,57 @@
+import types
+
+import pytest
+from botocore.exceptions import ClientError
+
+SNS_LIMIT = 256 * 1024
+
+
+class FakeSns:
+  def __init__(self):
+    self.messages = []
+
+  def publish(self, TopicArn, Subject, Message):
+    if len(Message.encode('utf-8')) > SNS_LIMIT:
+      raise ClientError({'Error': {'Code': 'InvalidParameter', 'Message': 'Message too long'}}, 'Publish')
+    self.messages.append(Message)
+    return {}
+
+
+def results(count, annotation='x' * 200):
+  return [
+    {
+      'EvaluationResultIdentifier': {'EvaluationResultQualifier': {'ResourceId': 'sg-%08d' % i}},
+      'Annotation': annotation,
+    }
+    for i in range(count)
+  ]
+
+
+@pytest.fixture
+def sns():
+  return FakeSns()
+
+@pytest.fixture
+def reporter(load_module, monkeypatch, sns, tmp_path):
+  module = load_module('compliance-reporter', sns)
+  monkeypatch.setattr(module, 'SNAPSHOT_LOCATION', str(tmp_path / 'snapshot.json.gz'))
+  monkeypatch.setattr(module, 'list_config_rules', lambda config: ['security-group'])
+  return module
+
+def run(reporter, monkeypatch, collected):
+  monkeypatch.setattr(reporter, 'collect_non_compliant_results', lambda config, rule_names, sink=None: collected)
+  context = types.SimpleNamespace(invoked_function_arn='arn:aws:lambda:ap-southeast-1:111111111111:function:compliance-reporter')
+  reporter.lambda_handler({}, context)
+
+
+def test_first_run_is_capped_and_seeds_the_snapshot(reporter, monkeypatch, sns):
+  run(reporter, monkeypatch, [('security-group', results(5000))])
+  assert len(sns.messages) == 1
+  assert 'more, not listed' in sns.messages[0]
+  assert len(reporter.load_snapshot(reporter.SNAPSHOT_LOCATION)) == 5000
+
+def test_second_run_reports_the_delta(reporter, monkeypatch, sns):
+  run(reporter, monkeypatch, [('security-group', results(5000))])
+  run(reporter, monkeypatch, [('security-group', results(4999))])
+  assert 'Resolved: 1\n' in sns.messages[1]
+  assert 'Newly failing: 0\n' in sns.messages[1]
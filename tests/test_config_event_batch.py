@@ -0,0 +1,104 @@
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+
+import config_event_batch
+
+
+def record(message_id, resource_id, capture_time, result_token='token-1', resource_type='AWS::EC2::Instance',
+           rule='rule-1', oversized=False):
+  item = {
+    'resourceType': resource_type,
+    'resourceId': resource_id,
+    'configurationItemCaptureTime': capture_time,
+  }
+  if oversized:
+    invoking_event = {'messageType': 'OversizedConfigurationItemChangeNotification', 'configurationItemSummary': item}
+  else:
+    invoking_event = {'messageType': 'ConfigurationItemChangeNotification', 'configurationItem': dict(item, configuration={})}
+  return {
+    'messageId': message_id,
+    'body': json.dumps({'invokingEvent': json.dumps(invoking_event), 'resultToken': result_token, 'configRuleName': rule}),
+  }
+
+def evaluation(resource_id, resource_type='AWS::EC2::Instance'):
+  return {
+    'ComplianceResourceType': resource_type,
+    'ComplianceResourceId': resource_id,
+    'ComplianceType': 'COMPLIANT',
+  }
+
+class FakeConfig:
+  def __init__(self, rejected=(), recorded=()):
+    self.rejected = set(rejected)
+    self.recorded = dict(recorded)
+    self.calls = []
+
+  def get_resource_config_history(self, resourceType, resourceId, limit):
+    if resourceId == 'i-throttled':
+      raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'GetResourceConfigHistory')
+    items = [dict(self.recorded[resourceId], resourceType=resourceType, resourceId=resourceId)] if resourceId in self.recorded else []
+    return {'configurationItems': items}
+
+  def put_evaluations(self, Evaluations, ResultToken):
+    self.calls.append((ResultToken, [item['ComplianceResourceId'] for item in Evaluations]))
+    return {'FailedEvaluations': [item for item in Evaluations
+                                  if (item['ComplianceResourceType'], item['ComplianceResourceId']) in self.rejected]}
+
+
+def test_latest_events_keeps_the_latest_event_per_resource():
+  scheduled = {'messageId': 'm-scheduled', 'body': json.dumps({
+    'invokingEvent': json.dumps({'messageType': 'ScheduledNotification'}), 'resultToken': 'token-1'})}
+  records = [
+    record('m1', 'i-1', '2024-01-01T00:00:02Z'),
+    record('m2', 'i-1', '2024-01-01T00:00:01Z'),
+    record('m3', 'i-1', '2024-01-01T00:00:03Z'),
+    record('m4', 'i-1', '2024-01-01T00:00:01Z', resource_type='AWS::EC2::Volume'),
+    record('m5', 'i-1', '2024-01-01T00:00:01Z', rule='rule-2'),
+    scheduled,
+    {'messageId': 'm-broken', 'body': 'not json'},
+  ]
+
+  latest, other_events, failed = config_event_batch.latest_events(records)
+
+  assert {key: value[0] for key, value in latest.items()} == {
+    ('rule-1', 'AWS::EC2::Instance', 'i-1'): 'm3',
+    ('rule-1', 'AWS::EC2::Volume', 'i-1'): 'm4',
+    ('rule-2', 'AWS::EC2::Instance', 'i-1'): 'm5',
+  }
+  assert [message_id for message_id, rule_event in other_events] == ['m-scheduled']
+  assert failed == ['m-broken']
+
+def test_put_evaluations_by_token_chunks_and_maps_rejected_evaluations():
+  config = FakeConfig(rejected=[('AWS::EC2::Instance', 'i-42'), ('AWS::EC2::Instance', 'i-150')])
+  pending = {
+    'token-1': [('m' + str(i), evaluation('i-' + str(i))) for i in range(150)],
+    'token-2': [('other', evaluation('i-42', resource_type='AWS::EC2::Volume'))],
+  }
+
+  failed = config_event_batch.put_evaluations_by_token(config, pending)
+
+  assert [(token, len(ids)) for token, ids in config.calls] == [('token-1', 100), ('token-1', 50), ('token-2', 1)]
+  assert failed == ['m42']
+
+def test_oversized_items_are_read_from_config_and_unevaluable_messages_dropped(monkeypatch):
+  config = FakeConfig(recorded={'i-big': {'configuration': '{"instanceType": "t3.micro"}'}})
+  monkeypatch.setattr(boto3, 'client', lambda service, **kwargs: config)
+  evaluated = {}
+  def evaluate(configuration_item, rule_parameters):
+    evaluated[configuration_item['resourceId']] = configuration_item['configuration']
+    if configuration_item['resourceId'] == 'i-broken':
+      raise KeyError('instanceType')
+    return {'compliance_type': 'COMPLIANT', 'annotation': 'ok'}
+
+  response = config_event_batch.handle_sqs_batch({'Records': [
+    record('m-big', 'i-big', '2024-01-01T00:00:00Z', oversized=True),
+    record('m-unrecorded', 'i-unrecorded', '2024-01-01T00:00:00Z', oversized=True),
+    record('m-throttled', 'i-throttled', '2024-01-01T00:00:00Z', oversized=True),
+    record('m-broken', 'i-broken', '2024-01-01T00:00:00Z'),
+  ]}, evaluate)
+
+  assert evaluated == {'i-big': {'instanceType': 't3.micro'}, 'i-broken': {}}
+  assert config.calls == [('token-1', ['i-big'])]
+  assert response == {'batchItemFailures': [{'itemIdentifier': 'm-throttled'}]}
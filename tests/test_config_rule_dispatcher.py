@@ -0,0 +1,68 @@
+import json
+import types
+
+import pytest
+
+SUMMARY = {
+  'resourceType': 'AWS::RDS::DBInstance',
+  'resourceId': 'db-ABCDEFGHIJKLMNOP',
+  'configurationItemStatus': 'OK',
+  'configurationItemCaptureTime': '2026-01-01T00:00:00.000Z',
+}
+
+
+class FakeConfig:
+  def __init__(self):
+    self.recorded = []
+    self.evaluations = []
+
+  def get_resource_config_history(self, resourceType, resourceId, limit):
+    return {'configurationItems': self.recorded}
+
+  def put_evaluations(self, Evaluations, ResultToken):
+    self.evaluations.extend(Evaluations)
+    return {}
+
+
+@pytest.fixture
+def config():
+  return FakeConfig()
+
+@pytest.fixture
+def dispatcher(load_module, config):
+  return load_module('config-rule-dispatcher', config)
+
+
+def test_oversized_rds_item_is_read_from_config(dispatcher, config):
+  config.recorded = [dict(SUMMARY, arn='arn:aws:rds:ap-southeast-1:111111111111:db:db1', accountId='111111111111',
+                          version='1.3', tags={}, configuration=json.dumps({'dBInstanceIdentifier': 'db1'}))]
+  context = dispatcher.resource_context.RdsContext(SUMMARY)
+  assert context.instance_id == 'db1'
+  assert context.configuration_item['awsAccountId'] == '111111111111'
+
+def test_unrecorded_oversized_rds_item_reports_a_failure(dispatcher, config):
+  event = {
+    'invokingEvent': json.dumps({'messageType': 'OversizedConfigurationItemChangeNotification', 'configurationItemSummary': SUMMARY}),
+    'resultToken': 'token',
+  }
+  dispatcher.lambda_handler(event, None)
+  [evaluation] = config.evaluations
+  assert evaluation['ComplianceType'] == 'NON_COMPLIANT'
+  assert 'evaluation failure' in evaluation['Annotation']
+
+def test_a_failing_rule_is_reported_without_failing_the_others(dispatcher, monkeypatch):
+  def broken(context, debug_enabled):
+    raise KeyError('licenseModel')
+  def passing(context, debug_enabled):
+    return {'compliance_type': 'COMPLIANT', 'annotation': 'ok'}
+  monkeypatch.setattr(dispatcher, 'LOADED_RULES', {
+    'rds-checker': types.SimpleNamespace(evaluate_context=broken),
+    'rds-encryption-checker': types.SimpleNamespace(evaluate_context=passing),
+  })
+  item = dict(SUMMARY, configuration={'dBInstanceIdentifier': 'db1'})
+
+  results = dispatcher.evaluate_rules(item, None, ['rds-checker', 'rds-encryption-checker'], False)
+
+  assert [(name, evaluation['compliance_type']) for name, evaluation in results] == [
+    ('rds-checker', 'NON_COMPLIANT'), ('rds-encryption-checker', 'COMPLIANT')]
+  assert results[0][1]['annotation'] == 'evaluation failure on resource db-ABCDEFGHIJKLMNOP'
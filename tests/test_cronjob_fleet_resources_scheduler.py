@@ -0,0 +1,46 @@
+import types
+
+import pytest
+
+import resource_scheduler
+import scheduler_targets
+
+
+class Context:
+  def get_remaining_time_in_millis(self):
+    return 930 * 1000
+
+
+@pytest.fixture
+def fleet(load_module, monkeypatch):
+  module = load_module('cronjob-fleet-resources-scheduler')
+  clock = types.SimpleNamespace(time=lambda: 1000.0)
+  monkeypatch.setattr(module, 'time', clock)
+  monkeypatch.setattr(resource_scheduler, 'time', clock)
+  targets = [{'account': str(i), 'region': 'ap-southeast-1'} for i in range(25)]
+  monkeypatch.setattr(scheduler_targets, 'load_targets', lambda event: targets)
+  monkeypatch.setattr(scheduler_targets, 'run_targets',
+                      lambda targets, work: [dict(target, result=work(target, None, None)) for target in targets])
+  return module
+
+
+def test_each_round_of_targets_gets_its_share_of_the_run(fleet, monkeypatch):
+  deadlines = []
+  def start_target(target, ec2, rds, deadline=None):
+    deadlines.append(deadline)
+    return {'unstarted': []}
+  monkeypatch.setattr(fleet, 'start_target', start_target)
+
+  result = fleet.lambda_handler({'action': 'start'}, Context())
+
+  # 900s left after RUN_MARGIN_SECONDS, 25 targets run in 3 rounds of 10
+  assert set(deadlines) == {1300.0}
+  assert result['status'] == 'complete'
+
+def test_unstarted_waves_make_the_run_incomplete(fleet, monkeypatch):
+  monkeypatch.setattr(fleet, 'start_target', lambda target, ec2, rds, deadline=None:
+                      {'unstarted': [{'wave': 2, 'ec2': ['i-1'], 'rds': []}] if target['account'] == '24' else []})
+
+  result = fleet.lambda_handler({'action': 'start'}, Context())
+
+  assert result['status'] == 'incomplete'
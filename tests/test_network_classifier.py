@@ -0,0 +1,43 @@
+import network_classifier
+from network_classifier import NON_PRODUCTION, PRODUCTION
+
+
+def test_flatten_networks_carves_nested_networks_out_of_their_parent():
+  networks = [(0, 99, 'a'), (10, 19, 'b'), (12, 13, 'a'), (50, 59, 'b')]
+  assert network_classifier.flatten_networks(networks) == [
+    (0, 9, 'a'), (10, 11, 'b'), (12, 13, 'a'), (14, 19, 'b'),
+    (20, 49, 'a'), (50, 59, 'b'), (60, 99, 'a'),
+  ]
+
+def test_flatten_networks_merges_adjacent_segments_with_the_same_label():
+  assert network_classifier.flatten_networks([(0, 9, 'a'), (10, 19, 'a'), (30, 39, 'b')]) == [
+    (0, 19, 'a'), (30, 39, 'b'),
+  ]
+
+def test_flatten_networks_keeps_a_nested_network_ending_with_its_parent():
+  assert network_classifier.flatten_networks([(0, 99, 'a'), (90, 99, 'b')]) == [(0, 89, 'a'), (90, 99, 'b')]
+
+def test_classify_uses_the_most_specific_cidr():
+  classifier = network_classifier.NetworkClassifier(
+    ['10.0.0.0/8', '10.1.2.0/24', 'fd00::/8'], ['10.1.0.0/16', 'fd00:1::/32'])
+  assert classifier.classify_many(['10.0.0.1', '10.1.0.1', '10.1.2.3', '10.2.0.1', '192.168.0.1']) == {
+    '10.0.0.1': PRODUCTION,
+    '10.1.0.1': NON_PRODUCTION,
+    '10.1.2.3': PRODUCTION,
+    '10.2.0.1': PRODUCTION,
+    '192.168.0.1': None,
+  }
+  assert classifier.classify('fd00::1') == PRODUCTION
+  assert classifier.classify('fd00:1::1') == NON_PRODUCTION
+  assert classifier.any_production(['192.168.0.1', '10.1.2.3'])
+
+def test_get_classifier_defaults_and_caches():
+  default = network_classifier.get_classifier({})
+  assert default.is_production('172.31.200.1')
+  assert not default.is_production('172.31.0.1')
+
+  parameters = {'ProductionCidrs': '10.0.0.0/16, 10.1.0.0/16', 'NonProductionCidrs': '10.0.5.0/24'}
+  classifier = network_classifier.get_classifier(parameters)
+  assert classifier is network_classifier.get_classifier(dict(parameters))
+  assert classifier.is_production('10.1.0.1')
+  assert not classifier.is_production('10.0.5.1')
@@ -0,0 +1,45 @@
+import pytest
+
+
+class FakeContext:
+  def __init__(self, production, **configuration):
+    self.instance_id = 'db1'
+    self.production = production
+    self.scope_checks = 0
+    self.cluster_lookups = 0
+    self.configuration = dict({
+      'storageEncrypted': True,
+      'publiclyAccessible': False,
+      'licenseModel': 'general-public-license',
+      'engine': 'aurora-postgresql',
+    }, **configuration)
+    self.configuration_item = {'tags': {'Environment': 'P1', 'ApplicationID': 'app'}}
+
+  def is_production(self):
+    self.scope_checks += 1
+    return self.production
+
+  def db_cluster(self):
+    self.cluster_lookups += 1
+    return {'MultiAZ': True}
+
+
+@pytest.fixture
+def checker(load_module):
+  return load_module('rds-checker')
+
+
+def test_configuration_finding_checks_the_scope_once(checker):
+  context = FakeContext(production=True, publiclyAccessible=True)
+  assert 'publicly accessible' in checker.evaluate_context(context)['annotation']
+  assert context.scope_checks == 1
+  assert context.cluster_lookups == 0
+
+def test_remote_checks_only_run_in_scope(checker):
+  outside = FakeContext(production=False)
+  assert checker.evaluate_context(outside)['compliance_type'] == 'NOT_APPLICABLE'
+  assert (outside.scope_checks, outside.cluster_lookups) == (1, 0)
+
+  inside = FakeContext(production=True)
+  assert checker.evaluate_context(inside)['compliance_type'] == 'COMPLIANT'
+  assert (inside.scope_checks, inside.cluster_lookups) == (1, 1)
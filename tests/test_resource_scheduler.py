@@ -0,0 +1,154 @@
+import types
+
+import pytest
+from botocore.exceptions import ClientError
+
+import resource_scheduler
+
+
+class FakeClock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+class FakeEc2:
+  '''
+  Instances are running wait_seconds after their start.
+  '''
+  def __init__(self, clock, wait_seconds):
+    self.clock = clock
+    self.wait_seconds = wait_seconds
+    self.started = []
+    self.started_at = {}
+    self.describe_calls = 0
+
+  def start_instances(self, InstanceIds):
+    self.started.extend(InstanceIds)
+    self.started_at.update((instance_id, self.clock.now) for instance_id in InstanceIds)
+    return {'StartingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+  def get_paginator(self, name):
+    return self
+
+  def paginate(self, InstanceIds):
+    self.describe_calls += 1
+    ready = lambda instance_id: self.clock.now >= self.started_at[instance_id] + self.wait_seconds
+    yield {'Reservations': [{'Instances': [
+      {'InstanceId': instance_id, 'State': {'Name': 'running' if ready(instance_id) else 'pending'}}
+      for instance_id in InstanceIds]}]}
+
+
+class FakeRds:
+  '''
+  Database instances that never become available.
+  '''
+  def __init__(self):
+    self.started = []
+    self.filters = []
+
+  def start_db_instance(self, DBInstanceIdentifier):
+    self.started.append(DBInstanceIdentifier)
+
+  def get_paginator(self, name):
+    return self
+
+  def paginate(self, Filters):
+    self.filters.append(Filters[0]['Values'])
+    yield {'DBInstances': [{'DBInstanceIdentifier': db_id, 'DBInstanceStatus': 'starting'}
+                           for db_id in Filters[0]['Values']]}
+
+
+def instance(instance_id, wave):
+  return {'id': instance_id, 'state': 'stopped', 'tags': {'StartWave': str(wave), 'Environment': 'D1'}}
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = FakeClock()
+  monkeypatch.setattr(resource_scheduler, 'time', types.SimpleNamespace(time=clock.time, sleep=clock.sleep))
+  return clock
+
+
+def test_waves_stop_at_the_deadline(clock):
+  ec2 = FakeEc2(clock, wait_seconds=100)
+  result = resource_scheduler.start_waves(ec2, None, [instance('i-1', 1), instance('i-2', 2)], [], deadline=clock.now + 120)
+
+  assert ec2.started == ['i-1']
+  assert result['unstarted'] == [{'wave': 2, 'ec2': ['i-2'], 'rds': []}]
+  # polled every READY_POLL_SECONDS, ready at the first poll after 100s
+  assert result['time_to_ready'] == {'D1': 105.0}
+
+def test_many_rds_resources_share_the_wave_deadline(clock):
+  rds = FakeRds()
+  databases = [{'kind': 'instance', 'id': 'db' + str(i), 'status': 'stopped', 'tags': {'Environment': 'D1'}}
+               for i in range(40)]
+  start = clock.now
+  result = resource_scheduler.start_waves(FakeEc2(clock, 0), rds, [], databases, deadline=start + 63)
+
+  assert len(rds.started) == 40
+  assert clock.now - start <= 63
+  # one describe_db_instances call per poll for the whole wave
+  assert [len(values) for values in rds.filters] == [40] * 5
+  assert result['waves'][0]['ready'] is False
+  assert result['time_to_ready'] == {'D1': None}
+
+def test_wait_ready_with_a_short_budget_polls_once(clock):
+  rds = FakeRds()
+  databases = [{'kind': 'instance', 'id': 'db' + str(i), 'tags': {}} for i in range(40)]
+  start = clock.now
+
+  assert resource_scheduler.wait_ready(None, rds, [], databases, 3) == [('untagged', None)] * 40
+  assert clock.now == start
+  assert len(rds.filters) == 1
+
+def test_waves_without_deadline(clock):
+  ec2 = FakeEc2(clock, wait_seconds=100)
+  result = resource_scheduler.start_waves(ec2, None, [instance('i-1', 1), instance('i-2', 2)], [])
+
+  assert ec2.started == ['i-1', 'i-2']
+  assert result['unstarted'] == []
+
+
+def stop_plan(entries):
+  return {'region': None, 'action': 'stop', 'tag': 'StopAtNonWorkingHours', 'start': [], 'stop': entries, 'leave': []}
+
+def test_ec2_only_scheduler_rejects_rds_plans():
+  plan = stop_plan([{'service': 'rds', 'kind': 'instance', 'id': 'db1'}])
+  with pytest.raises(Exception, match='RDS entries'):
+    resource_scheduler.execute_plan(types.SimpleNamespace(), None, plan, 'stop', 'StopAtNonWorkingHours')
+
+def test_plan_for_another_action_is_rejected():
+  plan = dict(stop_plan([]), action='start')
+  with pytest.raises(Exception, match='not a stop plan'):
+    resource_scheduler.execute_plan(types.SimpleNamespace(), None, plan, 'stop', 'StopAtNonWorkingHours')
+
+
+class RejectingEc2:
+  '''
+  start_instances fails while a terminated or stopping instance is in the call,
+  naming one of them like EC2 does.
+  '''
+  def __init__(self):
+    self.calls = []
+
+  def start_instances(self, InstanceIds):
+    self.calls.append(list(InstanceIds))
+    if 'i-0dead' in InstanceIds:
+      raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound',
+                                   'Message': "The instance ID 'i-0dead' does not exist"}}, 'StartInstances')
+    if 'i-0bad' in InstanceIds:
+      raise ClientError({'Error': {'Code': 'IncorrectInstanceState',
+                                   'Message': "The instance 'i-0bad' is not in a state from which it can be started."}}, 'StartInstances')
+    return {'StartingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+def test_rejected_instances_are_left_out_of_their_chunk():
+  ec2 = RejectingEc2()
+  started = resource_scheduler.ec2_act(ec2, 'start', ['i-01', 'i-0dead', 'i-02', 'i-0bad'])
+
+  assert started == ['i-01', 'i-02']
+  assert ec2.calls[-1] == ['i-01', 'i-02']
@@ -0,0 +1,30 @@
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeS3:
+  def __init__(self, code):
+    self.code = code
+
+  def get_bucket_tagging(self, Bucket):
+    raise ClientError({'Error': {'Code': self.code, 'Message': self.code}}, 'GetBucketTagging')
+
+
+@pytest.fixture
+def checker(load_module):
+  return load_module('s3-bucket-tagging-checker', FakeS3('AccessDenied'))
+
+def config_item(bucket):
+  return {'resourceName': bucket, 'configuration': {'name': bucket}, 'configurationItemCaptureTime': '2026-01-01T00:00:00.000Z'}
+
+
+def test_bucket_tagging_error_is_an_evaluation_failure(checker):
+  assert checker.evaluate_config_item(config_item('denied-bucket'), {}) == {
+    'compliance_type': 'NON_COMPLIANT',
+    'annotation': 'evaluation failure on resource denied-bucket',
+  }
+
+def test_bucket_without_tag_set_has_no_tags(checker, monkeypatch):
+  monkeypatch.setattr(checker, 's3', FakeS3('NoSuchTagSet'))
+  evaluation = checker.evaluate_config_item(config_item('untagged-bucket'), {})
+  assert evaluation['annotation'] == 'untagged-bucket does not have any taggings'
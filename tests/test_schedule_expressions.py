@@ -0,0 +1,67 @@
+import datetime
+
+import schedule_expressions
+
+UTC = datetime.timezone.utc
+# 2024-01-01 is a Monday
+HOLIDAY = datetime.date(2024, 1, 1)
+
+
+def utc(day, hour, minute=0):
+  return datetime.datetime(2024, 1, day, hour, minute, tzinfo=UTC)
+
+def resource(resource_id, expression=None):
+  return {'id': resource_id, 'tags': {'Schedule': expression} if expression else {}}
+
+
+def test_overnight_window_belongs_to_the_day_it_starts():
+  index = schedule_expressions.ScheduleIndex([resource('night', 'mon-fri 22:00-06:00 tz=UTC')])
+  assert index.desired_states(utc(1, 23)) == {'night': True}
+  # Tuesday morning, window started Monday evening
+  assert index.desired_states(utc(2, 5, 59)) == {'night': True}
+  assert index.desired_states(utc(2, 6)) == {'night': False}
+  # Monday morning, the window started on Sunday which is not a weekday
+  assert index.desired_states(utc(1, 3)) == {'night': False}
+  # Saturday morning, the window started on Friday
+  assert index.desired_states(utc(6, 3)) == {'night': True}
+
+def test_holidays_switch_off_unless_the_schedule_keeps_them():
+  index = schedule_expressions.ScheduleIndex([
+    resource('office', 'mon-fri 08:00-20:00 tz=UTC'),
+    resource('always', 'daily 08:00-20:00 tz=UTC holidays=on'),
+  ])
+  holidays = frozenset([HOLIDAY])
+  assert index.desired_states(utc(1, 12), holidays) == {'office': False, 'always': True}
+  assert index.desired_states(utc(2, 12), holidays) == {'office': True, 'always': True}
+
+def test_overnight_window_on_the_day_after_a_holiday():
+  index = schedule_expressions.ScheduleIndex([resource('night', 'daily 22:00-06:00 tz=UTC')])
+  holidays = frozenset([HOLIDAY])
+  assert index.desired_states(utc(1, 23), holidays) == {'night': False}
+  assert index.desired_states(utc(2, 3), holidays) == {'night': False}
+  assert index.desired_states(utc(2, 23), holidays) == {'night': True}
+
+def test_windows_are_evaluated_in_the_schedule_time_zone():
+  index = schedule_expressions.ScheduleIndex([
+    resource('hk', 'mon-fri 08:00-12:00+13:00-19:00 tz=Asia/Hong_Kong'),
+    resource('utc', 'mon-fri 08:00-12:00+13:00-19:00 tz=UTC'),
+  ])
+  # Monday 09:00 in Hong Kong
+  assert index.desired_states(utc(1, 1)) == {'hk': True, 'utc': False}
+  # Monday 12:30 in Hong Kong, lunch break
+  assert index.desired_states(utc(1, 4, 30)) == {'hk': False, 'utc': False}
+  # Sunday 18:00 UTC is Monday 02:00 in Hong Kong
+  assert index.desired_states(utc(7, 18)) == {'hk': False, 'utc': False}
+  # Friday 17:00 UTC is Saturday 01:00 in Hong Kong
+  assert index.desired_states(utc(5, 17)) == {'hk': False, 'utc': True}
+
+def test_resources_without_a_valid_schedule_are_unscheduled():
+  index = schedule_expressions.ScheduleIndex([
+    resource('untagged'),
+    resource('invalid', 'mon-fri'),
+    resource('a', 'daily 00:00-24:00'),
+    resource('b', 'daily 00:00-24:00'),
+  ])
+  assert [item['id'] for item in index.unscheduled] == ['untagged', 'invalid']
+  assert len(index.groups) == 1
+  assert index.desired_states(utc(3, 12)) == {'a': True, 'b': True}
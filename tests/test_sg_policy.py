@@ -0,0 +1,48 @@
+import sg_policy
+
+WEB = sg_policy.PortRangeIndex([
+  {'IpProtocol': 'tcp', 'FromPort': 80, 'ToPort': 80},
+  {'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443},
+  {'IpProtocol': 'tcp', 'FromPort': 444, 'ToPort': 450},
+])
+
+
+def test_merge_intervals_joins_overlapping_and_adjacent_ranges():
+  assert sg_policy.merge_intervals([(10, 20), (21, 30), (5, 12), (40, 50)]) == [[5, 30], [40, 50]]
+
+def test_covers_needs_every_port():
+  assert WEB.covers('tcp', 80, 80)
+  assert WEB.covers('tcp', 443, 450)
+  assert not WEB.covers('tcp', 80, 443)
+  assert not WEB.covers('udp', 80, 80)
+
+def test_overlaps_needs_one_port():
+  assert WEB.overlaps('tcp', 0, 80)
+  assert WEB.overlaps('6', 450, 1000)
+  assert not WEB.overlaps('tcp', 81, 442)
+  assert not WEB.overlaps('tcp', 451, 65535)
+
+def test_all_traffic_entries_apply_to_every_protocol():
+  index = sg_policy.PortRangeIndex([{'IpProtocol': '-1'}])
+  assert index.covers('udp', 53, 53)
+  assert index.covers('-1', 0, 65535)
+  assert index.overlaps('tcp', 22, 22)
+
+def test_batch_lookups_match_single_lookups():
+  queries = [('tcp', 443, 450), ('tcp', 0, 79), ('udp', 80, 80), ('tcp', 80, 80), ('-1', 0, 65535), ('tcp', 79, 81)]
+  assert WEB.covers_many(queries) == [WEB.covers(*query) for query in queries]
+  assert WEB.overlaps_many(queries) == [WEB.overlaps(*query) for query in queries]
+
+def test_find_public_violations_reports_the_first_public_rule_not_allowed():
+  groups = [
+    ('sg-web', [{'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}]),
+    ('sg-ssh', [
+      {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '10.0.0.0/8'}]},
+      {'IpProtocol': 'icmp', 'FromPort': 8, 'ToPort': 0, 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
+      {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'Ipv6Ranges': [{'CidrIpv6': '::/0'}]},
+    ]),
+  ]
+  assert sg_policy.find_public_violations(groups, allowed=WEB) == {
+    'sg-web': None,
+    'sg-ssh': ('tcp', 22, 22, '::/0'),
+  }
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+ARN = 'arn:aws:ec2:ap-southeast-1:111111111111:instance/i-0123456789abcdef0'
+RESOURCE_ID = 'i-0123456789abcdef0'
+MAPPING = {'resources': {RESOURCE_ID: {'ApplicationID': '1234'}}}
+
+
+class FakeTagging:
+  def __init__(self, tag_error=None):
+    self.tag_error = tag_error
+    self.tag_calls = []
+
+  def get_paginator(self, operation):
+    assert operation == 'get_resources'
+    return self
+
+  def paginate(self, **kwargs):
+    return [{'ResourceTagMappingList': [{'ResourceARN': ARN, 'Tags': [{'Key': 'Environment', 'Value': 'D1'}]}]}]
+
+  def tag_resources(self, ResourceARNList, Tags):
+    self.tag_calls.append((ResourceARNList, Tags))
+    if self.tag_error:
+      raise ClientError({'Error': {'Code': self.tag_error, 'Message': self.tag_error}}, 'TagResources')
+    return {'FailedResourcesMap': {}}
+
+
+@pytest.fixture
+def tagging():
+  return FakeTagging()
+
+@pytest.fixture
+def checker(load_module, tagging):
+  return load_module('tagging-checker', tagging)
+
+
+def sweep(checker, mapping):
+  policy = checker.tag_policy.get_policy({}, checker.DEFAULT_TAG_POLICY)
+  return checker.sweep_evaluations(policy, ['ec2:instance'], '2026-01-01T00:00:00Z', '111111111111', mapping)
+
+def config_item(tmp_path):
+  path = tmp_path / 'mapping.json'
+  path.write_text(json.dumps(MAPPING))
+  item = {
+    'ARN': ARN,
+    'resourceId': RESOURCE_ID,
+    'resourceType': 'AWS::EC2::Instance',
+    'awsAccountId': '111111111111',
+    'tags': {'Environment': 'D1'},
+  }
+  return item, {'Remediate': 'true', 'RemediationMapping': str(path)}
+
+
+def test_sweep_remediates_missing_tags(checker, tagging):
+  [evaluation] = sweep(checker, MAPPING)
+  assert tagging.tag_calls == [([ARN], {'ApplicationID': '1234'})]
+  assert evaluation['ComplianceType'] == 'COMPLIANT'
+
+def test_sweep_without_remediation(checker, tagging):
+  [evaluation] = sweep(checker, None)
+  assert tagging.tag_calls == []
+  assert evaluation['ComplianceType'] == 'NON_COMPLIANT'
+
+def test_sweep_keeps_result_when_tagging_fails(checker, tagging):
+  tagging.tag_error = 'AccessDeniedException'
+  [evaluation] = sweep(checker, MAPPING)
+  assert evaluation['ComplianceType'] == 'NON_COMPLIANT'
+
+def test_config_item_remediation(checker, tagging, tmp_path):
+  item, rule_parameters = config_item(tmp_path)
+  evaluation = checker.evaluate_config_item(item, rule_parameters)
+  assert tagging.tag_calls == [([ARN], {'ApplicationID': '1234'})]
+  assert evaluation['compliance_type'] == 'COMPLIANT'
+
+def test_config_item_keeps_result_when_tagging_fails(checker, tagging, tmp_path):
+  tagging.tag_error = 'AccessDeniedException'
+  item, rule_parameters = config_item(tmp_path)
+  evaluation = checker.evaluate_config_item(item, rule_parameters)
+  assert evaluation['compliance_type'] == 'NON_COMPLIANT'
+  assert 'ApplicationID' in evaluation['annotation']